@@ -0,0 +1,148 @@
+""" Analyses positions in bulk on a pool of worker processes, reading FEN or EPD and writing JSON lines in input
+order """
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import chessAI
+import engine
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Positions handed to each worker ahead of the one being written out, which bounds memory however long the input is
+QUEUED_PER_WORKER = 4
+# EPD operations that set the limits for one position, analysis count depth, nodes and seconds
+LIMIT_OPERATIONS = {"acd": ("depth", int), "acn": ("nodes", int), "acs": ("movetime", float)}
+
+# Searcher of a worker process, kept between positions so its table is allocated once
+worker_searcher = None
+
+
+# Splits a FEN or EPD line into the position and its operations, such as bm, id and acd. FEN move counters are kept
+# with the position, EPD operations take their place
+def parse_position(line):
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError("Invalid FEN: " + line)
+    position = " ".join(fields[:4])
+    rest = fields[4] if len(fields) > 4 else ""
+    counters = rest.split()
+    if len(counters) == 2 and counters[0].isdigit() and counters[1].isdigit():
+        return position + " " + rest, {}
+    operations = {}
+    for operation in rest.split(";"):
+        operation = operation.strip()
+        if operation:
+            opcode, _, operand = operation.partition(" ")
+            operations[opcode] = operand.strip().strip('"')
+    return position, operations
+
+
+def init_worker(hash_size_mb):
+    global worker_searcher
+    worker_searcher = chessAI.Searcher(hash_size_mb=hash_size_mb)
+
+
+# Analyses one position, returns its record. limits are the depth, nodes and movetime to search, which the position's
+# own EPD operations override
+def analyse_position(index, line, limits, searcher=None):
+    searcher = worker_searcher if searcher is None else searcher
+    record = {"index": index}
+    try:
+        fen, operations = parse_position(line)
+        bs = engine.BoardState(fen)
+    except (ValueError, IndexError, KeyError):
+        record["error"] = "Invalid position: " + line
+        return record
+    record["fen"] = fen
+    if "id" in operations:
+        record["id"] = operations["id"]
+    limits = dict(limits)
+    for opcode, (limit, convert) in LIMIT_OPERATIONS.items():
+        if opcode in operations:
+            try:
+                limits[limit] = convert(operations[opcode])
+            except ValueError:
+                pass
+    start_time = time.perf_counter()
+    valid_moves = bs.get_valid_moves()
+    if not valid_moves:
+        record.update({"bestmove": None, "score": -chessAI.CHECKMATE if bs.check_mate else chessAI.STALEMATE,
+                       "depth": 0, "pv": [], "nodes": 0, "seconds": 0.0})
+        return record
+    move = searcher.find_best_move(bs, valid_moves, limits.get("movetime"), limits.get("nodes"), limits.get("depth"))
+    if move is None:
+        move = valid_moves[0]
+    pv = [engine.PieceMove.from_move_code(code).get_chess_notation() for _, code in searcher.principal_variation]
+    record.update({"bestmove": move.get_chess_notation(), "san": str(move), "score": searcher.best_score,
+                   "depth": searcher.completed_depth, "pv": pv or [move.get_chess_notation()],
+                   "nodes": searcher.nodes, "qnodes": searcher.qnodes,
+                   "seconds": round(time.perf_counter() - start_time, 4)})
+    if searcher.book_move or searcher.tablebase_move:
+        record["source"] = "book" if searcher.book_move else "tablebase"
+    # Test suites give the best moves, or moves to avoid, in SAN
+    for opcode, wanted in (("bm", True), ("am", False)):
+        if opcode in operations:
+            expected = set()
+            for text in operations[opcode].split():
+                try:
+                    expected.add(bs.parse_move(text))
+                except ValueError:
+                    pass
+            record["solved"] = (move.move_code in expected) == wanted
+    return record
+
+
+# Analyses every position of lines, one FEN or EPD per line, and yields the records in input order. Blank lines and
+# lines starting with # are skipped but keep their place in the count. With one worker the search runs in this
+# process, otherwise only a few positions per worker are in flight at once, so the input is read as it is needed
+def analyse(lines, depth=None, movetime=None, nodes=None, workers=DEFAULT_WORKERS, hash_size_mb=chessAI.HASH_SIZE_MB):
+    limits = {"depth": depth, "movetime": movetime, "nodes": nodes}
+    positions = ((index, line.strip()) for index, line in enumerate(lines)
+                 if line.strip() and not line.lstrip().startswith("#"))
+    if workers <= 1:
+        searcher = chessAI.Searcher(hash_size_mb=hash_size_mb)
+        for index, line in positions:
+            yield analyse_position(index, line, limits, searcher)
+        return
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(hash_size_mb,)) as pool:
+        pending = collections.deque()
+        for index, line in positions:
+            pending.append(pool.submit(analyse_position, index, line, limits))
+            if len(pending) >= workers * QUEUED_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyses FEN or EPD positions, one per line, as JSON lines")
+    parser.add_argument("input", nargs="?", default="-", help="file of positions, - for standard input")
+    parser.add_argument("--depth", type=int, help="depth to search, the engine's default without other limits")
+    parser.add_argument("--movetime", type=float, help="seconds per position")
+    parser.add_argument("--nodes", type=int, help="nodes per position")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes")
+    parser.add_argument("--hash", type=int, default=chessAI.HASH_SIZE_MB, help="transposition table MB per worker")
+    parser.add_argument("--output", help="JSON lines file to write instead of standard output")
+    args = parser.parse_args(argv)
+
+    lines = sys.stdin if args.input == "-" else open(args.input)
+    output = sys.stdout if args.output is None else open(args.output, "w")
+    try:
+        for record in analyse(lines, args.depth, args.movetime, args.nodes, args.workers, args.hash):
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
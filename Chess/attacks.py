@@ -0,0 +1,131 @@
+""" Attack, ray and line tables built once at startup, for the move generators and attack queries in engine.py """
+
+import json
+import sys
+import time
+
+build_start = time.perf_counter()
+
+# Directions as (rank step, file step), rook directions first, then bishop directions
+DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+# Directions that walk towards higher square numbers, their nearest blocker is the lowest set bit
+POSITIVE_DIRECTIONS = (False, False, True, True, False, False, True, True)
+ROOK_DIRECTIONS = (0, 1, 2, 3)
+BISHOP_DIRECTIONS = (4, 5, 6, 7)
+
+
+# Builds a mask of every square reachable from (r, f) by the given steps, walking each step once or to the edge
+def build_step_masks(steps, sliding):
+    masks = []
+    for square in range(64):
+        r, f = divmod(square, 8)
+        per_step = []
+        for step in steps:
+            mask = 0
+            end_rank, end_file = r + step[0], f + step[1]
+            while 0 <= end_rank <= 7 and 0 <= end_file <= 7:
+                mask |= 1 << (end_rank * 8 + end_file)
+                if not sliding:
+                    break
+                end_rank, end_file = end_rank + step[0], end_file + step[1]
+            per_step.append(mask)
+        masks.append(per_step)
+    return masks
+
+
+# RAYS[square][direction] holds every square along a direction from square, excluding square itself
+RAYS = build_step_masks(DIRECTIONS, True)
+KNIGHT_ATTACKS = [sum(masks) for masks in
+                  build_step_masks(((-2, -1), (-2, 1), (2, -1), (2, 1), (-1, -2), (1, -2), (-1, 2), (1, 2)), False)]
+KING_ATTACKS = [sum(masks) for masks in build_step_masks(DIRECTIONS, False)]
+# Squares a pawn of the given color standing on a square attacks
+PAWN_ATTACKS = {'w': [sum(masks) for masks in build_step_masks(((-1, -1), (-1, 1)), False)],
+                'b': [sum(masks) for masks in build_step_masks(((1, -1), (1, 1)), False)]}
+
+
+# BETWEEN[a][b] holds the squares strictly between two squares on a shared rank, file or diagonal, and LINE[a][b]
+# the whole line through both from edge to edge. Both are 0 for squares that don't share a line
+def build_line_tables():
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for a in range(64):
+        for d in range(8):
+            # Directions come in opposite pairs, 0 and 2, 1 and 3, 4 and 7, 5 and 6
+            opposite = (d + 2) % 4 if d < 4 else 11 - d
+            full_line = RAYS[a][d] | RAYS[a][opposite] | (1 << a)
+            ray = RAYS[a][d]
+            while ray:
+                b = (ray & -ray).bit_length() - 1 if POSITIVE_DIRECTIONS[d] else ray.bit_length() - 1
+                between[a][b] = RAYS[a][d] ^ RAYS[b][d] ^ (1 << b)
+                line[a][b] = full_line
+                ray ^= 1 << b
+    return between, line
+
+
+BETWEEN, LINE = build_line_tables()
+BUILD_SECONDS = time.perf_counter() - build_start
+
+
+# Squares attacked from square along the given directions, stopping at (and including) the first occupied square
+def sliding_attacks(square, occupied, directions):
+    attacks = 0
+    rays = RAYS[square]
+    for d in directions:
+        ray = rays[d]
+        blockers = ray & occupied
+        if blockers:
+            if POSITIVE_DIRECTIONS[d]:
+                ray ^= RAYS[(blockers & -blockers).bit_length() - 1][d]
+            else:
+                ray ^= RAYS[blockers.bit_length() - 1][d]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(square, occupied):
+    return sliding_attacks(square, occupied, ROOK_DIRECTIONS)
+
+
+def bishop_attacks(square, occupied):
+    return sliding_attacks(square, occupied, BISHOP_DIRECTIONS)
+
+
+# Nearest occupied square to square along a direction, given the blockers on that ray
+def first_blocker(blockers, d):
+    if POSITIVE_DIRECTIONS[d]:
+        return (blockers & -blockers).bit_length() - 1
+    return blockers.bit_length() - 1
+
+
+# Bytes held by a table, its lists and the ints in them, counting an object shared between entries once
+def table_memory(table, seen=None):
+    if seen is None:
+        seen = set()
+    if id(table) in seen:
+        return 0
+    seen.add(id(table))
+    size = sys.getsizeof(table)
+    if isinstance(table, dict):
+        size += sum(table_memory(value, seen) for value in table.values())
+    elif isinstance(table, (list, tuple)):
+        size += sum(table_memory(value, seen) for value in table)
+    return size
+
+
+# Memory of every table in bytes, with the time taken to build them all
+def table_report():
+    tables = {"RAYS": RAYS, "KNIGHT_ATTACKS": KNIGHT_ATTACKS, "KING_ATTACKS": KING_ATTACKS,
+              "PAWN_ATTACKS": PAWN_ATTACKS, "BETWEEN": BETWEEN, "LINE": LINE}
+    report = {name: table_memory(table) for name, table in tables.items()}
+    report["total_bytes"] = sum(report.values())
+    report["build_seconds"] = round(BUILD_SECONDS, 4)
+    return report
+
+
+def main():
+    print(json.dumps(table_report()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,70 +1,58 @@
 import random
+import time
 import engine
+import instrumentation
+import tablebase
+import transposition
+from evaluation import piece_scores, piece_position_scores
 
 CHECKMATE = 999
 STALEMATE = 0
-piece_scores = {'p': 1, 'R': 5, 'N': 3, 'B': 3, 'Q': 9, 'K': 0}
-knight_scores = [[1, 1, 1, 1, 1, 1, 1, 1],
-                 [1, 2, 2, 2, 2, 2, 2, 1],
-                 [1, 2, 3, 3, 3, 3, 2, 1],
-                 [1, 2, 3, 4, 4, 3, 2, 1],
-                 [1, 2, 3, 4, 4, 3, 2, 1],
-                 [1, 2, 3, 3, 3, 3, 2, 1],
-                 [1, 2, 2, 2, 2, 2, 2, 1],
-                 [1, 1, 1, 1, 1, 1, 1, 1]]
-bishop_scores = [[4, 3, 2, 1, 1, 2, 3, 4],
-                 [3, 4, 3, 2, 2, 3, 4, 3],
-                 [2, 3, 4, 3, 3, 4, 3, 2],
-                 [1, 2, 3, 4, 4, 3, 2, 1],
-                 [1, 2, 4, 4, 4, 3, 2, 1],
-                 [2, 3, 4, 3, 3, 4, 3, 2],
-                 [3, 4, 3, 2, 2, 3, 4, 3],
-                 [4, 3, 2, 1, 1, 2, 3, 4]]
-queen_scores = [[1, 1, 1, 3, 1, 1, 1, 1],
-                [1, 2, 3, 3, 3, 1, 1, 1],
-                [1, 4, 3, 3, 3, 4, 2, 1],
-                [1, 2, 3, 3, 3, 2, 2, 1],
-                [1, 2, 3, 3, 3, 2, 2, 1],
-                [1, 4, 3, 3, 3, 4, 2, 1],
-                [1, 1, 2, 3, 3, 1, 1, 1],
-                [1, 1, 1, 3, 1, 1, 1, 1]]
-rook_scores = [[4, 3, 4, 4, 4, 4, 3, 4],
-               [4, 4, 4, 4, 4, 4, 4, 4],
-               [1, 1, 2, 3, 3, 2, 1, 1],
-               [1, 2, 3, 4, 4, 3, 2, 1],
-               [1, 2, 3, 4, 4, 3, 2, 1],
-               [1, 1, 2, 2, 2, 2, 1, 1],
-               [4, 4, 4, 4, 4, 4, 4, 4],
-               [4, 3, 4, 4, 4, 4, 3, 4]]
-white_pawn_scores = [[9, 9, 9, 9, 9, 9, 9, 9],
-                     [8, 8, 8, 8, 8, 8, 8, 8],
-                     [5, 6, 6, 7, 7, 6, 6, 5],
-                     [2, 3, 3, 5, 5, 3, 3, 2],
-                     [1, 2, 3, 4, 4, 3, 2, 1],
-                     [1, 1, 2, 3, 3, 2, 1, 1],
-                     [1, 1, 1, 0, 0, 1, 1, 1],
-                     [0, 0, 0, 0, 0, 0, 0, 0]]
-
-black_pawn_scores = [[0, 0, 0, 0, 0, 0, 0, 0],
-                     [1, 1, 1, 0, 0, 1, 1, 1],
-                     [1, 1, 2, 3, 3, 2, 1, 1],
-                     [1, 2, 3, 4, 4, 3, 2, 1],
-                     [2, 3, 3, 5, 5, 3, 3, 2],
-                     [5, 6, 6, 7, 7, 6, 6, 5],
-                     [8, 8, 8, 8, 8, 8, 8, 8],
-                     [9, 9, 9, 9, 9, 9, 9, 9]]
-king_scores = [[1, 5, 2, 0, 5, 0, 7, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0],
-               [0, 0, 0, 0, 0, 0, 0, 0],
-               [1, 5, 2, 0, 5, 0, 7, 0]]
-
-piece_position_scores = {"wp": white_pawn_scores, "bp": black_pawn_scores, "R": rook_scores, "N": knight_scores,
-                         "B": bishop_scores, "Q": queen_scores, "K": king_scores}
+# Tablebase wins score just short of checkmate, less a tenth per ply to mate so the search heads for the fastest one
+TABLEBASE_WIN = CHECKMATE - 1
+# Scores from here up are proven wins, mates found by the search or table wins however far the mate is
+PROVEN_WIN = TABLEBASE_WIN - tablebase.MAX_DTM / 10
 DEPTH = 4
+# Deepest iteration a search limited only by time or nodes may reach
+MAX_DEPTH = 64
+# Nodes searched between checks of the clock
+TIME_CHECK_INTERVAL = 256
+# Checks every incremental leaf score against a full scan of the board, slow and only meant for debugging
+DEBUG_EVALUATION = False
+# Memory cap for the transposition table of each searcher
+HASH_SIZE_MB = 32
+# Principal variation search tries every move after the first with a null window just above alpha, and only searches
+# again with the full window if the move turns out better. Scores move in steps of 0.1 so half a step is enough
+PRINCIPAL_VARIATION_SEARCH = True
+NULL_WINDOW = 0.05
+# Each iteration after the first searches this far around the previous score, widening the side that fails four times
+# over until the score falls inside. None searches every iteration with the full window
+ASPIRATION_WINDOW = 0.5
+# Null move pruning lets the opponent move twice in a row, searched this much shallower, and cuts the node off if
+# that still fails high. Only tried from NULL_MOVE_MIN_DEPTH on and with a piece besides pawns on the board for the
+# side to move, since in pawn endings passing may be the one thing that is not allowed
+NULL_MOVE_PRUNING = True
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+# Late move reductions search quiet moves ordered from LATE_MOVE_MIN_INDEX on a ply shallower, and again at full depth
+# if they beat alpha anyway
+LATE_MOVE_REDUCTIONS = True
+LATE_MOVE_REDUCTION = 1
+LATE_MOVE_MIN_DEPTH = 3
+LATE_MOVE_MIN_INDEX = 3
+# Beta cutoffs are counted by the index of the move that caused them, the last count also covers every later index
+CUTOFF_INDEX_BUCKETS = 8
+# Quiescence search also searches every evasion when in check, and skips captures that fall this far short of alpha
+QUIESCENCE_CHECK_EVASIONS = True
+DELTA_MARGIN = 2
+# Piece values used only to rank captures, the king is the most expensive attacker
+piece_order_values = {'p': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 10, '.': 0}
+# The values above indexed by the piece fields of a move code, so ranking a move never decodes it
+moved_order_values = [piece_order_values[piece[1]] for piece in engine.MOVED_PIECES]
+captured_order_values = [piece_order_values[piece[1]] for piece in engine.CAPTURED_PIECES]
+promotion_order_values = [piece_order_values[piece] for piece in engine.PROMOTION_PIECES]
+captured_scores = [piece_scores.get(piece[1], 0) for piece in engine.CAPTURED_PIECES]
+promotion_gains = [piece_scores[piece] - piece_scores['p'] for piece in engine.PROMOTION_PIECES]
 
 
 # Returns random move
@@ -107,90 +95,569 @@ def find_greedy_move(bs, valid_moves):
     return best_player_move
 
 
-# Helper for find best move first recursive call
-def find_best_move(bs, valid_moves):
-    global next_move
-    random.shuffle(valid_moves)
-    next_move = None
-    find_move_nega_max_alpha_beta(bs, valid_moves, DEPTH, -CHECKMATE, CHECKMATE, 1 if bs.white_to_move else -1)
-    return next_move
+# Class for searching for the best move. Each instance owns its limits, tables, statistics and principal variation,
+# so separate instances can search different boards at the same time, on separate threads if need be
+class Searcher:
+    def __init__(self, depth=DEPTH, hash_size_mb=HASH_SIZE_MB, table=None, timing=False,
+                 null_move_pruning=NULL_MOVE_PRUNING, late_move_reductions=LATE_MOVE_REDUCTIONS, book=None,
+                 endgame_tables=None):
+        # Depth searched when no time or node limit is given
+        self.depth = depth
+        # openingbook.OpeningBook played from before searching, None to always search
+        self.book = book
+        # tablebase.Tablebase played from at the root and probed at every node with few enough pieces
+        self.endgame_tables = endgame_tables
+        # Selective search, switched and tuned per searcher so differently configured searchers can play each other
+        self.null_move_pruning = null_move_pruning
+        self.null_move_reduction = NULL_MOVE_REDUCTION
+        self.null_move_min_depth = NULL_MOVE_MIN_DEPTH
+        self.late_move_reductions = late_move_reductions
+        self.late_move_reduction = LATE_MOVE_REDUCTION
+        self.late_move_min_depth = LATE_MOVE_MIN_DEPTH
+        self.late_move_min_index = LATE_MOVE_MIN_INDEX
+        # Splits the search time between move generation, make and undo, and evaluation. The board is wrapped in a
+        # timing proxy for that, so a search without timing runs exactly as it would without instrumentation
+        self.timing = timing
+        self.transposition_table = transposition.TranspositionTable(hash_size_mb) if table is None else table
+        # Flag shared with another thread or process, such as multiprocessing.Value, that stops the search when set,
+        # checked with the clock
+        self.stop_signal = None
+        # Called with the searcher after every completed iteration, so a caller can report the search as it deepens
+        self.iteration_callback = None
+        # State of the running search
+        self.next_move = None
+        self.root_depth = depth
+        self.nodes = 0
+        self.deadline = None
+        self.node_limit = None
+        self.stopped = False
+        # Depth and score, for the side to move, of the last completed iteration
+        self.completed_depth = 0
+        self.best_score = 0
+        # Counters of the last search, see statistics()
+        self.book_move = False
+        self.tablebase_move = False
+        self.tablebase_hits = 0
+        self.seconds = 0.0
+        self.qnodes = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.null_window_searches = 0
+        self.null_window_researches = 0
+        self.aspiration_searches = 0
+        self.aspiration_researches = 0
+        self.null_move_searches = 0
+        self.null_move_cutoffs = 0
+        self.reduced_searches = 0
+        self.reduced_researches = 0
+        self.cutoffs_by_index = []
+        self.iteration_nodes = []
+        self.timings = {}
+        self.evaluate = None
+        # (position key, move code) pairs of the last completed iteration's best line
+        self.principal_variation = []
+        # Triangular principal variation table, pv_table[ply] is the best line found so far from the node at ply
+        self.pv_table = []
+        # Two quiet moves per ply that last caused a beta cutoff, and per piece and end square cutoff history
+        self.killer_moves = []
+        self.history_scores = []
+        # One move list per ply, refilled at every node of that ply instead of allocating a new list each time
+        self.move_buffers = []
+        self.reset_move_ordering()
+
+    # Helper for find best move first recursive call, searches depth 1, 2, 3, ... until a limit is reached
+    # With no limits it searches to self.depth, otherwise it stops on whichever of time_limit (seconds), node_limit
+    # or max_depth comes first and returns the best move of the last completed iteration
+    def find_best_move(self, bs, valid_moves, time_limit=None, node_limit=None, max_depth=None):
+        if max_depth is None:
+            max_depth = self.depth if time_limit is None and node_limit is None else MAX_DEPTH
+        # The search works on packed move codes, the chosen one goes back out as a PieceMove
+        root_moves = [move.move_code for move in valid_moves]
+        random.shuffle(root_moves)
+        start_time = time.perf_counter()
+        self.transposition_table.new_search()
+        self.start_search(time_limit, node_limit)
+        if self.book is not None:
+            move = self.book.choose_move(bs)
+            if move in root_moves:
+                self.book_move = True
+                self.seconds = time.perf_counter() - start_time
+                return engine.PieceMove.from_move_code(move)
+        if self.endgame_tables is not None:
+            move = self.endgame_tables.best_move(bs)
+            if move in root_moves:
+                self.tablebase_move = True
+                self.seconds = time.perf_counter() - start_time
+                return engine.PieceMove.from_move_code(move)
+        board = instrumentation.TimedBoardState(bs, self.timings) if self.timing else bs
+        best_move = None
+        for depth in range(1, max_depth + 1):
+            self.root_depth = depth
+            self.next_move = None
+            score = self.aspiration_search(board, root_moves, depth)
+            if self.stopped:
+                break
+            best_move = self.next_move
+            self.iteration_nodes.append(self.nodes - sum(self.iteration_nodes))
+            self.completed_depth = depth
+            self.best_score = score
+            self.principal_variation = keyed_line(bs, self.pv_line(0))
+            if self.iteration_callback is not None:
+                self.iteration_callback(self)
+            # The next iteration takes several times as long as this one, so don't start one that can't finish
+            if time_limit is not None and time.perf_counter() - start_time > time_limit / 2:
+                break
+            if len(root_moves) <= 1:
+                break
+        self.seconds = time.perf_counter() - start_time
+        if best_move is None:
+            return None
+        return engine.PieceMove.from_move_code(best_move)
+
+    # Resets the limits, counters and move ordering tables for a new search, leaving the transposition table as it is
+    def start_search(self, time_limit=None, node_limit=None):
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+        self.node_limit = node_limit
+        self.nodes = 0
+        self.stopped = False
+        self.principal_variation = []
+        self.completed_depth = 0
+        self.best_score = 0
+        self.book_move = False
+        self.tablebase_move = False
+        self.tablebase_hits = 0
+        self.seconds = 0.0
+        self.qnodes = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.null_window_searches = 0
+        self.null_window_researches = 0
+        self.aspiration_searches = 0
+        self.aspiration_researches = 0
+        self.null_move_searches = 0
+        self.null_move_cutoffs = 0
+        self.reduced_searches = 0
+        self.reduced_researches = 0
+        self.iteration_nodes = []
+        self.timings = {part: 0.0 for part in instrumentation.TIMED_PARTS}
+        self.evaluate = instrumentation.timed_evaluation(score_board, self.timings) if self.timing else score_board
+        self.reset_move_ordering()
+
+    # Searches the root to depth in a window around the previous iteration's score. A score on or outside the window
+    # is only a bound, so the failing side is widened and the root searched again until the score lands inside
+    def aspiration_search(self, bs, root_moves, depth):
+        turn = 1 if bs.white_to_move else -1
+        if ASPIRATION_WINDOW is None or depth == 1 or abs(self.best_score) >= CHECKMATE:
+            return self.find_move_nega_max_alpha_beta(bs, root_moves, depth, -CHECKMATE, CHECKMATE, turn)
+        window = ASPIRATION_WINDOW
+        alpha = max(self.best_score - window, -CHECKMATE)
+        beta = min(self.best_score + window, CHECKMATE)
+        self.aspiration_searches += 1
+        while True:
+            score = self.find_move_nega_max_alpha_beta(bs, root_moves, depth, alpha, beta, turn)
+            if self.stopped:
+                return score
+            if score <= alpha and alpha > -CHECKMATE:
+                window *= 4
+                alpha = max(self.best_score - window, -CHECKMATE)
+            elif score >= beta and beta < CHECKMATE:
+                window *= 4
+                beta = min(self.best_score + window, CHECKMATE)
+            else:
+                return score
+            self.aspiration_researches += 1
+            self.next_move = None
+
+    # Counters of the last search as a JSON ready dict, with the time split when timing is on
+    def statistics(self):
+        cutoffs = sum(self.cutoffs_by_index)
+        stats = {"book": self.book_move, "tablebase": self.tablebase_move, "tablebase_hits": self.tablebase_hits,
+                 "depth": self.completed_depth, "score": self.best_score, "nodes": self.nodes, "qnodes": self.qnodes,
+                 "seconds": round(self.seconds, 4), "nps": int(self.nodes / self.seconds) if self.seconds > 0 else 0,
+                 "tt_probes": self.tt_probes, "tt_hits": self.tt_hits,
+                 "tt_hit_rate": round(self.tt_hits / self.tt_probes, 4) if self.tt_probes else 0.0,
+                 "cutoffs": cutoffs, "cutoffs_by_index": list(self.cutoffs_by_index),
+                 "first_move_cutoff_rate": round(self.first_move_cutoff_rate(), 4),
+                 "null_window_searches": self.null_window_searches,
+                 "null_window_researches": self.null_window_researches,
+                 "null_window_research_rate": research_rate(self.null_window_researches, self.null_window_searches),
+                 "aspiration_searches": self.aspiration_searches,
+                 "aspiration_researches": self.aspiration_researches,
+                 "aspiration_research_rate": research_rate(self.aspiration_researches, self.aspiration_searches),
+                 "null_move_searches": self.null_move_searches, "null_move_cutoffs": self.null_move_cutoffs,
+                 "reduced_searches": self.reduced_searches, "reduced_researches": self.reduced_researches,
+                 "reduced_research_rate": research_rate(self.reduced_researches, self.reduced_searches),
+                 "ebf": instrumentation.effective_branching_factor(self.iteration_nodes),
+                 "iteration_nodes": list(self.iteration_nodes)}
+        if self.timing:
+            times = {part: round(self.timings[part], 4) for part in instrumentation.TIMED_PARTS}
+            times["other"] = round(max(0.0, self.seconds - sum(self.timings.values())), 4)
+            stats["time"] = times
+        return stats
+
+    # Checks the time and node limits of the running search, only from depth 2 on so every search has a move
+    def limit_reached(self):
+        if self.root_depth > 1:
+            if self.node_limit is not None and self.nodes >= self.node_limit:
+                self.stopped = True
+            elif self.nodes % TIME_CHECK_INTERVAL == 0 and \
+                    ((self.deadline is not None and time.perf_counter() >= self.deadline) or
+                     (self.stop_signal is not None and self.stop_signal.value)):
+                self.stopped = True
+        return self.stopped
+
+    # Asks the running search, typically on another thread, to stop at its next node
+    def stop(self):
+        self.stopped = True
+
+    # Depth of the iteration being searched and nodes searched so far, for showing progress while a search runs
+    def progress(self):
+        return self.root_depth, self.nodes
+
+    # The reusable move list for a ply, quiescence search can go deeper than MAX_DEPTH so the lists grow on demand
+    def move_buffer(self, ply):
+        while ply >= len(self.move_buffers):
+            self.move_buffers.append([])
+        return self.move_buffers[ply]
+
+    # The principal variation line for a ply, grown on demand like the move buffers
+    def pv_line(self, ply):
+        while ply >= len(self.pv_table):
+            self.pv_table.append([])
+        return self.pv_table[ply]
+
+    # Searches captures and promotions only until the position is quiet, so the evaluation is never taken in the
+    # middle of an exchange. A side not in check may stand pat on the static score, in check every evasion is searched
+    def quiescence_search(self, bs, alpha, beta, turn, ply=0):
+        self.nodes += 1
+        self.qnodes += 1
+        if self.limit_reached():
+            return 0
+        # In check every evasion is searched, otherwise only the captures, so only one of the two lists is generated
+        if QUIESCENCE_CHECK_EVASIONS and bs.is_in_check():
+            valid_moves = bs.get_valid_move_codes(self.move_buffer(ply))
+            if len(valid_moves) == 0:
+                return -CHECKMATE
+            stand_pat = None
+        else:
+            valid_moves = bs.get_capture_move_codes(self.move_buffer(ply))
+            stand_pat = turn * self.evaluate(bs)
+            if stand_pat >= beta:
+                return stand_pat
+            if stand_pat > alpha:
+                alpha = stand_pat
+        valid_moves.sort(key=capture_order, reverse=True)
+
+        max_score = -CHECKMATE if stand_pat is None else stand_pat
+        for move in valid_moves:
+            # Delta pruning, skip captures that can't lift the score to alpha even with a positional bonus on top
+            if stand_pat is not None:
+                gain = captured_scores[move >> 20]
+                if (move >> 12) & 3 == engine.PROMOTION_MOVE:
+                    gain += promotion_gains[(move >> 14) & 3]
+                if stand_pat + gain + DELTA_MARGIN <= alpha:
+                    continue
+            bs.make_move_code(move)
+            score = -self.quiescence_search(bs, -beta, -alpha, -turn, ply + 1)
+            bs.undo_move()
+            if self.stopped:
+                return 0
+            if score > max_score:
+                max_score = score
+            if max_score > alpha:
+                alpha = max_score
+            if alpha >= beta:
+                break
+        return max_score
+
+    # Sorts moves best first: the hash or principal variation move, captures by most valuable victim then least
+    # valuable attacker, this ply's killer moves, then quiet moves by history score
+    def order_moves(self, valid_moves, ply, hash_move):
+        killers = self.killer_moves[ply] if ply < len(self.killer_moves) else ()
+        history_scores = self.history_scores
 
+        def move_order(move):
+            if move == hash_move:
+                return 3000000
+            if is_tactical(move):
+                return 2000000 + capture_order(move)
+            if move in killers:
+                return 1000000 + (killers.index(move) == 0)
+            return history_scores[(move >> 16) & 15][(move >> 6) & 63]
+
+        valid_moves.sort(key=move_order, reverse=True)
+
+    # Stage ordering of quiet moves for BoardState.generate_moves, this ply's killer moves first, then history score
+    def order_quiet_moves(self, moves, ply):
+        killers = self.killer_moves[ply] if ply < len(self.killer_moves) else ()
+        history_scores = self.history_scores
+
+        def move_order(move):
+            if move in killers:
+                return 1000000 + (killers.index(move) == 0)
+            return history_scores[(move >> 16) & 15][(move >> 6) & 63]
+
+        moves.sort(key=move_order, reverse=True)
+
+    # Records a beta cutoff, a quiet move that caused it becomes a killer for its ply and gains history
+    def record_cutoff(self, move, move_index, ply, depth):
+        self.cutoffs_by_index[min(move_index, CUTOFF_INDEX_BUCKETS - 1)] += 1
+        if is_tactical(move):
+            return
+        killers = self.killer_moves
+        if ply < len(killers) and killers[ply][0] != move:
+            killers[ply][1] = killers[ply][0]
+            killers[ply][0] = move
+        self.history_scores[(move >> 16) & 15][(move >> 6) & 63] += depth * depth
+
+    # Clears the killer moves, history scores and cutoff counts before a new search
+    def reset_move_ordering(self):
+        self.killer_moves = [[None, None] for _ in range(MAX_DEPTH + 1)]
+        self.history_scores = [[0] * 64 for _ in engine.MOVED_PIECES]
+        self.cutoffs_by_index = [0] * CUTOFF_INDEX_BUCKETS
+
+    # Share of beta cutoffs caused by the first move searched, the closer to 1 the better the move ordering
+    def first_move_cutoff_rate(self):
+        cutoffs = sum(self.cutoffs_by_index)
+        if cutoffs == 0:
+            return 0.0
+        return self.cutoffs_by_index[0] / cutoffs
+
+    # Negamax alpha beta search of the node ply moves from the root, the moves after a null move may not pass again
+    def find_move_nega_max_alpha_beta(self, bs, valid_moves, depth, alpha, beta, turn, ply=0, null_move_allowed=True):
+        self.nodes += 1
+        # The line from this node is rebuilt as its moves are searched, a node that returns early has none
+        line = self.pv_line(ply)
+        line.clear()
+        if self.limit_reached():
+            return 0
+        # A position in the tables has its exact result, the root still searches so that next_move gets set
+        if self.endgame_tables is not None and ply != 0:
+            value = self.endgame_tables.probe(bs)
+            if value is not None:
+                self.tablebase_hits += 1
+                return tablebase_score(*value)
+        if depth == 0:
+            # Checkmate and stalemate only need to know whether any move exists, not the whole list
+            if not bs.has_legal_move():
+                return turn * self.evaluate(bs)
+            return self.quiescence_search(bs, alpha, beta, turn, ply)
+
+        # A stored result at least as deep as this search can settle the node or narrow its window,
+        # the root always searches so that next_move gets set
+        hash_move = None
+        entry = self.transposition_table.probe(bs.zobrist_key)
+        self.tt_probes += 1
+        if entry is not None:
+            self.tt_hits += 1
+            key, entry_depth, entry_score, bound, hash_move, age = entry
+            if entry_depth >= depth and ply != 0:
+                if bound == transposition.EXACT:
+                    return entry_score
+                elif bound == transposition.LOWER:
+                    alpha = max(alpha, entry_score)
+                else:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+        # The bound stored for this node is for the window actually searched, after the stored result narrowed it
+        original_alpha = alpha
+        # Reductions are never applied while in check, where every move matters
+        in_check = (self.null_move_pruning or self.late_move_reductions) and bs.is_in_check()
+        if self.null_move_pruning and null_move_allowed and ply != 0 and not in_check and \
+                depth >= self.null_move_min_depth and beta < CHECKMATE and has_non_pawn_material(bs) and \
+                turn * self.evaluate(bs) >= beta:
+            self.null_move_searches += 1
+            bs.make_null_move()
+            score = -self.find_move_nega_max_alpha_beta(bs, None, max(depth - 1 - self.null_move_reduction, 0),
+                                                        -beta, -beta + NULL_WINDOW, -turn, ply + 1, False)
+            bs.undo_null_move()
+            if self.stopped:
+                return 0
+            if score >= beta:
+                self.null_move_cutoffs += 1
+                # A mate or table win found after passing proves nothing about the real moves
+                return beta if score >= PROVEN_WIN else score
+        # While still on the previous iteration's principal variation its move goes ahead of the stored one
+        if ply < len(self.principal_variation) and self.principal_variation[ply][0] == bs.zobrist_key:
+            hash_move = self.principal_variation[ply][1]
+        # The root is given its moves, every other node takes them from the staged generator so that a cutoff on the
+        # hash move or a capture skips generating the quiet moves
+        if valid_moves is None:
+            moves = bs.generate_moves(hash_move, order_captures,
+                                      lambda quiet_moves: self.order_quiet_moves(quiet_moves, ply),
+                                      self.move_buffer(ply))
+        else:
+            self.order_moves(valid_moves, ply, hash_move)
+            moves = valid_moves
+
+        max_score = -CHECKMATE
+        best_move = None
+        move_index = -1
+        killers = self.killer_moves[ply] if ply < len(self.killer_moves) else ()
+        for move_index, move in enumerate(moves):
+            bs.make_move_code(move)
+            if move_index == 0:
+                score = -self.find_move_nega_max_alpha_beta(bs, None, depth - 1, -beta, -alpha, -turn, ply + 1)
+            else:
+                # Later moves only have to be shown no better than alpha, which a null window does more cheaply
+                scout_beta = min(alpha + NULL_WINDOW, beta) if PRINCIPAL_VARIATION_SEARCH else beta
+                reduction = 0
+                if self.late_move_reductions and depth >= self.late_move_min_depth and \
+                        move_index >= self.late_move_min_index and not in_check and not is_tactical(move) and \
+                        move not in killers and not bs.is_in_check():
+                    reduction = self.late_move_reduction
+                    self.reduced_searches += 1
+                if scout_beta < beta:
+                    self.null_window_searches += 1
+                score = -self.find_move_nega_max_alpha_beta(bs, None, depth - 1 - reduction, -scout_beta, -alpha,
+                                                            -turn, ply + 1)
+                if reduction and score > alpha and not self.stopped:
+                    self.reduced_researches += 1
+                    score = -self.find_move_nega_max_alpha_beta(bs, None, depth - 1, -scout_beta, -alpha, -turn,
+                                                                ply + 1)
+                if scout_beta < beta and alpha < score < beta and not self.stopped:
+                    self.null_window_researches += 1
+                    score = -self.find_move_nega_max_alpha_beta(bs, None, depth - 1, -beta, -alpha, -turn, ply + 1)
+            bs.undo_move()
+            # An interrupted search returns a meaningless score, unwind without using or storing it
+            if self.stopped:
+                return 0
+            if score > max_score:
+                max_score = score
+                best_move = move
+                if ply == 0:
+                    self.next_move = move
+                if score > alpha:
+                    alpha = score
+                    # The best line from here is now this move followed by the best line found below it
+                    line.clear()
+                    line.append(move)
+                    line.extend(self.pv_line(ply + 1))
+            if alpha >= beta:
+                self.record_cutoff(move, move_index, ply, depth)
+                break
+        # No move at all, the generator has set checkmate or stalemate
+        if move_index < 0:
+            return turn * self.evaluate(bs)
+
+        if max_score <= original_alpha:
+            bound = transposition.UPPER
+        elif max_score >= beta:
+            bound = transposition.LOWER
+        else:
+            bound = transposition.EXACT
+        self.transposition_table.store(bs.zobrist_key, depth, max_score, bound, best_move)
+        return max_score
 
-# Implements min max algorithm
+
+# The searcher behind the module level functions, used by the game
+default_searcher = Searcher()
+
+
+def find_best_move(bs, valid_moves, time_limit=None, node_limit=None, max_depth=None):
+    return default_searcher.find_best_move(bs, valid_moves, time_limit, node_limit, max_depth)
+
+
+# A tablebase result and distance to mate in plies as a score for the side to move
+def tablebase_score(result, dtm):
+    if result == tablebase.DRAW:
+        return STALEMATE
+    return result * (TABLEBASE_WIN - dtm / 10)
+
+
+# Whether the side to move has a knight, bishop, rook or queen, the guard against null moves in likely zugzwang
+def has_non_pawn_material(bs):
+    bitboards = bs.bitboards
+    color = 'w' if bs.white_to_move else 'b'
+    return bool(bitboards[color + 'N'] | bitboards[color + 'B'] | bitboards[color + 'R'] | bitboards[color + 'Q'])
+
+
+# Share of searches that had to be repeated with a wider window, 0 when there were none
+def research_rate(researches, searches):
+    return round(researches / searches, 4) if searches else 0.0
+
+
+# Most valuable victim first, then least valuable attacker, with promotions counting the piece gained
+def capture_order(move):
+    score = 10 * captured_order_values[move >> 20] - moved_order_values[(move >> 16) & 15]
+    if (move >> 12) & 3 == engine.PROMOTION_MOVE:
+        score += promotion_order_values[(move >> 14) & 3]
+    return score
+
+
+# Captures and promotions, read straight from the captured piece and kind fields of a move code
+def is_tactical(move):
+    return move >> 20 or (move >> 12) & 3 == engine.PROMOTION_MOVE
+
+
+# Stage ordering of captures for BoardState.generate_moves, by most valuable victim then least valuable attacker
+def order_captures(moves):
+    moves.sort(key=capture_order, reverse=True)
+
+
+# Pairs each move of a line played from the current position with the key of the position it is played in
+def keyed_line(bs, moves):
+    line = []
+    for move in moves:
+        line.append((bs.zobrist_key, move))
+        bs.make_move_code(move)
+    for _ in moves:
+        bs.undo_move()
+    return line
+
+
+# Implements min max algorithm, returns the score and the best move for the side to move
 def find_best_move_min_max(bs, valid_moves, depth, white_to_move):
-    global next_move
     if depth == 0:
-        return material_score(bs.board)
+        return material_score(bs.board), None
+    best_move = None
     if white_to_move:
         max_score = -CHECKMATE
         for move in valid_moves:
             bs.make_move(move)
             next_moves = bs.get_valid_moves()
-            score = find_move_nega_max(bs, next_moves, depth - 1, False)
+            score, _ = find_best_move_min_max(bs, next_moves, depth - 1, False)
             if score > max_score:
                 max_score = score
-                if depth == DEPTH:
-                    next_move = move
+                best_move = move
             bs.undo_move()
-        return max_score
+        return max_score, best_move
     else:
         min_score = CHECKMATE
         for move in valid_moves:
             bs.make_move(move)
             next_moves = bs.get_valid_moves()
-            score = find_move_nega_max(bs, next_moves, depth - 1, True)
+            score, _ = find_best_move_min_max(bs, next_moves, depth - 1, True)
             if score < min_score:
                 min_score = score
-                if depth == DEPTH:
-                    next_move = move
+                best_move = move
             bs.undo_move()
-        return min_score
+        return min_score, best_move
 
 
+# Plain negamax, returns the score and the best move for the side to move
 def find_move_nega_max(bs, valid_moves, depth, turn):
-    global next_move
-    if depth == 0:
-        return turn * score_board(bs)
-    max_score = -CHECKMATE
-    for move in valid_moves:
-        bs.make_move(move)
-        next_moves = bs.get_valid_moves()
-        score = -find_move_nega_max(bs, next_moves, depth - 1, -turn)
-        if score > max_score:
-            max_score = score
-            if depth == DEPTH:
-                next_move = move
-        bs.undo_move()
-    return max_score
-
-
-def find_move_nega_max_alpha_beta(bs, valid_moves, depth, alpha, beta, turn):
-    global next_move
     if depth == 0:
-        return turn * score_board(bs)
-
+        return turn * score_board(bs), None
     max_score = -CHECKMATE
+    best_move = None
     for move in valid_moves:
         bs.make_move(move)
         next_moves = bs.get_valid_moves()
-        score = -find_move_nega_max_alpha_beta(bs, next_moves, depth - 1, -beta, -alpha, -turn)
+        score = -find_move_nega_max(bs, next_moves, depth - 1, -turn)[0]
         if score > max_score:
             max_score = score
-            if depth == DEPTH:
-                next_move = move
+            best_move = move
         bs.undo_move()
-        if max_score > alpha:
-            alpha = max_score
-        if alpha >= beta:
-            break
-    return max_score
+    return max_score, best_move
 
 
 # Helpers
 
 # More intuitive scoring method, positive is good for white
+# The material and position score is kept up to date by BoardState.make_move, so this is a constant time read
 def score_board(bs):
-    global piece_position_score
     if bs.check_mate:
         if bs.white_to_move:
             return -CHECKMATE
@@ -198,19 +665,26 @@ def score_board(bs):
             return CHECKMATE
     elif bs.stale_mate:
         return STALEMATE
+    if DEBUG_EVALUATION:
+        assert bs.eval_score == bs.compute_eval_score() and abs(bs.eval_score / 10 - score_board_full(bs)) < 1e-9
+    return bs.eval_score / 10
+
 
+# Scores the board by scanning every square, only used to cross-check the incremental score
+def score_board_full(bs):
     score = 0
     for rank in range(len(bs.board)):
         for file in range(len(bs.board[rank])):
             square = bs.board[rank][file]
-            if square != "..":
-                if square[1] == "p":
-                    piece_position_score = piece_position_scores[square][rank][file]
-                else:
-                    piece_position_score = piece_position_scores[square[1]][rank][file]
+            if square == "..":
+                continue
+            if square[1] == "p":
+                piece_position_score = piece_position_scores[square][rank][file]
+            else:
+                piece_position_score = piece_position_scores[square[1]][rank][file]
             if square[0] == 'w':
                 score += piece_scores[square[1]] + piece_position_score * .1
-            elif square[0] == 'b':
+            else:
                 score -= piece_scores[square[1]] + piece_position_score * .1
 
     return score
@@ -1,7 +1,12 @@
 """ Handles user input and displaying game state at given time """
 
+import threading
+
 import pygame as game
 import chessAI
+import instrumentation
+import openingbook
+import tablebase
 
 from Chess import engine
 
@@ -12,6 +17,14 @@ MOVE_LOG_PANEL_HEIGHT = BOARD_HEIGHT
 DIMENSION = 8
 SQUARE_SIZE = BOARD_WIDTH // DIMENSION
 MAX_FPS = 15
+# JSON lines file the AI's search statistics are appended to, one line per move and a summary line per game,
+# None to keep them in memory only. SEARCH_TIMING also splits each search's time by part, at some cost in speed
+STATS_FILE = None
+SEARCH_TIMING = False
+# Opening book file built with openingbook.py, which the AI plays from while the game is in book
+BOOK_FILE = None
+# Directory of endgame tables generated with tablebase.py, which the AI plays perfectly from
+TABLEBASE_DIR = None
 
 """ 
 Load in Images into Dictionary 
@@ -55,11 +68,21 @@ def run_game():
     move_made = False
     animate = False
     game_over = False
+    # Searcher kept for the whole game so its transposition table carries over between moves, and the search running
+    # for the AI's move, None while it is not the AI's turn
+    book = None if BOOK_FILE is None else openingbook.OpeningBook(BOOK_FILE)
+    endgame_tables = None if TABLEBASE_DIR is None else tablebase.Tablebase(TABLEBASE_DIR)
+    searcher = chessAI.Searcher(timing=SEARCH_TIMING, book=book, endgame_tables=endgame_tables)
+    ai_search = None
+    game_stats = instrumentation.GameStats()
     while playing:
         is_human_turn = (bs.white_to_move and player_one) or (not bs.white_to_move and player_two)
         for event in game.event.get():
             if event.type == game.QUIT:
                 playing = False
+                if ai_search is not None:
+                    ai_search.cancel()
+                write_game_stats(game_stats)
             # handle mouse clicks
             elif event.type == game.MOUSEBUTTONDOWN:
                 if not game_over and is_human_turn:
@@ -88,12 +111,18 @@ def run_game():
                             player_mouse_clicks = [selected]
             # Deal with key down presses, including undo and new game functionality
             elif event.type == game.KEYDOWN:
+                # A search for a position that is about to change is abandoned
+                if event.key in (game.K_u, game.K_n) and ai_search is not None:
+                    ai_search.cancel()
+                    ai_search = None
                 if event.key == game.K_u:
                     bs.undo_move()
                     move_made = True
                     animate = False
                     game_over = False
                 if event.key == game.K_n:
+                    write_game_stats(game_stats)
+                    game_stats = instrumentation.GameStats()
                     bs = engine.BoardState()
                     possible_moves = bs.get_valid_moves()
                     selected = ()
@@ -102,23 +131,33 @@ def run_game():
                     animate = False
                     game_over = False
 
-        # AI Move Call
-        if not game_over and not is_human_turn:
+        # AI Move Call, the best move search runs in the background and is polled once per frame
+        if not game_over and not is_human_turn and playing:
             if best_ai:
-                ai_move = chessAI.find_best_move(bs, possible_moves)
-                if ai_move is None:
-                    ai_move = chessAI.find_random_moves(possible_moves)
-                print(ai_move)
-                bs.make_move(ai_move)
+                if ai_search is None:
+                    ai_search = AISearch(bs, searcher)
+                elif ai_search.is_done():
+                    ai_move = ai_search.move
+                    ai_search = None
+                    if ai_move is None:
+                        ai_move = chessAI.find_random_moves(possible_moves)
+                    print(ai_move)
+                    game_stats.add(dict(searcher.statistics(), move=str(ai_move)))
+                    if STATS_FILE is not None:
+                        instrumentation.write_json_lines(STATS_FILE, game_stats.moves[-1:])
+                    bs.make_move(ai_move)
+                    move_made = True
+                    animate = True
             elif greedy_ai:
                 ai_move = chessAI.find_greedy_move(bs, possible_moves)
                 bs.make_move(ai_move)
+                move_made = True
+                animate = True
             elif random_ai:
                 ai_move = chessAI.find_random_moves(possible_moves)
                 bs.make_move(ai_move)
-
-            move_made = True
-            animate = True
+                move_made = True
+                animate = True
 
         # Animating the move if a move was made
         if move_made:
@@ -130,11 +169,51 @@ def run_game():
 
         # Handles final drawing of board and end game functionality
         draw_game(bs, screen, possible_moves, selected, move_log_font)
+        if ai_search is not None:
+            draw_thinking(screen, searcher, move_log_font)
         draw_checkmate_and_stalemate(screen, bs)
         game_over = draw_checkmate_and_stalemate(screen, bs)
 
         clock.tick(MAX_FPS)
         game.display.flip()
+    if book is not None:
+        book.close()
+    if endgame_tables is not None:
+        endgame_tables.close()
+
+
+# Appends the summary of a game's searches to the statistics file, the per move lines are already written
+def write_game_stats(game_stats):
+    if STATS_FILE is not None and game_stats.moves:
+        instrumentation.write_json_lines(STATS_FILE, [game_stats.summary()])
+
+
+"""
+Runs the AI search in the background
+"""
+
+
+# Searches a copy of the board state on a thread, so the window keeps drawing and handling events while it runs
+# The copy is made from a snapshot, since the search doesn't need the game's move history
+class AISearch:
+    def __init__(self, bs, searcher):
+        self.board_state = engine.BoardState.from_snapshot(bs.snapshot())
+        self.searcher = searcher
+        self.move = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        self.move = self.searcher.find_best_move(self.board_state, self.board_state.get_valid_moves())
+
+    def is_done(self):
+        return not self.thread.is_alive()
+
+    # Stops the search and waits for the thread, asking again in case the search had not started when first asked
+    def cancel(self):
+        while self.thread.is_alive():
+            self.searcher.stop()
+            self.thread.join(0.01)
 
 
 """
@@ -195,6 +274,13 @@ def draw_move_log(screen, bs, font):
         screen.blit(text_object, text_location.move(padding, text_dy))
         text_dy += text_object.get_height() + line_spacing
 
+# Shows the depth and node count of the running AI search at the bottom of the move log
+def draw_thinking(screen, searcher, font):
+    depth, nodes = searcher.progress()
+    text_object = font.render("Thinking... depth " + str(depth) + ", " + str(nodes) + " nodes", True,
+                              game.Color("Dark Blue"))
+    screen.blit(text_object, (BOARD_WIDTH + 5, MOVE_LOG_PANEL_HEIGHT - text_object.get_height() - 5))
+
 # Draw text at the end of the game, for stalemate or checkmate
 def draw_end_game_text(screen, text):
     font = game.font.SysFont("Times New Roman", 32, True, False)
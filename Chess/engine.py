@@ -1,10 +1,100 @@
 """ Handles storing information on game state, logs moves, determines valid moves """
 
+import random
+import re
+import struct
+
+from attacks import BETWEEN, KING_ATTACKS, KNIGHT_ATTACKS, LINE, PAWN_ATTACKS, RAYS, bishop_attacks, first_blocker, \
+    rook_attacks
+from evaluation import PIECE_SQUARE_VALUES
+
+# Squares are numbered rank * 8 + file so that bit n of a bitboard is board[n // 8][n % 8], a8 is bit 0 and h1 is bit 63
+ALL_SQUARES = (1 << 64) - 1
+FILE_A = 0x0101010101010101
+FILE_H = FILE_A << 7
+NOT_FILE_A = ALL_SQUARES ^ FILE_A
+NOT_FILE_H = ALL_SQUARES ^ FILE_H
+ROWS = [0xFF << (8 * r) for r in range(8)]
+PIECES = ("wp", "wR", "wN", "wB", "wQ", "wK", "bp", "bR", "bN", "bB", "bQ", "bK")
+# Pieces a pawn can promote to, queen first so it is the move found when only the squares are known
+PROMOTION_PIECES = ('Q', 'R', 'B', 'N')
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+# Byte form of a snapshot, the twelve bitboards in PIECES order, the side to move, the castling rights and the en
+# passant square, NO_SQUARE when there is none
+SNAPSHOT = struct.Struct("<12QBBB")
+NO_SQUARE = 0xFF
+# Standard algebraic notation once check marks and annotations are stripped: piece, origin file and rank where needed
+# to tell two pieces apart, destination square and promotion piece
+SAN_PATTERN = re.compile(r"([KQRBN])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([QRBN]))?")
+
+# Moves are packed into ints so generating, storing and comparing them creates no objects: the start square is in
+# bits 0-5, the end square in bits 6-11, the kind of move in bits 12-13, the promotion piece's index in
+# PROMOTION_PIECES in bits 14-15, the moved piece's index in PIECES in bits 16-19 and the captured piece's index plus
+# one in bits 20-23, zero when nothing is captured
+NORMAL_MOVE = 0
+EN_PASSANT_MOVE = 1
+CASTLE_MOVE = 2
+PROMOTION_MOVE = 3
+# Decoding tables, a move started from an empty square (a click on nothing) decodes its piece as ".."
+MOVED_PIECES = PIECES + ("..", "..", "..", "..")
+CAPTURED_PIECES = ("..",) + PIECES
+# Encoding tables, giving the bits each piece string adds to a move
+MOVED_CODES = {piece: i << 16 for i, piece in enumerate(MOVED_PIECES)}
+CAPTURED_CODES = {piece: i << 20 for i, piece in enumerate(CAPTURED_PIECES)}
+PROMOTION_CODES = tuple(PROMOTION_MOVE << 12 | i << 14 for i in range(len(PROMOTION_PIECES)))
+
+# Castling rights as bits of one int, in the order of CastleRights.index()
+WHITE_KING_SIDE = 1
+BLACK_KING_SIDE = 2
+WHITE_QUEEN_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+# Rights kept by a move starting or ending on each square, moving a king or rook or capturing a rook loses them
+CASTLING_MASKS = [15] * 64
+CASTLING_MASKS[0] = 15 ^ BLACK_QUEEN_SIDE
+CASTLING_MASKS[4] = 15 ^ BLACK_KING_SIDE ^ BLACK_QUEEN_SIDE
+CASTLING_MASKS[7] = 15 ^ BLACK_KING_SIDE
+CASTLING_MASKS[56] = 15 ^ WHITE_QUEEN_SIDE
+CASTLING_MASKS[60] = 15 ^ WHITE_KING_SIDE ^ WHITE_QUEEN_SIDE
+CASTLING_MASKS[63] = 15 ^ WHITE_KING_SIDE
+
+
+def move_piece(move):
+    return MOVED_PIECES[(move >> 16) & 15]
+
+
+def move_captured(move):
+    return CAPTURED_PIECES[move >> 20]
+
+
+# The piece letter a move promotes to, or None when it is not a promotion
+def move_promotion(move):
+    if (move >> 12) & 3 == PROMOTION_MOVE:
+        return PROMOTION_PIECES[(move >> 14) & 3]
+    return None
+
+
+# Zobrist keys, drawn from a fixed seed so a position hashes the same in every run and process
+zobrist_random = random.Random(20210607)
+ZOBRIST_PIECES = {piece: [zobrist_random.getrandbits(64) for _ in range(64)] for piece in PIECES}
+ZOBRIST_BLACK_TO_MOVE = zobrist_random.getrandbits(64)
+# Indexed by CastleRights.index(), one key per combination of the four rights
+ZOBRIST_CASTLING = [zobrist_random.getrandbits(64) for _ in range(16)]
+ZOBRIST_ENPASSANT_FILE = [zobrist_random.getrandbits(64) for _ in range(8)]
+
+
+# Yields the square of every set bit, lowest first
+def squares_of(bitboard):
+    while bitboard:
+        low_bit = bitboard & -bitboard
+        yield low_bit.bit_length() - 1
+        bitboard ^= low_bit
+
 
 # Class Defining Board State
 class BoardState:
-    def __init__(self):
+    def __init__(self, fen=None):
         # bR = black rook, rest follow same formatting, ".." signifies empty space
+        # The board list is a view kept in step with the bitboards, which drive move generation
         self.board = [
             ["bR", "bN", "bB", "bQ", "bK", "bB", "bN", "bR"],
             ["bp", "bp", "bp", "bp", "bp", "bp", "bp", "bp"],
@@ -14,179 +104,451 @@ class BoardState:
             ["..", "..", "..", "..", "..", "..", "..", ".."],
             ["wp", "wp", "wp", "wp", "wp", "wp", "wp", "wp"],
             ["wR", "wN", "wB", "wQ", "wK", "wB", "wN", "wR"]]
-        self.move_dictionary = {'p': self.get_pawn_moves, 'R': self.get_rook_moves, 'N': self.get_knight_moves,
-                                'B': self.get_bishop_moves, 'Q': self.get_queen_moves, 'K': self.get_king_moves}
-        self.log = []
+        self.bitboards = {}
+        self.occupancy = {}
+        self.occupied = 0
+        self.load_bitboards()
+        # Moves played, as packed move codes
+        self.move_log = []
         self.white_to_move = True
         self.in_check = False
         self.white_king = (7, 4)
         self.black_king = (0, 4)
-        self.pins = []
+        self.pins = {}
         self.checks = []
         self.check_mate = False
         self.stale_mate = False
         self.enpassant_move = ()
-        self.current_castling_right = CastleRights(True, True, True, True)
-        self.castle_rights_log = [CastleRights(self.current_castling_right.wks, self.current_castling_right.bks,
-                                               self.current_castling_right.wqs, self.current_castling_right.bqs)]
+        self.enpassant_log = [self.enpassant_move]
+        self.castling_rights = WHITE_KING_SIDE | BLACK_KING_SIDE | WHITE_QUEEN_SIDE | BLACK_QUEEN_SIDE
+        self.castle_rights_log = [self.castling_rights]
+        # Position key, updated move by move, with one entry per position in the log so undo can restore it directly
+        self.zobrist_key = self.compute_zobrist_key()
+        self.zobrist_log = [self.zobrist_key]
+        # Material and piece-square score in tenths of a pawn from white's side, kept up to date the same way
+        self.eval_score = self.compute_eval_score()
+        self.eval_log = [self.eval_score]
+        # Half move clock and full move number of the position the move log starts from, for to_fen
+        self.start_counters = (0, 1)
+        if fen is not None:
+            self.load_fen(fen)
+
+    # Sets up the position described by a FEN string, clearing the move history
+    def load_fen(self, fen):
+        fields = fen.split()
+        rows = fields[0].split('/')
+        if len(fields) < 4 or len(rows) != 8:
+            raise ValueError("Invalid FEN: " + fen)
+        self.board = []
+        for r, row in enumerate(rows):
+            board_row = []
+            for symbol in row:
+                if symbol.isdigit():
+                    board_row.extend([".."] * int(symbol))
+                elif symbol.upper() in "PRNBQK":
+                    color = 'w' if symbol.isupper() else 'b'
+                    piece = 'p' if symbol.upper() == 'P' else symbol.upper()
+                    if piece == 'K':
+                        if color == 'w':
+                            self.white_king = (r, len(board_row))
+                        else:
+                            self.black_king = (r, len(board_row))
+                    board_row.append(color + piece)
+                else:
+                    raise ValueError("Invalid FEN: " + fen)
+            if len(board_row) != 8:
+                raise ValueError("Invalid FEN: " + fen)
+            self.board.append(board_row)
+        self.load_bitboards()
+        if bin(self.bitboards['wK']).count("1") != 1 or bin(self.bitboards['bK']).count("1") != 1:
+            raise ValueError("Invalid FEN, each side needs one king: " + fen)
+        self.white_to_move = fields[1] == 'w'
+        # A right is only kept while its king and rook are still on their home squares
+        castling = fields[2]
+        board = self.board
+        white_king_home = board[7][4] == "wK"
+        black_king_home = board[0][4] == "bK"
+        self.castling_rights = CastleRights('K' in castling and white_king_home and board[7][7] == "wR",
+                                            'k' in castling and black_king_home and board[0][7] == "bR",
+                                            'Q' in castling and white_king_home and board[7][0] == "wR",
+                                            'q' in castling and black_king_home and board[0][0] == "bR").index()
+        if fields[3] == '-':
+            self.enpassant_move = ()
+        else:
+            self.enpassant_move = (PieceMove.ranks_to_rows[fields[3][1]], PieceMove.files_to_cols[fields[3][0]])
+        self.clear_history()
+        if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+            self.start_counters = (int(fields[4]), max(1, int(fields[5])))
+
+    # The position as a FEN string. The half move clock counts back through the move log to the last capture or pawn
+    # move, and before the start of the log goes on from the counters the position was loaded with
+    def to_fen(self):
+        rows = []
+        for row in self.board:
+            text = ""
+            empty = 0
+            for piece in row:
+                if piece == "..":
+                    empty += 1
+                    continue
+                if empty:
+                    text += str(empty)
+                    empty = 0
+                letter = 'P' if piece[1] == 'p' else piece[1]
+                text += letter if piece[0] == 'w' else letter.lower()
+            rows.append(text + (str(empty) if empty else ""))
+        castling = "".join(letter for letter, right in (("K", WHITE_KING_SIDE), ("Q", WHITE_QUEEN_SIDE),
+                                                       ("k", BLACK_KING_SIDE), ("q", BLACK_QUEEN_SIDE))
+                           if self.castling_rights & right)
+        if self.enpassant_move:
+            enpassant_rank, enpassant_file = self.enpassant_move
+            enpassant = PieceMove.cols_to_files[enpassant_file] + PieceMove.rows_to_ranks[enpassant_rank]
+        else:
+            enpassant = "-"
+        start_clock, start_move = self.start_counters
+        clock = start_clock + len(self.move_log)
+        for plies, move in enumerate(reversed(self.move_log)):
+            if MOVED_PIECES[(move >> 16) & 15][1] == 'p' or move >> 20:
+                clock = plies
+                break
+        # Black moving first in the log moves the move number on one ply sooner
+        started_black = self.white_to_move == (len(self.move_log) % 2 == 1)
+        move_number = start_move + (len(self.move_log) + started_black) // 2
+        return " ".join(("/".join(rows), "w" if self.white_to_move else "b", castling or "-", enpassant, str(clock),
+                         str(move_number)))
+
+    # Compact copy of the position without its history, a tuple of ints that is cheap to send to another process
+    def snapshot(self):
+        return (tuple(self.bitboards[piece] for piece in PIECES), self.white_to_move, self.castling_rights,
+                self.enpassant_move)
+
+    # The snapshot packed into a fixed SNAPSHOT.size bytes, for storing positions in files or as compact keys
+    def snapshot_bytes(self):
+        if self.enpassant_move:
+            enpassant = self.enpassant_move[0] * 8 + self.enpassant_move[1]
+        else:
+            enpassant = NO_SQUARE
+        return SNAPSHOT.pack(*(self.bitboards[piece] for piece in PIECES), self.white_to_move, self.castling_rights,
+                             enpassant)
+
+    # Sets up the position saved by snapshot() or snapshot_bytes(), clearing the move history
+    def load_snapshot(self, snapshot):
+        if isinstance(snapshot, (bytes, bytearray, memoryview)):
+            fields = SNAPSHOT.unpack(snapshot)
+            enpassant = fields[14]
+            snapshot = (fields[:12], bool(fields[12]), fields[13],
+                        () if enpassant == NO_SQUARE else divmod(enpassant, 8))
+        bitboards, self.white_to_move, self.castling_rights, self.enpassant_move = snapshot
+        # The board list, key and score are filled in from the bitboards in one pass over the pieces
+        self.bitboards = dict(zip(PIECES, bitboards))
+        self.board = board = [[".."] * 8 for _ in range(8)]
+        key = 0
+        score = 0
+        for piece, bitboard in zip(PIECES, bitboards):
+            piece_keys = ZOBRIST_PIECES[piece]
+            piece_values = PIECE_SQUARE_VALUES[piece]
+            for square in squares_of(bitboard):
+                board[square >> 3][square & 7] = piece
+                key ^= piece_keys[square]
+                score += piece_values[square]
+        white = bitboards[0] | bitboards[1] | bitboards[2] | bitboards[3] | bitboards[4] | bitboards[5]
+        black = bitboards[6] | bitboards[7] | bitboards[8] | bitboards[9] | bitboards[10] | bitboards[11]
+        self.occupancy = {'w': white, 'b': black}
+        self.occupied = white | black
+        self.white_king = divmod(self.bitboards['wK'].bit_length() - 1, 8) if self.bitboards['wK'] else (7, 4)
+        self.black_king = divmod(self.bitboards['bK'].bit_length() - 1, 8) if self.bitboards['bK'] else (0, 4)
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        self.clear_history(key ^ self.get_enpassant_zobrist(), score)
+
+    # A board for a snapshot. It is set up from the snapshot alone, without first building the start position
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        bs = cls.__new__(cls)
+        bs.load_snapshot(snapshot)
+        return bs
+
+    # Makes the current position the start of the history, after it was set up from a FEN string or snapshot
+    # The key and score are computed from scratch unless the caller already has them
+    def clear_history(self, zobrist_key=None, eval_score=None):
+        self.start_counters = (0, 1)
+        self.castle_rights_log = [self.castling_rights]
+        self.enpassant_log = [self.enpassant_move]
+        self.move_log = []
+        self.in_check = False
+        self.pins = {}
+        self.checks = []
+        self.check_mate = False
+        self.stale_mate = False
+        self.zobrist_key = self.compute_zobrist_key() if zobrist_key is None else zobrist_key
+        self.zobrist_log = [self.zobrist_key]
+        self.eval_score = self.compute_eval_score() if eval_score is None else eval_score
+        self.eval_log = [self.eval_score]
+
+    # Scores the whole position from scratch, make_move keeps eval_score equal to this incrementally
+    def compute_eval_score(self):
+        score = 0
+        for piece in PIECES:
+            for square in squares_of(self.bitboards[piece]):
+                score += PIECE_SQUARE_VALUES[piece][square]
+        return score
+
+    # Hashes the whole position from scratch, make_move keeps zobrist_key equal to this incrementally
+    def compute_zobrist_key(self):
+        key = 0
+        for piece in PIECES:
+            for square in squares_of(self.bitboards[piece]):
+                key ^= ZOBRIST_PIECES[piece][square]
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        return key ^ self.get_enpassant_zobrist()
+
+    # The en passant file only changes the key when a pawn of the side to move can actually make the capture,
+    # otherwise positions that are identical for play would hash differently
+    def get_enpassant_zobrist(self):
+        if self.enpassant_move == ():
+            return 0
+        target = self.enpassant_move[0] * 8 + self.enpassant_move[1]
+        if self.white_to_move:
+            capturers = PAWN_ATTACKS['b'][target] & self.bitboards['wp']
+        else:
+            capturers = PAWN_ATTACKS['w'][target] & self.bitboards['bp']
+        return ZOBRIST_ENPASSANT_FILE[self.enpassant_move[1]] if capturers else 0
+
+    # Rebuilds every bitboard and occupancy mask from the board list
+    def load_bitboards(self):
+        self.bitboards = {piece: 0 for piece in PIECES}
+        for r in range(8):
+            for f in range(8):
+                piece = self.board[r][f]
+                if piece != "..":
+                    self.bitboards[piece] |= 1 << (r * 8 + f)
+        self.occupancy = {'w': 0, 'b': 0}
+        for piece in PIECES:
+            self.occupancy[piece[0]] |= self.bitboards[piece]
+        self.occupied = self.occupancy['w'] | self.occupancy['b']
+
+    # Toggles a piece on or off a square in its bitboard and its color's occupancy
+    def toggle_piece(self, piece, square_bits):
+        self.bitboards[piece] ^= square_bits
+        self.occupancy[piece[0]] ^= square_bits
+
+    # Moves played so far as PieceMove objects, built when asked for since the board itself only keeps move codes
+    @property
+    def log(self):
+        return [PieceMove.from_move_code(move) for move in self.move_log]
+
+    @property
+    def current_castling_right(self):
+        return CastleRights.from_index(self.castling_rights)
 
     # Updates board state based on move made
     def make_move(self, piecemove):
-        self.board[piecemove.start_rank][piecemove.start_file] = ".."
-        self.board[piecemove.end_rank][piecemove.end_file] = piecemove.piece_moved
-        self.log.append(piecemove)
+        self.make_move_code(piecemove.move_code)
+
+    # Plays a packed move code, the search calls this directly so no PieceMove is ever built
+    def make_move_code(self, move):
+        start = move & 63
+        end = (move >> 6) & 63
+        kind = (move >> 12) & 3
+        piece_moved = MOVED_PIECES[(move >> 16) & 15]
+        piece_captured = CAPTURED_PIECES[move >> 20]
+        start_bit = 1 << start
+        end_bit = 1 << end
+        color = piece_moved[0]
+        board = self.board
+        key = self.zobrist_key ^ self.get_enpassant_zobrist() ^ ZOBRIST_CASTLING[self.castling_rights]
+        key ^= ZOBRIST_PIECES[piece_moved][start] ^ ZOBRIST_PIECES[piece_moved][end]
+        score = self.eval_score - PIECE_SQUARE_VALUES[piece_moved][start] + PIECE_SQUARE_VALUES[piece_moved][end]
+        self.toggle_piece(piece_moved, start_bit | end_bit)
+        board[start >> 3][start & 7] = ".."
+        board[end >> 3][end & 7] = piece_moved
+        self.move_log.append(move)
         self.white_to_move = not self.white_to_move
-        if piecemove.piece_moved == "wK":
-            self.white_king = (piecemove.end_rank, piecemove.end_file)
-        elif piecemove.piece_moved == "bK":
-            self.black_king = (piecemove.end_rank, piecemove.end_file)
+        if piece_moved == "wK":
+            self.white_king = (end >> 3, end & 7)
+        elif piece_moved == "bK":
+            self.black_king = (end >> 3, end & 7)
 
-        # Pawn promotion
-        if piecemove.is_pawn_promotion:
-            self.board[piecemove.end_rank][piecemove.end_file] = piecemove.piece_moved[0] + 'Q'
+        # Enpassant captures the pawn beside the start square rather than on the end square
+        if kind == EN_PASSANT_MOVE:
+            captured = (start & 56) | (end & 7)
+            self.toggle_piece(piece_captured, 1 << captured)
+            key ^= ZOBRIST_PIECES[piece_captured][captured]
+            score -= PIECE_SQUARE_VALUES[piece_captured][captured]
+            board[start >> 3][end & 7] = '..'
+        elif piece_captured != "..":
+            self.toggle_piece(piece_captured, end_bit)
+            key ^= ZOBRIST_PIECES[piece_captured][end]
+            score -= PIECE_SQUARE_VALUES[piece_captured][end]
 
-        # Enpassant
-        if piecemove.is_en_passant:
-            self.board[piecemove.start_rank][piecemove.end_file] = '..'
+        # Pawn promotion
+        if kind == PROMOTION_MOVE:
+            promoted = color + PROMOTION_PIECES[(move >> 14) & 3]
+            self.toggle_piece(piece_moved, end_bit)
+            self.toggle_piece(promoted, end_bit)
+            key ^= ZOBRIST_PIECES[piece_moved][end] ^ ZOBRIST_PIECES[promoted][end]
+            score += PIECE_SQUARE_VALUES[promoted][end] - PIECE_SQUARE_VALUES[piece_moved][end]
+            board[end >> 3][end & 7] = promoted
 
-        if piecemove.piece_moved[1] == 'p' and abs(piecemove.start_rank - piecemove.end_rank) == 2:
-            self.enpassant_move = ((piecemove.start_rank + piecemove.end_rank) // 2, piecemove.start_file)
+        if piece_moved[1] == 'p' and (start - end == 16 or end - start == 16):
+            self.enpassant_move = ((start + end) >> 4, start & 7)
         else:
             self.enpassant_move = ()
+        self.enpassant_log.append(self.enpassant_move)
 
         # Castling Rights
-        self.update_castle_rights(piecemove)
-        self.castle_rights_log.append(CastleRights(self.current_castling_right.wks, self.current_castling_right.bks,
-                                                   self.current_castling_right.wqs, self.current_castling_right.bqs))
-
-        if piecemove.is_castle_move:
-            if piecemove.end_file - piecemove.start_file == 2:  # Kingside castle
-                self.board[piecemove.end_rank][piecemove.end_file - 1] = self.board[piecemove.end_rank][
-                    piecemove.end_file + 1]
-                self.board[piecemove.end_rank][piecemove.end_file + 1] = ".."
+        self.castling_rights &= CASTLING_MASKS[start] & CASTLING_MASKS[end]
+        self.castle_rights_log.append(self.castling_rights)
+
+        if kind == CASTLE_MOVE:
+            if end > start:  # Kingside castle
+                rook_from, rook_to = end + 1, end - 1
             else:
-                self.board[piecemove.end_rank][piecemove.end_file + 1] = self.board[piecemove.end_rank][
-                    piecemove.end_file - 2]
-                self.board[piecemove.end_rank][piecemove.end_file - 2] = ".."
+                rook_from, rook_to = end - 2, end + 1
+            rook = color + 'R'
+            self.toggle_piece(rook, (1 << rook_from) | (1 << rook_to))
+            key ^= ZOBRIST_PIECES[rook][rook_from] ^ ZOBRIST_PIECES[rook][rook_to]
+            score += PIECE_SQUARE_VALUES[rook][rook_to] - PIECE_SQUARE_VALUES[rook][rook_from]
+            board[rook_to >> 3][rook_to & 7] = rook
+            board[rook_from >> 3][rook_from & 7] = ".."
+
+        self.occupied = self.occupancy['w'] | self.occupancy['b']
+        self.zobrist_key = key ^ ZOBRIST_BLACK_TO_MOVE ^ ZOBRIST_CASTLING[self.castling_rights] ^ \
+            self.get_enpassant_zobrist()
+        self.zobrist_log.append(self.zobrist_key)
+        self.eval_score = score
+        self.eval_log.append(score)
 
     # Undo a move by clicking u on the keyboard
     def undo_move(self):
         # Makes sure there is a move to undo
-        if len(self.log) != 0:
-            piecemove = self.log.pop()
-            self.board[piecemove.start_rank][piecemove.start_file] = piecemove.piece_moved
-            self.board[piecemove.end_rank][piecemove.end_file] = piecemove.piece_captured
+        if len(self.move_log) != 0:
+            move = self.move_log.pop()
+            start = move & 63
+            end = (move >> 6) & 63
+            kind = (move >> 12) & 3
+            piece_moved = MOVED_PIECES[(move >> 16) & 15]
+            piece_captured = CAPTURED_PIECES[move >> 20]
+            end_bit = 1 << end
+            color = piece_moved[0]
+            board = self.board
+            # Undo promotion first so the pawn is back on the end square before it is moved back
+            if kind == PROMOTION_MOVE:
+                self.toggle_piece(color + PROMOTION_PIECES[(move >> 14) & 3], end_bit)
+                self.toggle_piece(piece_moved, end_bit)
+            self.toggle_piece(piece_moved, (1 << start) | end_bit)
+            board[start >> 3][start & 7] = piece_moved
+            board[end >> 3][end & 7] = piece_captured
             self.white_to_move = not self.white_to_move
             # Updates king location in case of undoing king moves
-            if piecemove.piece_moved == "wK":
-                self.white_king = (piecemove.start_rank, piecemove.start_file)
-            elif piecemove.piece_moved == "bK":
-                self.black_king = (piecemove.start_rank, piecemove.start_file)
+            if piece_moved == "wK":
+                self.white_king = (start >> 3, start & 7)
+            elif piece_moved == "bK":
+                self.black_king = (start >> 3, start & 7)
             # Undo enpassant
-            if piecemove.is_en_passant:
-                self.board[piecemove.end_rank][piecemove.end_file] = ".."
-                self.board[piecemove.start_rank][piecemove.end_file] = piecemove.piece_captured
-                self.en_passant_possible = (piecemove.end_rank, piecemove.end_file)
+            if kind == EN_PASSANT_MOVE:
+                captured = (start & 56) | (end & 7)
+                self.toggle_piece(piece_captured, 1 << captured)
+                board[end >> 3][end & 7] = ".."
+                board[captured >> 3][captured & 7] = piece_captured
+            elif piece_captured != "..":
+                self.toggle_piece(piece_captured, end_bit)
             # Undo two square advance
-            if piecemove.piece_moved[1] == 'p' and abs(piecemove.end_rank - piecemove.start_rank) == 2:
-                self.en_passant_possible = ()
+            self.enpassant_log.pop()
+            self.enpassant_move = self.enpassant_log[-1]
             # Undo castling rights
             self.castle_rights_log.pop()
-            self.current_castling_right = self.castle_rights_log[-1]
+            self.castling_rights = self.castle_rights_log[-1]
+            self.zobrist_log.pop()
+            self.zobrist_key = self.zobrist_log[-1]
+            self.eval_log.pop()
+            self.eval_score = self.eval_log[-1]
             # Undo castle move
-            if piecemove.is_castle_move:
-                if piecemove.end_file - piecemove.start_file == 2:
-                    self.board[piecemove.end_rank][piecemove.end_file + 1] = self.board[piecemove.end_rank][
-                        piecemove.end_file - 1]
-                    self.board[piecemove.end_rank][piecemove.end_file - 1] = ".."
+            if kind == CASTLE_MOVE:
+                if end > start:
+                    rook_from, rook_to = end + 1, end - 1
                 else:
-                    self.board[piecemove.end_rank][piecemove.end_file - 2] = self.board[piecemove.end_rank][
-                        piecemove.end_file + 1]
-                    self.board[piecemove.end_rank][piecemove.end_file + 1] = ".."
+                    rook_from, rook_to = end - 2, end + 1
+                self.toggle_piece(color + 'R', (1 << rook_from) | (1 << rook_to))
+                board[rook_from >> 3][rook_from & 7] = color + 'R'
+                board[rook_to >> 3][rook_to & 7] = ".."
 
+            self.occupied = self.occupancy['w'] | self.occupancy['b']
             self.check_mate = False
             self.stale_mate = False
 
-    # Update castling rights given move
-    def update_castle_rights(self, piecemove):
-        if piecemove.piece_moved == 'wK':  # If white king moved
-            self.current_castling_right.wks = False
-            self.current_castling_right.wqs = False
-        elif piecemove.piece_moved == 'bK':
-            self.current_castling_right.bks = False
-            self.current_castling_right.bqs = False
-        elif piecemove.piece_moved == 'wR':  # If white rook moved
-            if piecemove.start_rank == 7:
-                if piecemove.start_file == 0:
-                    self.current_castling_right.wqs = False
-                elif piecemove.start_file == 7:
-                    self.current_castling_right.wks = False
-        elif piecemove.piece_moved == 'bR':
-            if piecemove.start_rank == 0:
-                if piecemove.start_file == 0:
-                    self.current_castling_right.bqs = False
-                elif piecemove.start_file == 7:
-                    self.current_castling_right.bks = False
-        # If Rook is captured
-        if piecemove.piece_captured == 'wR':
-            if piecemove.end_rank == 7:
-                if piecemove.end_file == 0:
-                    self.current_castling_right.wqs = False
-                elif piecemove.end_file == 7:
-                    self.current_castling_right.wks = False
-        elif piecemove.piece_captured == 'bR':
-            if piecemove.end_rank == 0:
-                if piecemove.end_file == 0:
-                    self.current_castling_right.bqs = False
-                elif piecemove.end_file == 7:
-                    self.current_castling_right.bks = False
+    # Passes the turn without moving a piece, for null move pruning in the search. The null move is not added to the
+    # move log, so it has to be taken back with undo_null_move before any real move is undone
+    def make_null_move(self):
+        self.zobrist_key ^= self.get_enpassant_zobrist() ^ ZOBRIST_BLACK_TO_MOVE
+        self.white_to_move = not self.white_to_move
+        self.enpassant_move = ()
+        self.enpassant_log.append(self.enpassant_move)
+        self.castle_rights_log.append(self.castling_rights)
+        self.zobrist_log.append(self.zobrist_key)
+        self.eval_log.append(self.eval_score)
+
+    def undo_null_move(self):
+        self.white_to_move = not self.white_to_move
+        self.enpassant_log.pop()
+        self.enpassant_move = self.enpassant_log[-1]
+        self.castle_rights_log.pop()
+        self.zobrist_log.pop()
+        self.zobrist_key = self.zobrist_log[-1]
+        self.eval_log.pop()
+        self.check_mate = False
+        self.stale_mate = False
 
     # Get all the valid moves based on the board state, including checks and pins
     def get_valid_moves(self):
-        temp_enpassant = self.enpassant_move  # Storing this because our method might change this, we want to conserve it
-        temp_castle_rights = CastleRights(self.current_castling_right.wks, self.current_castling_right.bks,
-                                          self.current_castling_right.wqs, self.current_castling_right.bqs)
-        valid_moves = []
+        return [PieceMove.from_move_code(move) for move in self.get_valid_move_codes()]
+
+    # The legal move written in coordinate notation (e2e4, e7e8q) or SAN (Nf3, exd5, O-O, e8=Q+), as a move code
+    # Raises ValueError for a move that is not legal here or could be more than one move
+    def parse_move(self, text):
+        moves = self.get_valid_moves()
+        text = text.strip().rstrip("+#!?")
+        for move in moves:
+            if move.get_chess_notation() == text.lower():
+                return move.move_code
+        if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            candidates = [move for move in moves if move.is_castle_move and (move.end_file == 6) == (len(text) == 3)]
+        else:
+            match = SAN_PATTERN.fullmatch(text)
+            if match is None:
+                raise ValueError("Invalid move: " + text)
+            piece, start_file, start_rank, end_square, promotion = match.groups()
+            candidates = [move for move in moves if move.piece_moved[1] == (piece or 'p') and
+                          move.get_rank_and_file(move.end_rank, move.end_file) == end_square and
+                          (start_file is None or PieceMove.cols_to_files[move.start_file] == start_file) and
+                          (start_rank is None or PieceMove.rows_to_ranks[move.start_rank] == start_rank) and
+                          move.promotion_piece == (promotion or ('Q' if move.is_pawn_promotion else None))]
+        if len(candidates) != 1:
+            raise ValueError("Illegal or ambiguous move: " + text)
+        return candidates[0].move_code
+
+    # Same as get_valid_moves but as packed move codes, written into buffer when one is given so a search can reuse
+    # one list per ply instead of allocating a new one at every node
+    def get_valid_move_codes(self, buffer=None):
+        if buffer is None:
+            valid_moves = []
+        else:
+            valid_moves = buffer
+            valid_moves.clear()
         self.in_check, self.pins, self.checks = self.pins_and_checks()
         if self.white_to_move:
             king_rank, king_file = self.white_king
         else:
             king_rank, king_file = self.black_king
         if self.in_check:
-            # Moves if only one piece is putting the king in check
-            if len(self.checks) == 1:
-                moves = self.get_all_possible_moves()
-                check = self.checks[0]
-                check_rank, check_file, check_rank_dir, check_file_dir = check
-                piece_putting_check = self.board[check_rank][check_file]
-                possible_squares = []
-                # If a knight is checking, then no blocking is possible, you can only capture the knight
-                if piece_putting_check[1] == 'N':
-                    possible_squares = [(check_rank, check_file)]
-                # Any other piece is checking
-                else:
-                    for i in range(1, 8):
-                        # Can block by moving any piece in the check direction up to the check piece
-                        possible_square = (king_rank + check_rank_dir * i, king_file + check_file_dir * i)
-                        possible_squares.append(possible_square)
-                        if possible_square[0] == check_rank and possible_square[1] == check_file:
-                            break
-                # Remove from all possible moves, ones that are not valid given a check
-                for i in range(len(moves) - 1, -1, -1):
-                    if moves[i].piece_moved[1] != 'K':
-                        if not (moves[i].end_rank, moves[i].end_file) in possible_squares:
-                            moves.remove(moves[i])
-                valid_moves = moves
-            # If multiple checks (double checks) then the king needs to move
-            else:
-                self.get_king_moves(king_rank, king_file, valid_moves)
+            self.get_check_evasion_moves(valid_moves)
         # No checks mean all moves that are possible are valid
         else:
-            valid_moves = self.get_all_possible_moves()
-            if self.white_to_move:
-                self.get_castle_moves(self.white_king[0], self.white_king[1], valid_moves)
-            else:
-                self.get_castle_moves(self.black_king[0], self.black_king[1], valid_moves)
+            self.get_all_possible_moves(ALL_SQUARES, valid_moves)
+            self.get_castle_moves(king_rank, king_file, valid_moves)
 
         if len(valid_moves) == 0:
             if self.in_check:
@@ -194,322 +556,423 @@ class BoardState:
             else:
                 self.stale_mate = True
 
-        self.enpassant_move = temp_enpassant
-        self.current_castling_right = temp_castle_rights
         return valid_moves
 
-    # Get all possible moves based on piece
-    def get_all_possible_moves(self):
-        valid_moves = []
-        for r in range(len(self.board)):
-            for f in range(len(self.board[r])):
-                turn = self.board[r][f][0]
-                if (turn == "w" and self.white_to_move) or (turn == "b" and not self.white_to_move):
-                    piece = self.board[r][f][1]
-                    self.move_dictionary[piece](r, f, valid_moves)
+    # Get the valid captures and promotions only as move codes, for searches that look at tactical moves without the
+    # quiet ones. Unlike get_valid_moves this never sets check_mate or stale_mate, an empty list only means no captures
+    def get_capture_move_codes(self, buffer=None):
+        if buffer is None:
+            capture_moves = []
+        else:
+            capture_moves = buffer
+            capture_moves.clear()
+        self.in_check, self.pins, self.checks = self.pins_and_checks()
+        if self.white_to_move:
+            enemy_pieces = self.occupancy['b']
+            promotion_row = ROWS[0]
+        else:
+            enemy_pieces = self.occupancy['w']
+            promotion_row = ROWS[7]
+        if self.in_check:
+            return self.get_check_evasion_moves(capture_moves, enemy_pieces, enemy_pieces | promotion_row)
+        self.get_tactical_moves(capture_moves, enemy_pieces, promotion_row)
+        return capture_moves
+
+    # Captures, and pawn pushes to the last rank, which count as captures since they gain as much material as most
+    # captures. In check get_check_evasion_moves is given the same targets instead
+    def get_tactical_moves(self, moves, enemy_pieces, promotion_row):
+        self.get_pawn_moves(moves, enemy_pieces | promotion_row)
+        self.get_all_possible_moves(enemy_pieces, moves, include_pawns=False)
+
+    # Yields the legal moves as move codes in stages, the hash move if it is legal, then captures and promotions, then
+    # quiet moves, so a search that cuts off early never generates the later stages. order_captures and order_quiets
+    # may sort a stage in place before it is yielded. Once every stage is exhausted without a move, check_mate or
+    # stale_mate is set as get_valid_moves would
+    def generate_moves(self, hash_move=None, order_captures=None, order_quiets=None, buffer=None):
+        # The caller plays each move and searches below it before asking for the next, which overwrites the pins
+        # and checks, so they are kept here and put back before every stage
+        state = self.pins_and_checks()
+        in_check = state[0]
+        self.in_check, self.pins, self.checks = state
+        moves = [] if buffer is None else buffer
+        found = False
+        if hash_move is not None and self.is_legal_move_code(hash_move):
+            found = True
+            yield hash_move
+
+        if self.white_to_move:
+            enemy_pieces = self.occupancy['b']
+            promotion_row = ROWS[0]
+        else:
+            enemy_pieces = self.occupancy['w']
+            promotion_row = ROWS[7]
+        empty = ALL_SQUARES ^ self.occupied
+        for stage in range(2):
+            self.in_check, self.pins, self.checks = state
+            moves.clear()
+            if in_check:
+                if stage == 0:
+                    self.get_check_evasion_moves(moves, enemy_pieces, enemy_pieces | promotion_row)
+                else:
+                    self.get_check_evasion_moves(moves, empty, empty & ~promotion_row)
+            elif stage == 0:
+                self.get_tactical_moves(moves, enemy_pieces, promotion_row)
+            else:
+                self.get_pawn_moves(moves, empty & ~promotion_row)
+                self.get_all_possible_moves(empty, moves, include_pawns=False)
+                king_rank, king_file = self.white_king if self.white_to_move else self.black_king
+                self.get_castle_moves(king_rank, king_file, moves)
+            order = order_captures if stage == 0 else order_quiets
+            if order is not None and len(moves) > 1:
+                order(moves)
+            for move in moves:
+                if move != hash_move:
+                    found = True
+                    yield move
+
+        if not found:
+            if in_check:
+                self.check_mate = True
+            else:
+                self.stale_mate = True
+
+    # Whether a move code, typically taken from the transposition table, is legal here
+    # Only moves of the same piece to the same square are generated, pins_and_checks must be current
+    def is_legal_move_code(self, move):
+        start = move & 63
+        end = (move >> 6) & 63
+        kind = (move >> 12) & 3
+        piece = MOVED_PIECES[(move >> 16) & 15]
+        if piece == ".." or self.board[start >> 3][start & 7] != piece or \
+                (piece[0] == 'w') != self.white_to_move:
+            return False
+        candidates = []
+        if kind == CASTLE_MOVE:
+            if not self.in_check:
+                king_rank, king_file = self.white_king if self.white_to_move else self.black_king
+                self.get_castle_moves(king_rank, king_file, candidates)
+            return move in candidates
+        targets = 1 << end
+        if kind == EN_PASSANT_MOVE:
+            targets |= 1 << ((start & 56) | (end & 7))
+        if self.in_check and piece[1] != 'K':
+            # Only a capture of the checker or a block can answer a single check, nothing but the king a double one
+            if len(self.checks) > 1:
+                return False
+            targets &= self.checks[0][1]
+        if piece[1] == 'p':
+            self.get_pawn_moves(candidates, targets)
+        elif piece[1] == 'N':
+            self.get_knight_moves(candidates, targets)
+        elif piece[1] == 'B':
+            self.get_bishop_moves(candidates, targets)
+        elif piece[1] == 'R':
+            self.get_rook_moves(candidates, targets)
+        elif piece[1] == 'Q':
+            self.get_queen_moves(candidates, targets)
+        else:
+            self.get_king_moves(candidates, targets)
+        return move in candidates
+
+    # Whether the side to move has any legal move, stopping at the first piece type that has one
+    # Sets check_mate or stale_mate like get_valid_moves when there is none
+    def has_legal_move(self):
+        self.in_check, self.pins, self.checks = self.pins_and_checks()
+        moves = self.get_king_moves([])
+        if not moves and len(self.checks) < 2:
+            # In check the other pieces can only capture the checker or block
+            targets = self.checks[0][1] if self.in_check else ALL_SQUARES
+            for generate in (self.get_pawn_moves, self.get_knight_moves, self.get_bishop_moves, self.get_rook_moves,
+                             self.get_queen_moves):
+                generate(moves, targets)
+                if moves:
+                    break
+        if moves:
+            return True
+        if self.in_check:
+            self.check_mate = True
+        else:
+            self.stale_mate = True
+        return False
+
+    # Get the moves out of check ending on one of the target squares, pins_and_checks must be current. Only the
+    # king moves out of a double check. A single check can also be answered by capturing the checker or blocking
+    # between it and the king, and those squares are the only ones the other pieces are generated for. Pawns use
+    # pawn_targets when given, an en passant capture is found when the checker is the pawn it takes
+    def get_check_evasion_moves(self, valid_moves, targets=ALL_SQUARES, pawn_targets=None):
+        if len(self.checks) == 1:
+            # Squares from the king up to and including the checking piece, a knight or pawn can only be captured
+            evasion_squares = self.checks[0][1]
+            pawn_targets = evasion_squares & (targets if pawn_targets is None else pawn_targets)
+            if pawn_targets:
+                self.get_pawn_moves(valid_moves, pawn_targets)
+            if targets & evasion_squares:
+                self.get_knight_moves(valid_moves, targets & evasion_squares)
+                self.get_bishop_moves(valid_moves, targets & evasion_squares)
+                self.get_rook_moves(valid_moves, targets & evasion_squares)
+                self.get_queen_moves(valid_moves, targets & evasion_squares)
+        return self.get_king_moves(valid_moves, targets)
+
+    # Get all possible moves based on piece, only those ending on one of the target squares
+    def get_all_possible_moves(self, targets=ALL_SQUARES, valid_moves=None, include_pawns=True):
+        if valid_moves is None:
+            valid_moves = []
+        if include_pawns:
+            self.get_pawn_moves(valid_moves, targets)
+        self.get_knight_moves(valid_moves, targets)
+        self.get_bishop_moves(valid_moves, targets)
+        self.get_rook_moves(valid_moves, targets)
+        self.get_queen_moves(valid_moves, targets)
+        self.get_king_moves(valid_moves, targets)
         return valid_moves
 
-    # Get all possible pawn moves including if pinned
-    def get_pawn_moves(self, r, f, valid_moves):
-        # Check if a pawn is pinned, and if so get the direction of the pin
-        pinned = False
-        pin_direction = ()
-        for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == f:
-                pinned = True
-                pin_direction = (self.pins[i][2], self.pins[i][3])
-                self.pins.remove(self.pins[i])  # Remove from total pins the one given by this pawn
-                break
+    # Appends a move for every target square, offset gives the start square relative to the target and pawn the
+    # moved pawn's code
+    def add_pawn_moves(self, targets, offset, pawn, valid_moves):
+        board = self.board
+        pins = self.pins
+        for end in squares_of(targets):
+            start = end + offset
+            if start not in pins or (1 << end) & pins[start]:
+                move = start | end << 6 | pawn | CAPTURED_CODES[board[end >> 3][end & 7]]
+                if end < 8 or end >= 56:
+                    for promotion in PROMOTION_CODES:
+                        valid_moves.append(move | promotion)
+                else:
+                    valid_moves.append(move)
+
+    # Get all possible pawn moves including if pinned, for every pawn at once by shifting the pawn bitboard
+    def get_pawn_moves(self, valid_moves, targets=ALL_SQUARES):
+        empty = (ALL_SQUARES ^ self.occupied) & targets
         if self.white_to_move:
-            move_amount = -1
-            start_row = 6
-            enemy_color = 'b'
-            king_rank, king_file = self.white_king
+            pawns = self.bitboards['wp']
+            enemy_pieces = self.occupancy['b'] & targets
+            single_pushes = (pawns >> 8) & empty
+            double_pushes = ((((pawns >> 8) & ~self.occupied) & ROWS[5]) >> 8) & empty
+            left_captures = ((pawns & NOT_FILE_A) >> 9) & enemy_pieces
+            right_captures = ((pawns & NOT_FILE_H) >> 7) & enemy_pieces
+            forward = -8
+            pawn, enemy_pawn = MOVED_CODES['wp'], CAPTURED_CODES['bp']
         else:
-            move_amount = 1
-            start_row = 1
-            enemy_color = 'w'
-            king_rank, king_file = self.black_king
+            pawns = self.bitboards['bp']
+            enemy_pieces = self.occupancy['w'] & targets
+            single_pushes = (pawns << 8) & empty
+            double_pushes = ((((pawns << 8) & ~self.occupied) & ROWS[2]) << 8) & empty
+            left_captures = ((pawns & NOT_FILE_A) << 7) & enemy_pieces
+            right_captures = ((pawns & NOT_FILE_H) << 9) & enemy_pieces
+            forward = 8
+            pawn, enemy_pawn = MOVED_CODES['bp'], CAPTURED_CODES['wp']
 
         # One square, two square moves
-        if self.board[r + move_amount][f] == "..":
-            if not pinned or pin_direction == (move_amount, 0):
-                valid_moves.append(PieceMove((r, f), (r + move_amount, f), self.board))
-                if r == start_row and self.board[r + 2 * move_amount][f] == "..":
-                    valid_moves.append(PieceMove((r, f), (r + 2 * move_amount, f), self.board))
-        # Left capture
-        if f - 1 >= 0:
-            if not pinned or pin_direction == (move_amount, -1):
-                if self.board[r + move_amount][f - 1][0] == enemy_color:
-                    valid_moves.append(PieceMove((r, f), (r + move_amount, f - 1), self.board))
-                if (r + move_amount, f - 1) == self.enpassant_move:
-                    attacking_piece = blocking_piece = False
-                    if king_rank == r:
-                        if king_file < f:  # King is left of pawn
-                            inside = range(king_file + 1, f - 1)
-                            outside = range(f + 1, 8)
-                        else:
-                            inside = range(king_file - 1, f, -1)
-                            outside = range(f - 2, -1, -1)
-                        for i in inside:
-                            if self.board[r][i] != "..":  # Some piece is blocking
-                                blocking_piece = True
-                        for i in outside:
-                            square = self.board[r][i]
-                            if square[0] == enemy_color and (square[1] == 'R' or square[1] == 'Q'):
-                                attacking_piece = True
-                            elif square != "..":
-                                blocking_piece = True
-                    if not attacking_piece or blocking_piece:
-                        valid_moves.append(PieceMove((r, f), (r + move_amount, f - 1), self.board, en_passant_possible=True))
-        # Right capture
-        if f + 1 <= 7:
-            if not pinned or pin_direction == (move_amount, 1):
-                if self.board[r + move_amount][f + 1][0] == enemy_color:
-                    valid_moves.append(PieceMove((r, f), (r + move_amount, f + 1), self.board))
-                if (r + move_amount, f + 1) == self.enpassant_move:
-                    attacking_piece = blocking_piece = False
-                    if king_rank == r:
-                        if king_file > f:  # King is left of pawn
-                            inside = range(king_file + 1, f)
-                            outside = range(f + 2, 8)
-                        else:
-                            inside = range(king_file - 1, f + 1, -1)
-                            outside = range(f - 1, -1, -1)
-                        for i in inside:
-                            if self.board[r][i] != "..":  # Some piece is blocking
-                                blocking_piece = True
-                        for i in outside:
-                            square = self.board[r][i]
-                            if square[0] == enemy_color and (square[1] == 'R' or square[1] == 'Q'):
-                                attacking_piece = True
-                            elif square != "..":
-                                blocking_piece = True
-                    if not attacking_piece or blocking_piece:
-                        valid_moves.append(PieceMove((r, f), (r + move_amount, f - 1), self.board, en_passant_possible=True))
+        self.add_pawn_moves(single_pushes, -forward, pawn, valid_moves)
+        self.add_pawn_moves(double_pushes, -2 * forward, pawn, valid_moves)
+        # Left and right captures
+        self.add_pawn_moves(left_captures, 1 - forward, pawn, valid_moves)
+        self.add_pawn_moves(right_captures, -1 - forward, pawn, valid_moves)
+
+        # Enpassant, checked by lifting both pawns off the board since it can uncover the king along a rank or diagonal
+        if self.enpassant_move != ():
+            target = self.enpassant_move[0] * 8 + self.enpassant_move[1]
+            captured = target - forward
+        if self.enpassant_move != () and (1 << captured) & targets:
+            enemy_color = 'b' if self.white_to_move else 'w'
+            king_rank, king_file = self.white_king if self.white_to_move else self.black_king
+            king_square = king_rank * 8 + king_file
+            enemy_orthogonal = self.bitboards[enemy_color + 'R'] | self.bitboards[enemy_color + 'Q']
+            enemy_diagonal = self.bitboards[enemy_color + 'B'] | self.bitboards[enemy_color + 'Q']
+            for start in squares_of(PAWN_ATTACKS[enemy_color][target] & pawns):
+                # Only a pawn leaving a line through the king can uncover it
+                if LINE[king_square][start] or LINE[king_square][captured]:
+                    occupied = (self.occupied ^ (1 << start) ^ (1 << captured)) | (1 << target)
+                    if rook_attacks(king_square, occupied) & enemy_orthogonal or \
+                            bishop_attacks(king_square, occupied) & enemy_diagonal:
+                        continue
+                valid_moves.append(start | target << 6 | EN_PASSANT_MOVE << 12 | pawn | enemy_pawn)
 
         return valid_moves
 
-    # Get all rook moves including if pinned
-    def get_rook_moves(self, r, f, valid_moves):
-        # Check if rook is pinned, and if so remove it from total pins
-        pinned = False
-        pin_direction = ()
-        for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == f:
-                pinned = True
-                pin_direction = (self.pins[i][2], self.pins[i][3])
-                if self.board[r][f][1] != 'Q':
-                    self.pins.remove(self.pins[i])
-                break
+    # Appends a move to every target square of a piece standing on start, limited to its pin line if it is pinned
+    def add_piece_moves(self, start, targets, valid_moves):
+        if start in self.pins:
+            targets &= self.pins[start]
+        board = self.board
+        base = start | MOVED_CODES[board[start >> 3][start & 7]]
+        for end in squares_of(targets):
+            valid_moves.append(base | end << 6 | CAPTURED_CODES[board[end >> 3][end & 7]])
 
-        directions = ((-1, 0), (1, 0), (0, -1), (0, 1))  # Unit vector rook movement
-        opponent_color = 'b' if self.white_to_move else 'w'
-        # Deal with rook movement in each direction
-        for direction in directions:
-            for i in range(1, 8):
-                end_rank = r + direction[0] * i
-                end_file = f + direction[1] * i
-                if 0 <= end_rank <= 7 and 0 <= end_file <= 7:
-                    if not pinned or pin_direction == direction or pin_direction == (-direction[0], -direction[1]):
-                        end_piece = self.board[end_rank][end_file]
-                        if end_piece == "..":
-                            valid_moves.append(PieceMove((r, f), (end_rank, end_file), self.board))
-                        elif end_piece[0] == opponent_color:
-                            valid_moves.append(PieceMove((r, f), (end_rank, end_file), self.board))
-                            break
-                        else:
-                            break
-                else:
-                    break
+    # Get all rook moves including if pinned
+    def get_rook_moves(self, valid_moves, targets=ALL_SQUARES, piece='R'):
+        ally_color = 'w' if self.white_to_move else 'b'
+        not_ally = (ALL_SQUARES ^ self.occupancy[ally_color]) & targets
+        for start in squares_of(self.bitboards[ally_color + piece]):
+            self.add_piece_moves(start, rook_attacks(start, self.occupied) & not_ally, valid_moves)
         return valid_moves
 
-    # Get all knight moves including if pinned
-    def get_knight_moves(self, r, f, valid_moves):
-        # Check if knight is pinned, if so remove it from total pins
-        pinned = False
-        for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == f:
-                pinned = True
-                self.pins.remove(self.pins[i])
-                break
-
-        directions = ((-2, -1), (-2, 1), (2, -1), (2, 1), (-1, -2), (1, -2), (-1, 2), (1, 2))  # Vector for knight moves
+    # Get all knight moves, a pinned knight can never move
+    def get_knight_moves(self, valid_moves, targets=ALL_SQUARES):
         ally_color = 'w' if self.white_to_move else 'b'
-        # Get all knight moves for each direction
-        for direction in directions:
-            end_rank = r + direction[0]
-            end_file = f + direction[1]
-            if 0 <= end_rank <= 7 and 0 <= end_file <= 7:
-                if not pinned:
-                    end_piece = self.board[end_rank][end_file]
-                    if end_piece[0] != ally_color:
-                        valid_moves.append(PieceMove((r, f), (end_rank, end_file), self.board))
+        not_ally = (ALL_SQUARES ^ self.occupancy[ally_color]) & targets
+        for start in squares_of(self.bitboards[ally_color + 'N']):
+            if start not in self.pins:
+                self.add_piece_moves(start, KNIGHT_ATTACKS[start] & not_ally, valid_moves)
         return valid_moves
 
     # Get all bishop moves including if pinned
-    def get_bishop_moves(self, r, f, valid_moves):
-        # Check if bishop is pinned, if so remove it from total pins
-        pinned = False
-        pin_direction = ()
-        for i in range(len(self.pins) - 1, -1, -1):
-            if self.pins[i][0] == r and self.pins[i][1] == f:
-                pinned = True
-                pin_direction = (self.pins[i][2], self.pins[i][3])
-                self.pins.remove(self.pins[i])
-                break
-
-        directions = ((-1, -1), (1, -1), (1, 1), (-1, 1))  # Vectors for bishop directions
-        opponent_color = 'b' if self.white_to_move else 'w'
-        # Check bishop moves in each direction
-        for direction in directions:
-            for i in range(1, 8):
-                end_rank = r + direction[0] * i
-                end_file = f + direction[1] * i
-                if 0 <= end_rank <= 7 and 0 <= end_file <= 7:
-                    if not pinned or pin_direction == direction or pin_direction == (-direction[0], -direction[1]):
-                        end_piece = self.board[end_rank][end_file]
-                        if end_piece == "..":
-                            valid_moves.append(PieceMove((r, f), (end_rank, end_file), self.board))
-                        elif end_piece[0] == opponent_color:
-                            valid_moves.append(PieceMove((r, f), (end_rank, end_file), self.board))
-                            break
-                        else:
-                            break
-                else:
-                    break
+    def get_bishop_moves(self, valid_moves, targets=ALL_SQUARES, piece='B'):
+        ally_color = 'w' if self.white_to_move else 'b'
+        not_ally = (ALL_SQUARES ^ self.occupancy[ally_color]) & targets
+        for start in squares_of(self.bitboards[ally_color + piece]):
+            self.add_piece_moves(start, bishop_attacks(start, self.occupied) & not_ally, valid_moves)
         return valid_moves
 
     # Get all queen moves (is exactly rook and bishop combined)
-    def get_queen_moves(self, r, f, valid_moves):
-        self.get_rook_moves(r, f, valid_moves)
-        self.get_bishop_moves(r, f, valid_moves)
+    def get_queen_moves(self, valid_moves, targets=ALL_SQUARES):
+        self.get_rook_moves(valid_moves, targets, 'Q')
+        self.get_bishop_moves(valid_moves, targets, 'Q')
 
-    # Get all possible king moves
-    def get_king_moves(self, r, f, valid_moves):
-        directions = ((-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, -1), (1, 1), (-1, 1))
+    # Get all possible king moves, to every square the opponent does not attack once the king has left its square
+    def get_king_moves(self, valid_moves, targets=ALL_SQUARES):
         ally_color = 'w' if self.white_to_move else 'b'
-        for direction in directions:
-            end_rank = r + direction[0]
-            end_file = f + direction[1]
-            if 0 <= end_rank <= 7 and 0 <= end_file <= 7:
-                end_piece = self.board[end_rank][end_file]
-                if end_piece[0] != ally_color:
-                    # Move king temporarily to square being considered, if not in check then add that to possible moves
-                    if ally_color == 'w':
-                        self.white_king = (end_rank, end_file)
-                    else:
-                        self.black_king = (end_rank, end_file)
-                    in_check, pins, checks = self.pins_and_checks()
-                    if not in_check:
-                        valid_moves.append(PieceMove((r, f), (end_rank, end_file), self.board))
-                    if ally_color == 'w':
-                        self.white_king = (r, f)
-                    else:
-                        self.black_king = (r, f)
-
+        r, f = self.white_king if self.white_to_move else self.black_king
+        king_square = r * 8 + f
+        targets &= KING_ATTACKS[king_square] & ~self.occupancy[ally_color]
+        if targets:
+            # Without the king on the board, a square behind it on a checking ray counts as attacked
+            attacked = self.get_attacked_among(targets, 'b' if self.white_to_move else 'w',
+                                               self.occupied ^ (1 << king_square))
+            board = self.board
+            base = king_square | MOVED_CODES[ally_color + 'K']
+            for end in squares_of(targets & ~attacked):
+                valid_moves.append(base | end << 6 | CAPTURED_CODES[board[end >> 3][end & 7]])
         return valid_moves
 
-    # Get moves for castling if possible
+    # Get moves for castling if possible, the king's square and the squares it crosses are tested in one query
     def get_castle_moves(self, r, f, moves):
-        if self.square_under_attack(r, f):
+        if self.white_to_move:
+            king_side = self.castling_rights & WHITE_KING_SIDE
+            queen_side = self.castling_rights & WHITE_QUEEN_SIDE
+        else:
+            king_side = self.castling_rights & BLACK_KING_SIDE
+            queen_side = self.castling_rights & BLACK_QUEEN_SIDE
+        king_square = r * 8 + f
+        king_side_path = (1 << (king_square + 1)) | (1 << (king_square + 2)) if king_side else 0
+        queen_side_path = (1 << (king_square - 1)) | (1 << (king_square - 2)) if queen_side else 0
+        # Every square between king and rook must be empty, including b1/b8 which the king does not cross
+        if king_side_path & self.occupied:
+            king_side_path = 0
+        if queen_side_path and (queen_side_path | (1 << (king_square - 3))) & self.occupied:
+            queen_side_path = 0
+        if not king_side_path and not queen_side_path:
             return
-        if (self.current_castling_right.wks and self.white_to_move) or (
-                self.current_castling_right.bks and not self.white_to_move):
-            self.get_king_side_castle_moves(r, f, moves)
-        if (self.current_castling_right.wqs and self.white_to_move) or (
-                self.current_castling_right.bqs and not self.white_to_move):
-            self.get_queen_side_castle_moves(r, f, moves)
-
-    # Add king side castle moves
-    def get_king_side_castle_moves(self, r, f, moves):
-        if self.board[r][f + 1] == ".." and self.board[r][f + 2] == "..":
-            if not self.square_under_attack(r, f + 1) and not self.square_under_attack(r, f + 2):
-                moves.append(PieceMove((r, f), (r, f + 2), self.board, is_castle=True))
-
-    # Add queen side castle moves
-    def get_queen_side_castle_moves(self, r, f, moves):
-        if self.board[r][f - 1] == ".." and self.board[r][f - 2] == ".." and self.board[r][f - 3] == "..":
-            if not self.square_under_attack(r, f - 1) and not self.square_under_attack(r, f - 2):
-                moves.append(PieceMove((r, f), (r, f - 2), self.board, is_castle=True))
+        attacked = self.get_attacked_among((1 << king_square) | king_side_path | queen_side_path,
+                                           'b' if self.white_to_move else 'w')
+        if attacked & (1 << king_square):
+            return
+        base = king_square | CASTLE_MOVE << 12 | MOVED_CODES['wK' if self.white_to_move else 'bK']
+        if king_side_path and not attacked & king_side_path:
+            moves.append(base | (king_square + 2) << 6)
+        if queen_side_path and not attacked & queen_side_path:
+            moves.append(base | (king_square - 2) << 6)
 
     # Checks for all pins and checks for a given board state
+    # Pins map a pinned square to the squares it may still move to, checks pair a checking square with the squares
+    # that would stop the check by capturing or blocking it
     def pins_and_checks(self):
-        pins = []
+        pins = {}
         checks = []
-        in_check = False
         if self.white_to_move:
             opponent_color = 'b'
             ally_color = 'w'
-            start_rank = self.white_king[0]
-            start_file = self.white_king[1]
+            start_rank, start_file = self.white_king
         else:
             opponent_color = 'w'
             ally_color = 'b'
-            start_rank = self.black_king[0]
-            start_file = self.black_king[1]
-        directions = [(-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+            start_rank, start_file = self.black_king
+        king_square = start_rank * 8 + start_file
+        occupied = self.occupied
+        allies = self.occupancy[ally_color]
+        orthogonal = self.bitboards[opponent_color + 'R'] | self.bitboards[opponent_color + 'Q']
+        diagonal = self.bitboards[opponent_color + 'B'] | self.bitboards[opponent_color + 'Q']
         # Check in all directions for pins and checks
-        for i, direction in enumerate(directions):
-            poss_pins = ()
-            # Check all the way in each direction until an allied piece, enemy piece, or end of board
-            for j in range(1, 8):
-                end_rank = start_rank + direction[0] * j
-                end_file = start_file + direction[1] * j
-                if 0 <= end_rank <= 7 and 0 <= end_file <= 7:
-                    end_piece = self.board[end_rank][end_file]
-                    if (end_piece[0] == ally_color) and (end_piece[1] != 'K'):  # King cannot be a pinned piece
-                        if poss_pins == ():
-                            poss_pins = (end_rank, end_file, direction[0], direction[1])
-                        else:  # If there's already a piece pinned in this direction, we don't add it
-                            break
-                    # Check if piece in specific direction can actually check the king
-                    elif end_piece[0] == opponent_color:
-                        piece_type = end_piece[1]
-                        if (0 <= i <= 3 and piece_type == 'R') or \
-                                (4 <= i <= 7 and piece_type == 'B') or \
-                                (j == 1 and piece_type == 'p' and ((opponent_color == 'w' and 6 <= i <= 7) or (
-                                        opponent_color == 'b' and 4 <= i <= 5))) or \
-                                (piece_type == 'Q') or (j == 1 and piece_type == 'K'):
-                            if poss_pins == ():
-                                in_check = True
-                                checks.append((end_rank, end_file, direction[0], direction[1]))
-                                break
-                            else:
-                                pins.append(poss_pins)
-                                break
-                        else:
-                            break
-                else:
-                    break
-        # Check if knight is checking the king
-        knight_moves = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1))
-        for move in knight_moves:
-            end_rank = start_rank + move[0]
-            end_file = start_file + move[1]
-            if 0 <= end_rank <= 7 and 0 <= end_file <= 7:
-                end_piece = self.board[end_rank][end_file]
-                if end_piece[0] == opponent_color and end_piece[1] == 'N':
-                    in_check = True
-                    checks.append((end_rank, end_file, move[0], move[1]))
-        return in_check, pins, checks
+        for d in range(8):
+            ray = RAYS[king_square][d]
+            blockers = ray & occupied
+            if not blockers:
+                continue
+            sliders = orthogonal if d < 4 else diagonal
+            first = first_blocker(blockers, d)
+            first_bit = 1 << first
+            if first_bit & sliders:
+                checks.append((first, BETWEEN[king_square][first] | first_bit))
+            elif first_bit & allies:
+                blockers ^= first_bit
+                if blockers:
+                    second = first_blocker(blockers, d)
+                    second_bit = 1 << second
+                    if second_bit & sliders:
+                        pins[first] = BETWEEN[king_square][second] | second_bit
+        # Check if knight or pawn is checking the king
+        for attacker in squares_of(KNIGHT_ATTACKS[king_square] & self.bitboards[opponent_color + 'N']):
+            checks.append((attacker, 1 << attacker))
+        for attacker in squares_of(PAWN_ATTACKS[ally_color][king_square] & self.bitboards[opponent_color + 'p']):
+            checks.append((attacker, 1 << attacker))
+        return len(checks) != 0, pins, checks
 
     # Checks if king is in check
     def is_in_check(self):
         if self.white_to_move:
-            return self.square_under_attack(self.white_king[0], self.white_king[1])
+            return self.is_square_attacked(self.white_king[0] * 8 + self.white_king[1], 'b')
         else:
-            return self.square_under_attack(self.black_king[0], self.black_king[1])
+            return self.is_square_attacked(self.black_king[0] * 8 + self.black_king[1], 'w')
 
-    # Checks if a given square is under attack
+    # Checks if a given square is under attack by the opponent of the side to move
     def square_under_attack(self, r, f):
-        self.white_to_move = not self.white_to_move
-        opponent_moves = self.get_all_possible_moves()
-        self.white_to_move = not self.white_to_move
-        for piecemove in opponent_moves:
-            if piecemove.end_rank == r and piecemove.end_file == f:
-                return True
-        return False
+        return self.is_square_attacked(r * 8 + f, 'b' if self.white_to_move else 'w')
+
+    # Attack queries look outward from the target square: a piece attacks the square exactly when the same kind of
+    # piece standing on the square would attack it, so one knight pattern, one pawn pattern and one ray cast per
+    # direction replace generating the attacker's moves. occupied defaults to the current board
+
+    # Whether any piece of the given color attacks a square, testing the cheap patterns before casting rays
+    def is_square_attacked(self, square, color, occupied=None):
+        if occupied is None:
+            occupied = self.occupied
+        bitboards = self.bitboards
+        if KNIGHT_ATTACKS[square] & bitboards[color + 'N'] or \
+                PAWN_ATTACKS['b' if color == 'w' else 'w'][square] & bitboards[color + 'p'] or \
+                KING_ATTACKS[square] & bitboards[color + 'K']:
+            return True
+        queens = bitboards[color + 'Q']
+        orthogonal = bitboards[color + 'R'] | queens
+        if orthogonal and rook_attacks(square, occupied) & orthogonal:
+            return True
+        diagonal = bitboards[color + 'B'] | queens
+        return bool(diagonal and bishop_attacks(square, occupied) & diagonal)
+
+    # Which of the squares in a mask the given color attacks, returned as a mask
+    # Pawn and king attacks are worked out for the whole mask with shifts, the rest square by square
+    def get_attacked_among(self, squares, color, occupied=None):
+        if occupied is None:
+            occupied = self.occupied
+        bitboards = self.bitboards
+        pawns = bitboards[color + 'p']
+        if color == 'w':
+            pawn_attacks = ((pawns & NOT_FILE_A) >> 9) | ((pawns & NOT_FILE_H) >> 7)
+        else:
+            pawn_attacks = ((pawns & NOT_FILE_A) << 7) | ((pawns & NOT_FILE_H) << 9)
+        attacked = squares & pawn_attacks
+        for king_square in squares_of(bitboards[color + 'K']):
+            attacked |= squares & KING_ATTACKS[king_square]
+        knights = bitboards[color + 'N']
+        queens = bitboards[color + 'Q']
+        orthogonal = bitboards[color + 'R'] | queens
+        diagonal = bitboards[color + 'B'] | queens
+        for square in squares_of(squares & ~attacked):
+            if KNIGHT_ATTACKS[square] & knights or \
+                    (orthogonal and rook_attacks(square, occupied) & orthogonal) or \
+                    (diagonal and bishop_attacks(square, occupied) & diagonal):
+                attacked |= 1 << square
+        return attacked
 
 
 # Class for defining a move
@@ -520,22 +983,46 @@ class PieceMove:
     files_to_cols = {"h": 7, "g": 6, "f": 5, "e": 4, "d": 3, "c": 2, "b": 1, "a": 0}
     cols_to_files = {v: k for k, v in files_to_cols.items()}
 
-    def __init__(self, start_sq, end_sq, board, en_passant_possible=False, is_castle=False):
-        self.start_rank = start_sq[0]
-        self.start_file = start_sq[1]
-        self.end_rank = end_sq[0]
-        self.end_file = end_sq[1]
-        self.piece_moved = board[self.start_rank][self.start_file]
-        self.piece_captured = board[self.end_rank][self.end_file]
+    def __init__(self, start_sq, end_sq, board, en_passant_possible=False, is_castle=False, promotion_piece='Q'):
+        start = start_sq[0] * 8 + start_sq[1]
+        end = end_sq[0] * 8 + end_sq[1]
+        piece_moved = board[start_sq[0]][start_sq[1]]
+        move_code = start | end << 6 | MOVED_CODES[piece_moved]
+        if en_passant_possible:
+            move_code |= EN_PASSANT_MOVE << 12 | CAPTURED_CODES['wp' if piece_moved == 'bp' else 'bp']
+        else:
+            move_code |= CAPTURED_CODES[board[end_sq[0]][end_sq[1]]]
+        if is_castle:
+            move_code |= CASTLE_MOVE << 12
+        elif (piece_moved == 'wp' and end_sq[0] == 0) or (piece_moved == 'bp' and end_sq[0] == 7):
+            move_code |= PROMOTION_CODES[PROMOTION_PIECES.index(promotion_piece)]
+        self.set_move_code(move_code)
+
+    # Builds the move object for a packed move code, for moves leaving the engine for the UI, logs and notation
+    @classmethod
+    def from_move_code(cls, move_code):
+        piecemove = cls.__new__(cls)
+        piecemove.set_move_code(move_code)
+        return piecemove
+
+    # Fills in the readable fields from a packed move code
+    def set_move_code(self, move_code):
+        self.move_code = move_code
+        self.start_rank, self.start_file = divmod(move_code & 63, 8)
+        self.end_rank, self.end_file = divmod((move_code >> 6) & 63, 8)
+        self.piece_moved = MOVED_PIECES[(move_code >> 16) & 15]
+        self.piece_captured = CAPTURED_PIECES[move_code >> 20]
+        kind = (move_code >> 12) & 3
         # Sort of like a hash map for pieces
         self.move_id = self.start_rank * 1000 + self.start_file * 100 + self.end_rank * 10 + self.end_file
-        self.is_pawn_promotion = ((self.piece_moved == 'wp' and self.end_rank == 0) or (
-                self.piece_moved == 'bp' and self.end_rank == 7))
-        self.is_en_passant = en_passant_possible
-        if self.is_en_passant:
-            self.piece_captured = 'wp' if self.piece_moved == 'bp' else 'bp'
+        self.is_pawn_promotion = kind == PROMOTION_MOVE
+        self.promotion_piece = PROMOTION_PIECES[(move_code >> 14) & 3] if self.is_pawn_promotion else None
+        # Underpromotions get their own ids, a queen promotion keeps the plain id that a two click move produces
+        if self.is_pawn_promotion:
+            self.move_id += ((move_code >> 14) & 3) * 10000
+        self.is_en_passant = kind == EN_PASSANT_MOVE
         self.is_capture = self.piece_captured != ".."
-        self.is_castle_move = is_castle
+        self.is_castle_move = kind == CASTLE_MOVE
 
     def __eq__(self, other):
         if isinstance(other, PieceMove):
@@ -548,6 +1035,8 @@ class PieceMove:
         end_square = self.get_rank_and_file(self.end_rank, self.end_file)
         # Dealing with pawn moves and captures
         if self.piece_moved[1] == 'p':
+            if self.is_pawn_promotion:
+                end_square += "=" + self.promotion_piece
             if self.is_capture:
                 return self.cols_to_files[self.start_file] + "x" + end_square
             else:
@@ -558,9 +1047,13 @@ class PieceMove:
             move_string += 'x'
         return move_string + end_square
 
+    # Coordinate notation, e.g. e2e4 or e7e8q
     def get_chess_notation(self):
-        return self.get_rank_and_file(self.start_rank, self.start_file) + self.get_rank_and_file(self.end_file,
-                                                                                                 self.end_file)
+        notation = self.get_rank_and_file(self.start_rank, self.start_file) + self.get_rank_and_file(self.end_rank,
+                                                                                                     self.end_file)
+        if self.is_pawn_promotion:
+            notation += self.promotion_piece.lower()
+        return notation
 
     def get_rank_and_file(self, r, c):
         return self.cols_to_files[c] + self.rows_to_ranks[r]
@@ -572,3 +1065,12 @@ class CastleRights:
         self.bks = bks
         self.wqs = wqs
         self.bqs = bqs
+
+    # Packs the four rights into a number from 0 to 15
+    def index(self):
+        return self.wks | self.bks << 1 | self.wqs << 2 | self.bqs << 3
+
+    @classmethod
+    def from_index(cls, index):
+        return cls(bool(index & WHITE_KING_SIDE), bool(index & BLACK_KING_SIDE), bool(index & WHITE_QUEEN_SIDE),
+                   bool(index & BLACK_QUEEN_SIDE))
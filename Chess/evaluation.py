@@ -0,0 +1,78 @@
+""" Piece values and piece-square tables shared by the engine's incremental score and the AI's evaluation """
+
+piece_scores = {'p': 1, 'R': 5, 'N': 3, 'B': 3, 'Q': 9, 'K': 0}
+knight_scores = [[1, 1, 1, 1, 1, 1, 1, 1],
+                 [1, 2, 2, 2, 2, 2, 2, 1],
+                 [1, 2, 3, 3, 3, 3, 2, 1],
+                 [1, 2, 3, 4, 4, 3, 2, 1],
+                 [1, 2, 3, 4, 4, 3, 2, 1],
+                 [1, 2, 3, 3, 3, 3, 2, 1],
+                 [1, 2, 2, 2, 2, 2, 2, 1],
+                 [1, 1, 1, 1, 1, 1, 1, 1]]
+bishop_scores = [[4, 3, 2, 1, 1, 2, 3, 4],
+                 [3, 4, 3, 2, 2, 3, 4, 3],
+                 [2, 3, 4, 3, 3, 4, 3, 2],
+                 [1, 2, 3, 4, 4, 3, 2, 1],
+                 [1, 2, 4, 4, 4, 3, 2, 1],
+                 [2, 3, 4, 3, 3, 4, 3, 2],
+                 [3, 4, 3, 2, 2, 3, 4, 3],
+                 [4, 3, 2, 1, 1, 2, 3, 4]]
+queen_scores = [[1, 1, 1, 3, 1, 1, 1, 1],
+                [1, 2, 3, 3, 3, 1, 1, 1],
+                [1, 4, 3, 3, 3, 4, 2, 1],
+                [1, 2, 3, 3, 3, 2, 2, 1],
+                [1, 2, 3, 3, 3, 2, 2, 1],
+                [1, 4, 3, 3, 3, 4, 2, 1],
+                [1, 1, 2, 3, 3, 1, 1, 1],
+                [1, 1, 1, 3, 1, 1, 1, 1]]
+rook_scores = [[4, 3, 4, 4, 4, 4, 3, 4],
+               [4, 4, 4, 4, 4, 4, 4, 4],
+               [1, 1, 2, 3, 3, 2, 1, 1],
+               [1, 2, 3, 4, 4, 3, 2, 1],
+               [1, 2, 3, 4, 4, 3, 2, 1],
+               [1, 1, 2, 2, 2, 2, 1, 1],
+               [4, 4, 4, 4, 4, 4, 4, 4],
+               [4, 3, 4, 4, 4, 4, 3, 4]]
+white_pawn_scores = [[9, 9, 9, 9, 9, 9, 9, 9],
+                     [8, 8, 8, 8, 8, 8, 8, 8],
+                     [5, 6, 6, 7, 7, 6, 6, 5],
+                     [2, 3, 3, 5, 5, 3, 3, 2],
+                     [1, 2, 3, 4, 4, 3, 2, 1],
+                     [1, 1, 2, 3, 3, 2, 1, 1],
+                     [1, 1, 1, 0, 0, 1, 1, 1],
+                     [0, 0, 0, 0, 0, 0, 0, 0]]
+
+black_pawn_scores = [[0, 0, 0, 0, 0, 0, 0, 0],
+                     [1, 1, 1, 0, 0, 1, 1, 1],
+                     [1, 1, 2, 3, 3, 2, 1, 1],
+                     [1, 2, 3, 4, 4, 3, 2, 1],
+                     [2, 3, 3, 5, 5, 3, 3, 2],
+                     [5, 6, 6, 7, 7, 6, 6, 5],
+                     [8, 8, 8, 8, 8, 8, 8, 8],
+                     [9, 9, 9, 9, 9, 9, 9, 9]]
+king_scores = [[1, 5, 2, 0, 5, 0, 7, 0],
+               [0, 0, 0, 0, 0, 0, 0, 0],
+               [0, 0, 0, 0, 0, 0, 0, 0],
+               [0, 0, 0, 0, 0, 0, 0, 0],
+               [0, 0, 0, 0, 0, 0, 0, 0],
+               [0, 0, 0, 0, 0, 0, 0, 0],
+               [0, 0, 0, 0, 0, 0, 0, 0],
+               [1, 5, 2, 0, 5, 0, 7, 0]]
+
+piece_position_scores = {"wp": white_pawn_scores, "bp": black_pawn_scores, "R": rook_scores, "N": knight_scores,
+                         "B": bishop_scores, "Q": queen_scores, "K": king_scores}
+
+
+# Value of every piece on every square in tenths of a pawn, positive for white and negative for black, so a score is
+# the sum over the pieces on the board and a move changes it by a few table lookups
+def build_piece_square_values():
+    values = {}
+    for color, sign in (('w', 1), ('b', -1)):
+        for piece in ('p', 'R', 'N', 'B', 'Q', 'K'):
+            table = piece_position_scores[color + piece if piece == 'p' else piece]
+            values[color + piece] = [sign * (piece_scores[piece] * 10 + table[square // 8][square % 8])
+                                     for square in range(64)]
+    return values
+
+
+PIECE_SQUARE_VALUES = build_piece_square_values()
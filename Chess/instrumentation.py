@@ -0,0 +1,140 @@
+""" Timing and statistics collection for the search, written out as JSON lines """
+
+import json
+import time
+
+# Parts of the search that timing splits the search time into, whatever is left over is counted as other
+TIMED_PARTS = ("movegen", "make_undo", "eval")
+
+
+# Stands in for a BoardState during a timed search, passing everything through to the real board and adding the
+# time spent generating moves and making and undoing them to timings. Only used while timing is on, so an untimed
+# search calls the board directly and pays nothing for it
+class TimedBoardState:
+    def __init__(self, bs, timings):
+        object.__setattr__(self, "board_state", bs)
+        object.__setattr__(self, "timings", timings)
+
+    def __getattr__(self, name):
+        return getattr(self.board_state, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.board_state, name, value)
+
+    def make_move_code(self, move):
+        start_time = time.perf_counter()
+        self.board_state.make_move_code(move)
+        self.timings["make_undo"] += time.perf_counter() - start_time
+
+    def undo_move(self):
+        start_time = time.perf_counter()
+        self.board_state.undo_move()
+        self.timings["make_undo"] += time.perf_counter() - start_time
+
+    def make_null_move(self):
+        start_time = time.perf_counter()
+        self.board_state.make_null_move()
+        self.timings["make_undo"] += time.perf_counter() - start_time
+
+    def undo_null_move(self):
+        start_time = time.perf_counter()
+        self.board_state.undo_null_move()
+        self.timings["make_undo"] += time.perf_counter() - start_time
+
+    def get_valid_move_codes(self, buffer=None):
+        start_time = time.perf_counter()
+        moves = self.board_state.get_valid_move_codes(buffer)
+        self.timings["movegen"] += time.perf_counter() - start_time
+        return moves
+
+    def get_capture_move_codes(self, buffer=None):
+        start_time = time.perf_counter()
+        moves = self.board_state.get_capture_move_codes(buffer)
+        self.timings["movegen"] += time.perf_counter() - start_time
+        return moves
+
+    def has_legal_move(self):
+        start_time = time.perf_counter()
+        found = self.board_state.has_legal_move()
+        self.timings["movegen"] += time.perf_counter() - start_time
+        return found
+
+    # The staged generator does its work whenever the next move is asked for, so each step is timed on its own
+    def generate_moves(self, hash_move=None, order_captures=None, order_quiets=None, buffer=None):
+        moves = self.board_state.generate_moves(hash_move, order_captures, order_quiets, buffer)
+        timings = self.timings
+        while True:
+            start_time = time.perf_counter()
+            move = next(moves, None)
+            timings["movegen"] += time.perf_counter() - start_time
+            if move is None:
+                return
+            yield move
+
+
+# Wraps an evaluation function so its time is added to timings
+def timed_evaluation(evaluate, timings):
+    def timed(bs):
+        start_time = time.perf_counter()
+        score = evaluate(bs)
+        timings["eval"] += time.perf_counter() - start_time
+        return score
+
+    return timed
+
+
+# Effective branching factor, the growth in nodes from one completed iteration to the next
+def effective_branching_factor(iteration_nodes):
+    if len(iteration_nodes) < 2 or iteration_nodes[-2] == 0:
+        return None
+    return round(iteration_nodes[-1] / iteration_nodes[-2], 3)
+
+
+# Collects the statistics of every search in a game and sums them up
+class GameStats:
+    def __init__(self):
+        self.moves = []
+
+    # Adds the statistics of one search, as given by Searcher.statistics()
+    def add(self, move_stats):
+        self.moves.append(move_stats)
+
+    def summary(self):
+        nodes = sum(stats["nodes"] for stats in self.moves)
+        seconds = sum(stats["seconds"] for stats in self.moves)
+        tt_probes = sum(stats["tt_probes"] for stats in self.moves)
+        cutoffs_by_index = [0] * max([len(stats["cutoffs_by_index"]) for stats in self.moves] + [0])
+        for stats in self.moves:
+            for i, count in enumerate(stats["cutoffs_by_index"]):
+                cutoffs_by_index[i] += count
+        branching_factors = [stats["ebf"] for stats in self.moves if stats["ebf"] is not None]
+        summary = {"summary": True, "moves": len(self.moves), "nodes": nodes,
+                   "qnodes": sum(stats["qnodes"] for stats in self.moves), "seconds": round(seconds, 4),
+                   "nps": int(nodes / seconds) if seconds > 0 else 0, "tt_probes": tt_probes,
+                   "tt_hits": sum(stats["tt_hits"] for stats in self.moves),
+                   "cutoffs_by_index": cutoffs_by_index,
+                   "null_window_research_rate": total_rate(self.moves, "null_window_researches",
+                                                           "null_window_searches"),
+                   "aspiration_research_rate": total_rate(self.moves, "aspiration_researches", "aspiration_searches"),
+                   "mean_ebf": round(sum(branching_factors) / len(branching_factors), 3) if branching_factors else None}
+        timed = [stats["time"] for stats in self.moves if "time" in stats]
+        if timed:
+            summary["time"] = {part: round(sum(times[part] for times in timed), 4) for part in timed[0]}
+        return summary
+
+    # One JSON line per search followed by the summary line
+    def json_lines(self):
+        return [json.dumps(stats) for stats in self.moves] + [json.dumps(self.summary())]
+
+
+# Share of a counter over another, summed over every search
+def total_rate(moves, part, whole):
+    whole_count = sum(stats[whole] for stats in moves)
+    return round(sum(stats[part] for stats in moves) / whole_count, 4) if whole_count else 0.0
+
+
+# Appends records to a JSON lines file
+def write_json_lines(path, records):
+    with open(path, "a") as file:
+        for record in records:
+            file.write((record if isinstance(record, str) else json.dumps(record)) + "\n")
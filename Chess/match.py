@@ -0,0 +1,379 @@
+""" Plays matches between two engine configurations on a pool of worker processes, without a display, and reports
+the result with an Elo estimate and a sequential probability ratio test """
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import analysis
+import chessAI
+import engine
+import tablebase
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Kinds of player, the first two are the simple movers chessmain.py can also pick
+PLAYERS = ("random", "greedy", "search")
+# Settings an engine configuration can give, with how each is read from the command line. movetime is in seconds
+ENGINE_SETTINGS = {"name": str, "depth": int, "movetime": float, "nodes": int, "hash": int,
+                   "null_move_pruning": lambda value: value.lower() in ("1", "true", "yes", "on"),
+                   "late_move_reductions": lambda value: value.lower() in ("1", "true", "yes", "on")}
+# Openings played when no suite is given, each from both sides
+DEFAULT_OPENINGS = ["e2e4 e7e5 g1f3 b8c6", "e2e4 c7c5 g1f3 d7d6", "e2e4 e7e6 d2d4 d7d5", "e2e4 c7c6 d2d4 d7d5",
+                    "d2d4 d7d5 c2c4 e7e6", "d2d4 g8f6 c2c4 g7g6", "c2c4 e7e5 b1c3 g8f6", "g1f3 d7d5 g2g3 g8f6"]
+# Adjudication, a game is given to a side once both engines agree it is winning by resign_score pawns for
+# resign_moves moves each, and drawn once they agree it is within draw_score of level for draw_moves moves each after
+# draw_start plies. Games still going after max_plies are drawn
+RESIGN_SCORE = 9.0
+RESIGN_MOVES = 3
+DRAW_SCORE = 0.1
+DRAW_MOVES = 8
+DRAW_START = 80
+MAX_PLIES = 400
+# Plies without a capture or pawn move that draw the game
+FIFTY_MOVE_PLIES = 100
+# Elo bounds and error rates of the sequential probability ratio test
+SPRT_ELO0 = 0.0
+SPRT_ELO1 = 10.0
+SPRT_ALPHA = 0.05
+SPRT_BETA = 0.05
+
+# Searchers of a worker process by side and configuration, kept between games so their tables are allocated once
+worker_searchers = {}
+worker_tables = None
+
+
+# Reads an engine configuration written as player[:setting=value,...], such as search:depth=3,late_move_reductions=no
+def parse_engine(text):
+    player, _, settings = text.partition(":")
+    if player not in PLAYERS:
+        raise ValueError("Unknown player: " + player)
+    config = {"player": player, "name": text}
+    for setting in filter(None, settings.split(",")):
+        key, _, value = setting.partition("=")
+        if key not in ENGINE_SETTINGS or not value:
+            raise ValueError("Unknown engine setting: " + setting)
+        config[key] = ENGINE_SETTINGS[key](value)
+    return config
+
+
+# Reads an opening suite, one opening per line, either a FEN or EPD position or moves played from the start. A
+# position that can't be set up raises ValueError, before any game starts
+def read_openings(lines):
+    openings = []
+    for line in lines:
+        line = line.split("#")[0].strip()
+        if not line:
+            continue
+        if "/" in line:
+            # EPD operations are dropped, FEN move counters are kept
+            fen, _ = analysis.parse_position(line)
+            engine.BoardState(fen)
+            openings.append({"fen": fen, "moves": []})
+        else:
+            openings.append({"fen": engine.START_FEN, "moves": line.split()})
+    return openings
+
+
+def init_worker(tablebase_dir):
+    global worker_tables
+    worker_tables = None if tablebase_dir is None else tablebase.Tablebase(tablebase_dir)
+
+
+# The searcher for a side playing a configuration in this worker, its tables cleared so every game starts fresh
+# Each side has its own, so neither engine ever sees the other's transposition table or move ordering history
+def get_searcher(config, side):
+    key = (side, tuple(sorted(config.items())))
+    searcher = worker_searchers.get(key)
+    if searcher is None:
+        searcher = chessAI.Searcher(depth=config.get("depth", chessAI.DEPTH),
+                                    hash_size_mb=config.get("hash", chessAI.HASH_SIZE_MB),
+                                    null_move_pruning=config.get("null_move_pruning", chessAI.NULL_MOVE_PRUNING),
+                                    late_move_reductions=config.get("late_move_reductions",
+                                                                    chessAI.LATE_MOVE_REDUCTIONS))
+        worker_searchers[key] = searcher
+    searcher.transposition_table.clear()
+    return searcher
+
+
+# Picks a move for the configuration, returns it with the score for the side to move, None for players that don't
+# score positions, and the nodes searched
+def choose_move(config, searcher, bs, valid_moves):
+    if config["player"] == "random":
+        return chessAI.find_random_moves(valid_moves), None, 0
+    if config["player"] == "greedy":
+        # The greedy mover finds nothing when every move gets it mated
+        return chessAI.find_greedy_move(bs, valid_moves) or chessAI.find_random_moves(valid_moves), None, 0
+    limited = "movetime" in config or "nodes" in config
+    move = searcher.find_best_move(bs, valid_moves, config.get("movetime"), config.get("nodes"),
+                                   config.get("depth") if limited else None)
+    if move is None:
+        return chessAI.find_random_moves(valid_moves), None, searcher.nodes
+    # Book and table moves come without a search score
+    score = None if searcher.book_move or searcher.tablebase_move else searcher.best_score
+    return move, score, searcher.nodes
+
+
+# Only kings, or kings and a single minor piece, can't mate
+def insufficient_material(bs):
+    for piece in ("wp", "bp", "wR", "bR", "wQ", "bQ"):
+        if bs.bitboards[piece]:
+            return False
+    minors = bs.bitboards["wN"] | bs.bitboards["bN"] | bs.bitboards["wB"] | bs.bitboards["bB"]
+    return minors & (minors - 1) == 0
+
+
+# Plays one game between two configurations from an opening, returns its record. Runs in a worker process
+def play_game(game, opening, white, black, adjudication, seed):
+    random.seed(seed)
+    start_time = time.perf_counter()
+    bs = engine.BoardState(opening["fen"])
+    fields = opening["fen"].split()
+    fifty_move_plies = int(fields[4]) if len(fields) > 4 and fields[4].isdigit() else 0
+    for text in opening["moves"]:
+        move = bs.parse_move(text)
+        fifty_move_plies = 0 if engine.move_piece(move)[1] == 'p' or engine.move_captured(move) != ".." \
+            else fifty_move_plies + 1
+        bs.make_move_code(move)
+    configs = (white, black)
+    searchers = [get_searcher(config, side) if config["player"] == "search" else None
+                 for side, config in enumerate(configs)]
+    # Times each position has been reached, for threefold repetition
+    positions = {bs.zobrist_key: 1}
+    nodes = [0, 0]
+    moves = []
+    # Scores from white's side of the last moves, for adjudication
+    white_scores = []
+    result = None
+    reason = None
+    while result is None:
+        valid_moves = bs.get_valid_moves()
+        if not valid_moves:
+            if bs.check_mate:
+                result, reason = ("0-1" if bs.white_to_move else "1-0"), "checkmate"
+            else:
+                result, reason = "1/2-1/2", "stalemate"
+            break
+        if positions[bs.zobrist_key] >= 3:
+            result, reason = "1/2-1/2", "repetition"
+        elif fifty_move_plies >= FIFTY_MOVE_PLIES:
+            result, reason = "1/2-1/2", "fifty moves"
+        elif insufficient_material(bs):
+            result, reason = "1/2-1/2", "insufficient material"
+        elif len(moves) >= adjudication["max_plies"]:
+            result, reason = "1/2-1/2", "max plies"
+        elif worker_tables is not None:
+            value = worker_tables.probe(bs)
+            if value is not None:
+                reason = "tablebase"
+                if value[0] == tablebase.DRAW:
+                    result = "1/2-1/2"
+                else:
+                    result = "1-0" if (value[0] == tablebase.WIN) == bs.white_to_move else "0-1"
+        if result is None:
+            result = adjudicate(white_scores, len(moves), adjudication)
+            if result is not None:
+                reason = "adjudication"
+        if result is not None:
+            break
+        side = 0 if bs.white_to_move else 1
+        move, score, move_nodes = choose_move(configs[side], searchers[side], bs, valid_moves)
+        nodes[side] += move_nodes
+        white_scores.append(None if score is None else (score if side == 0 else -score))
+        fifty_move_plies = 0 if move.piece_moved[1] == 'p' or move.piece_captured != ".." else fifty_move_plies + 1
+        moves.append(move.get_chess_notation())
+        bs.make_move_code(move.move_code)
+        positions[bs.zobrist_key] = positions.get(bs.zobrist_key, 0) + 1
+    return {"game": game, "opening": opening["fen"] if not opening["moves"] else " ".join(opening["moves"]),
+            "white": white["name"], "black": black["name"], "result": result, "reason": reason, "plies": len(moves),
+            "moves": moves, "white_nodes": nodes[0], "black_nodes": nodes[1],
+            "seconds": round(time.perf_counter() - start_time, 3)}
+
+
+# The adjudicated result from the scores both engines gave, None to play on
+def adjudicate(white_scores, plies, adjudication):
+    resign_plies = 2 * adjudication["resign_moves"]
+    if resign_plies and len(white_scores) >= resign_plies:
+        recent = white_scores[-resign_plies:]
+        if None not in recent:
+            if min(recent) >= adjudication["resign_score"]:
+                return "1-0"
+            if max(recent) <= -adjudication["resign_score"]:
+                return "0-1"
+    draw_plies = 2 * adjudication["draw_moves"]
+    if draw_plies and plies >= adjudication["draw_start"] and len(white_scores) >= draw_plies:
+        recent = white_scores[-draw_plies:]
+        if None not in recent and max(abs(score) for score in recent) <= adjudication["draw_score"]:
+            return "1/2-1/2"
+    return None
+
+
+# Class for the running score of the first engine against the second
+class MatchScore:
+    def __init__(self):
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+
+    # Adds a game, first_white says whether the first engine had white
+    def add(self, result, first_white):
+        if result == "1/2-1/2":
+            self.draws += 1
+        elif (result == "1-0") == first_white:
+            self.wins += 1
+        else:
+            self.losses += 1
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    # Mean and variance of the first engine's score per game
+    def score_and_variance(self):
+        games = self.games
+        score = (self.wins + self.draws / 2) / games
+        variance = (self.wins * (1 - score) ** 2 + self.draws * (0.5 - score) ** 2 + self.losses * score ** 2) / games
+        return score, variance
+
+    # Elo difference of the first engine over the second with its 95% error margin, None until both are known
+    def elo(self):
+        if self.games == 0:
+            return None, None
+        score, variance = self.score_and_variance()
+        if score in (0.0, 1.0):
+            return None, None
+        margin = 1.96 * math.sqrt(variance / self.games)
+        low, high = max(score - margin, 1e-6), min(score + margin, 1 - 1e-6)
+        return elo_from_score(score), (elo_from_score(high) - elo_from_score(low)) / 2
+
+    # Log likelihood ratio of the hypothesis that the first engine is elo1 stronger over the one that it is elo0
+    # stronger, from the normal approximation to the game results, which needs at least two different results
+    def log_likelihood_ratio(self, elo0, elo1):
+        if self.games == 0:
+            return 0.0
+        score, variance = self.score_and_variance()
+        if variance == 0:
+            return 0.0
+        score0, score1 = score_from_elo(elo0), score_from_elo(elo1)
+        return self.games * (score1 - score0) * (2 * score - score0 - score1) / (2 * variance)
+
+    def summary(self, sprt=None):
+        elo, margin = self.elo()
+        summary = {"summary": True, "games": self.games, "wins": self.wins, "draws": self.draws,
+                   "losses": self.losses,
+                   "score": round((self.wins + self.draws / 2) / self.games, 4) if self.games else None,
+                   "elo": None if elo is None else round(elo, 1),
+                   "elo_margin": None if margin is None else round(margin, 1)}
+        if sprt is not None:
+            summary["sprt"] = sprt_status(self, *sprt)
+        return summary
+
+
+def elo_from_score(score):
+    return -400 * math.log10(1 / score - 1)
+
+
+def score_from_elo(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+# The test's state, H1 once the first engine is shown elo1 stronger, H0 once it is shown at most elo0 stronger
+def sprt_status(match_score, elo0, elo1, alpha, beta):
+    llr = match_score.log_likelihood_ratio(elo0, elo1)
+    lower, upper = math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+    state = "H1" if llr >= upper else "H0" if llr <= lower else "continue"
+    return {"elo0": elo0, "elo1": elo1, "llr": round(llr, 3), "lower": round(lower, 3), "upper": round(upper, 3),
+            "state": state}
+
+
+# Plays pairs of games from each opening with colors swapped, on a pool of worker processes, and yields each
+# game's record as it finishes followed by the summary. Only a few games per worker are queued at once so a test that
+# is decided stops early
+def run_match(first, second, games, openings, workers=DEFAULT_WORKERS, adjudication=None, sprt=None,
+              tablebase_dir=None, seed=None):
+    if adjudication is None:
+        adjudication = {"resign_score": RESIGN_SCORE, "resign_moves": RESIGN_MOVES, "draw_score": DRAW_SCORE,
+                        "draw_moves": DRAW_MOVES, "draw_start": DRAW_START, "max_plies": MAX_PLIES}
+    seeds = random.Random(seed)
+    match_score = MatchScore()
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(tablebase_dir,)) as pool:
+        pending = {}
+        next_game = 0
+        decided = False
+        while pending or (next_game < games and not decided):
+            while next_game < games and not decided and len(pending) < 2 * workers:
+                opening = openings[(next_game // 2) % len(openings)]
+                first_white = next_game % 2 == 0
+                white, black = (first, second) if first_white else (second, first)
+                future = pool.submit(play_game, next_game, opening, white, black, adjudication, seeds.random())
+                pending[future] = first_white
+                next_game += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                first_white = pending.pop(future)
+                record = future.result()
+                match_score.add(record["result"], first_white)
+                yield record
+                if sprt is not None and sprt_status(match_score, *sprt)["state"] != "continue":
+                    decided = True
+    yield match_score.summary(sprt)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plays a match between two engine configurations, as JSON lines")
+    parser.add_argument("first", type=parse_engine, help="engine as player[:setting=value,...], the player one of " +
+                        ", ".join(PLAYERS) + " and the settings any of " + ", ".join(ENGINE_SETTINGS))
+    parser.add_argument("second", type=parse_engine, help="engine it plays against, the same way")
+    parser.add_argument("--games", type=int, default=100, help="games to play, in pairs with colors swapped")
+    parser.add_argument("--openings", help="file of openings, a FEN or EPD position or a list of moves per line")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes")
+    parser.add_argument("--output", help="JSON lines file the games and summary are appended to as they finish")
+    parser.add_argument("--tablebase", help="directory of endgame tables to adjudicate table positions with")
+    parser.add_argument("--resign-score", type=float, default=RESIGN_SCORE, help="pawns, 0 to never adjudicate wins")
+    parser.add_argument("--resign-moves", type=int, default=RESIGN_MOVES)
+    parser.add_argument("--draw-score", type=float, default=DRAW_SCORE)
+    parser.add_argument("--draw-moves", type=int, default=DRAW_MOVES, help="0 to never adjudicate draws")
+    parser.add_argument("--draw-start", type=int, default=DRAW_START, help="plies before draws can be adjudicated")
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--sprt", nargs=2, type=float, metavar=("ELO0", "ELO1"),
+                        help="stop once a sequential probability ratio test of ELO0 against ELO1 is decided")
+    parser.add_argument("--sprt-alpha", type=float, default=SPRT_ALPHA)
+    parser.add_argument("--sprt-beta", type=float, default=SPRT_BETA)
+    parser.add_argument("--seed", type=int, help="seed for the engines' random choices")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.openings is None:
+            openings = read_openings(DEFAULT_OPENINGS)
+        else:
+            with open(args.openings) as lines:
+                openings = read_openings(lines)
+    except (ValueError, IndexError, KeyError) as error:
+        parser.error(str(error))
+    if args.first["name"] == args.second["name"]:
+        args.second["name"] += " (2)"
+    adjudication = {"resign_score": args.resign_score if args.resign_score > 0 else math.inf,
+                    "resign_moves": args.resign_moves, "draw_score": args.draw_score,
+                    "draw_moves": args.draw_moves, "draw_start": args.draw_start, "max_plies": args.max_plies}
+    sprt = None if args.sprt is None else (args.sprt[0], args.sprt[1], args.sprt_alpha, args.sprt_beta)
+    output = None if args.output is None else open(args.output, "a")
+    try:
+        for record in run_match(args.first, args.second, args.games, openings, args.workers, adjudication, sprt,
+                                args.tablebase, args.seed):
+            line = json.dumps(record)
+            print(line, flush=True)
+            if output is not None:
+                output.write(line + "\n")
+                output.flush()
+    finally:
+        if output is not None:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
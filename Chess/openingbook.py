@@ -0,0 +1,192 @@
+""" Builds an opening book from games and looks moves up in it straight from the file through a memory map """
+
+import argparse
+import json
+import mmap
+import os
+import random
+import re
+import struct
+import sys
+
+import engine
+
+# A book is a file of fixed size records, a position key, a move code and a weight, sorted by key and then by weight
+# from high to low. Keys are BoardState.zobrist_key, so a book only works with the engine's own hashing
+RECORD = struct.Struct("<QIH")
+KEY = struct.Struct("<Q")
+MAX_WEIGHT = 0xFFFF
+# Plies of each game that go into the book
+DEFAULT_MAX_PLY = 20
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+# Comments, variations, move numbers and numeric annotations in PGN movetext, none of which are moves
+PGN_NOISE = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+|\d+\.+")
+
+
+# Splits PGN text into the moves of each game, ignoring tags, comments and variations
+def read_pgn_games(lines):
+    moves = []
+    variation_depth = 0
+    for line in lines:
+        if line.startswith("["):
+            if moves:
+                yield moves
+                moves = []
+            continue
+        for token in PGN_NOISE.sub(" ", line).replace("(", " ( ").replace(")", " ) ").split():
+            if token == "(":
+                variation_depth += 1
+            elif token == ")":
+                variation_depth -= 1
+            elif variation_depth > 0:
+                continue
+            elif token in RESULTS:
+                if moves:
+                    yield moves
+                moves = []
+            else:
+                moves.append(token)
+    if moves:
+        yield moves
+
+
+# One game per line, moves in coordinate notation or SAN separated by spaces
+def read_move_lists(lines):
+    for line in lines:
+        moves = [token for token in PGN_NOISE.sub(" ", line).split() if token not in RESULTS]
+        if moves:
+            yield moves
+
+
+# Plays through each game up to max_ply and counts how often each move was played in each position. A game stops
+# counting at its first move that can't be read, returns the sorted records with the number of games read and cut short
+def build_book(games, max_ply=DEFAULT_MAX_PLY, min_count=1):
+    counts = {}
+    games_read = 0
+    games_cut = 0
+    for moves in games:
+        games_read += 1
+        bs = engine.BoardState()
+        for text in moves[:max_ply]:
+            try:
+                move = bs.parse_move(text)
+            except ValueError:
+                games_cut += 1
+                break
+            entry = (bs.zobrist_key, move)
+            counts[entry] = counts.get(entry, 0) + 1
+            bs.make_move_code(move)
+    records = [(key, move, min(count, MAX_WEIGHT)) for (key, move), count in counts.items() if count >= min_count]
+    records.sort(key=lambda record: (record[0], -record[2], record[1]))
+    return records, games_read, games_cut
+
+
+def write_book(path, records):
+    with open(path, "wb") as file:
+        for record in records:
+            file.write(RECORD.pack(*record))
+
+
+# Class for reading a book file, which is memory mapped and binary searched so it is never loaded into memory whole
+class OpeningBook:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if size % RECORD.size:
+            self.file.close()
+            raise ValueError("Not an opening book: " + path)
+        # An empty file can't be mapped, and has nothing to find anyway
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.count = size // RECORD.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    # The (move code, weight) pairs stored for a position key, highest weight first
+    def entries(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.data, middle * RECORD.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        entries = []
+        while low < self.count:
+            record_key, move, weight = RECORD.unpack_from(self.data, low * RECORD.size)
+            if record_key != key:
+                break
+            entries.append((move, weight))
+            low += 1
+        return entries
+
+    # A book move for the position as a move code, picked at random by weight, or the heaviest one when random_choice
+    # is off. Moves that aren't legal, from a key collision or another engine's book, are skipped. None when out of book
+    def choose_move(self, bs, random_choice=True):
+        entries = self.entries(bs.zobrist_key)
+        if not entries:
+            return None
+        legal_moves = set(bs.get_valid_move_codes())
+        entries = [(move, weight) for move, weight in entries if move in legal_moves and weight > 0]
+        if not entries:
+            return None
+        if not random_choice:
+            return entries[0][0]
+        return random.choices([move for move, _ in entries], [weight for _, weight in entries])[0]
+
+
+def read_lines(path):
+    if path == "-":
+        return sys.stdin
+    return open(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Builds and probes opening books")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="compile games into a book, PGN for .pgn files, else one game per line")
+    build.add_argument("inputs", nargs="+", help="game files, - for PGN on standard input")
+    build.add_argument("-o", "--output", required=True, help="book file to write")
+    build.add_argument("--max-ply", type=int, default=DEFAULT_MAX_PLY, help="plies of each game to add")
+    build.add_argument("--min-count", type=int, default=1, help="drop moves played fewer times than this")
+    probe = commands.add_parser("probe", help="list the book moves for a position, as JSON lines")
+    probe.add_argument("book", help="book file")
+    probe.add_argument("--fen", default=engine.START_FEN, help="position to look up")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        def games():
+            for path in args.inputs:
+                with read_lines(path) as lines:
+                    pgn = path == "-" or path.lower().endswith(".pgn")
+                    yield from (read_pgn_games(lines) if pgn else read_move_lists(lines))
+
+        records, games_read, games_cut = build_book(games(), args.max_ply, args.min_count)
+        write_book(args.output, records)
+        print(json.dumps({"book": args.output, "games": games_read, "games_cut_short": games_cut,
+                          "positions": len({record[0] for record in records}), "records": len(records),
+                          "bytes": len(records) * RECORD.size}))
+    else:
+        bs = engine.BoardState(args.fen)
+        with OpeningBook(args.book) as book:
+            for move, weight in book.entries(bs.zobrist_key):
+                piecemove = engine.PieceMove.from_move_code(move)
+                print(json.dumps({"move": str(piecemove), "notation": piecemove.get_chess_notation(),
+                                  "weight": weight}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+""" Searches for the best move on several processes at once and measures the speedup over a single process """
+
+import argparse
+import ctypes
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+
+import chessAI
+import engine
+import transposition
+
+# Root splitting hands each root move to a free worker, with the best score found so far as its alpha. Lazy SMP runs
+# the whole search on every worker at once, each in its own move order, sharing one transposition table
+ROOT_SPLIT = "split"
+LAZY_SMP = "lazy"
+MODES = (ROOT_SPLIT, LAZY_SMP)
+DEFAULT_WORKERS = os.cpu_count() or 1
+BENCHMARK_POSITIONS = [
+    engine.START_FEN,
+    "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+]
+
+# State of a worker process, set up once when the pool starts it
+worker_searcher = None
+shared_alpha = None
+worker_board = None
+worker_snapshot = None
+
+
+# Gives a worker a searcher on the shared transposition table and stop flag, and keeps the shared alpha
+def init_worker(table_array, alpha, stop):
+    global worker_searcher, shared_alpha
+    worker_searcher = chessAI.Searcher(table=transposition.SharedTranspositionTable(array=table_array))
+    worker_searcher.stop_signal = stop
+    shared_alpha = alpha
+
+
+# The board for a snapshot, a worker keeps its board between tasks on the same position
+def get_worker_board(snapshot):
+    global worker_board, worker_snapshot
+    if snapshot != worker_snapshot:
+        worker_board = engine.BoardState.from_snapshot(snapshot)
+        worker_snapshot = snapshot
+    return worker_board
+
+
+# Worker task for root splitting, searches one root move with alpha raised to the best score any worker has found
+# Returns the move, its score, whether the score is exact rather than an upper bound, the line it starts, the nodes
+# searched and whether the search was stopped by a limit. The deadline is wall clock time since a task may wait in the
+# queue before it runs
+def search_root_move(snapshot, move, depth, age, principal_variation, deadline, node_limit):
+    searcher = worker_searcher
+    bs = get_worker_board(snapshot)
+    searcher.transposition_table.age = age
+    searcher.start_search(None if deadline is None else max(0.0, deadline - time.time()), node_limit)
+    searcher.root_depth = depth
+    searcher.principal_variation = principal_variation
+    turn = 1 if bs.white_to_move else -1
+    alpha = shared_alpha.value
+    bs.make_move_code(move)
+    score = -searcher.find_move_nega_max_alpha_beta(bs, None, depth - 1, -chessAI.CHECKMATE, -alpha, -turn, 1)
+    bs.undo_move()
+    if searcher.stopped:
+        return move, None, False, [], searcher.nodes, True
+    if score > alpha:
+        with shared_alpha.get_lock():
+            if score > shared_alpha.value:
+                shared_alpha.value = score
+    return move, score, score > alpha, [move] + searcher.pv_line(1), searcher.nodes, False
+
+
+# Worker task for Lazy SMP, a complete iterative deepening search seeded so each worker orders the root differently
+# Returns the depth completed, the best move code, its score and the nodes searched
+def search_lazy(snapshot, root_moves, max_depth, age, seed, time_limit, node_limit):
+    bs = get_worker_board(snapshot)
+    random.seed(seed)
+    searcher = worker_searcher
+    # find_best_move starts a new search on the table, which moves the age on by one
+    searcher.transposition_table.age = (age - 1) & 0xFF
+    move = searcher.find_best_move(bs, [engine.PieceMove.from_move_code(code) for code in root_moves], time_limit,
+                                   node_limit, max_depth)
+    return searcher.completed_depth, None if move is None else move.move_code, searcher.best_score, searcher.nodes
+
+
+# Class for searching on a pool of worker processes, which live until close() so later searches skip their startup
+class ParallelSearch:
+    def __init__(self, workers=DEFAULT_WORKERS, mode=ROOT_SPLIT, hash_size_mb=chessAI.HASH_SIZE_MB):
+        if mode not in MODES:
+            raise ValueError("Unknown parallel search mode: " + str(mode))
+        self.workers = workers
+        self.mode = mode
+        self.table = transposition.SharedTranspositionTable(hash_size_mb)
+        self.alpha = multiprocessing.Value(ctypes.c_double, -chessAI.CHECKMATE)
+        self.stop = multiprocessing.Value(ctypes.c_int, 0)
+        self.pool = ProcessPoolExecutor(workers, initializer=init_worker,
+                                        initargs=(self.table.array, self.alpha, self.stop))
+        # Results of the last search
+        self.nodes = 0
+        self.completed_depth = 0
+        self.best_score = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+    # Same limits and result as chessAI.find_best_move
+    def find_best_move(self, bs, valid_moves, time_limit=None, node_limit=None, max_depth=None):
+        if max_depth is None:
+            max_depth = chessAI.DEPTH if time_limit is None and node_limit is None else chessAI.MAX_DEPTH
+        root_moves = [move.move_code for move in valid_moves]
+        random.shuffle(root_moves)
+        self.table.new_search()
+        self.stop.value = 0
+        self.nodes = 0
+        self.completed_depth = 0
+        self.best_score = 0
+        if not root_moves:
+            return None
+        if self.mode == ROOT_SPLIT:
+            best_move = self.split_search(bs, root_moves, time_limit, node_limit, max_depth)
+        else:
+            best_move = self.lazy_search(bs, root_moves, time_limit, node_limit, max_depth)
+        if best_move is None:
+            return None
+        return engine.PieceMove.from_move_code(best_move)
+
+    # Iterative deepening with every iteration's root moves spread over the workers. The first move, the best of the
+    # previous iteration, is searched alone so the others start with its score as alpha
+    def split_search(self, bs, root_moves, time_limit, node_limit, max_depth):
+        snapshot = bs.snapshot()
+        start_time = time.perf_counter()
+        deadline = None if time_limit is None else time.time() + time_limit
+        best_move = None
+        principal_variation = []
+        for depth in range(1, max_depth + 1):
+            self.alpha.value = -chessAI.CHECKMATE
+            results = []
+            stopped = False
+            for batch in (root_moves[:1], root_moves[1:]):
+                if not batch:
+                    continue
+                nodes_left = None if node_limit is None else max(1, node_limit - self.nodes)
+                futures = [self.pool.submit(search_root_move, snapshot, move, depth, self.table.age,
+                                            principal_variation, deadline, nodes_left) for move in batch]
+                for future in futures:
+                    move, score, exact, line, nodes, move_stopped = future.result()
+                    self.nodes += nodes
+                    stopped = stopped or move_stopped
+                    results.append((score, exact, move, line))
+                if stopped or (node_limit is not None and self.nodes >= node_limit and depth > 1):
+                    stopped = True
+                    break
+            if stopped:
+                break
+            # An exact score beats an upper bound equal to it, and the moves are searched best first next iteration
+            results.sort(key=lambda result: (result[0], result[1]), reverse=True)
+            root_moves = [result[2] for result in results]
+            best_move = root_moves[0]
+            self.completed_depth = depth
+            self.best_score = results[0][0]
+            principal_variation = chessAI.keyed_line(bs, results[0][3])
+            if time_limit is not None and time.perf_counter() - start_time > time_limit / 2:
+                break
+            if len(root_moves) <= 1:
+                break
+        return best_move
+
+    # Every worker searches the whole tree, half of the helpers one ply deeper. Once the first worker finishes its
+    # depth the others are stopped, and the deepest completed result is used
+    def lazy_search(self, bs, root_moves, time_limit, node_limit, max_depth):
+        snapshot = bs.snapshot()
+        worker_nodes = None if node_limit is None else max(1, node_limit // self.workers)
+        futures = [self.pool.submit(search_lazy, snapshot, root_moves, min(max_depth + i % 2, chessAI.MAX_DEPTH),
+                                    self.table.age, i, time_limit, worker_nodes) for i in range(self.workers)]
+        wait(futures[:1])
+        self.stop.value = 1
+        best_move = None
+        for future in futures:
+            depth, move, score, nodes = future.result()
+            self.nodes += nodes
+            if move is not None and depth > self.completed_depth:
+                best_move = move
+                self.completed_depth = depth
+                self.best_score = score
+        return best_move
+
+
+# Times the single process search against each parallel mode at a fixed depth, the pools are started and warmed up
+# before the clock runs so only the search is timed
+def benchmark(fens, depth, workers):
+    searches = {mode: ParallelSearch(workers, mode) for mode in MODES}
+    try:
+        for search in searches.values():
+            warm_up = engine.BoardState()
+            search.find_best_move(warm_up, warm_up.get_valid_moves(), max_depth=1)
+        results = []
+        for fen in fens:
+            bs = engine.BoardState(fen)
+            searcher = chessAI.Searcher()
+            start_time = time.perf_counter()
+            move = searcher.find_best_move(bs, bs.get_valid_moves(), max_depth=depth)
+            single_seconds = time.perf_counter() - start_time
+            results.append({"fen": fen, "mode": "single", "workers": 1, "depth": depth, "move": str(move),
+                            "nodes": searcher.nodes, "seconds": round(single_seconds, 4), "speedup": 1.0})
+            for mode, search in searches.items():
+                search.table.clear()
+                start_time = time.perf_counter()
+                move = search.find_best_move(bs, bs.get_valid_moves(), max_depth=depth)
+                seconds = time.perf_counter() - start_time
+                results.append({"fen": fen, "mode": mode, "workers": workers, "depth": depth, "move": str(move),
+                                "nodes": search.nodes, "seconds": round(seconds, 4),
+                                "speedup": round(single_seconds / seconds, 3) if seconds > 0 else 0.0})
+        return results
+    finally:
+        for search in searches.values():
+            search.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parallel search speedup over a single process, as JSON lines")
+    parser.add_argument("--fen", action="append", help="position to search, repeatable, defaults to a small suite")
+    parser.add_argument("--depth", type=int, default=4, help="search depth")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes")
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.fen or BENCHMARK_POSITIONS, args.depth, args.workers)
+    for result in results:
+        print(json.dumps(result))
+    for mode in MODES:
+        speedups = [result["speedup"] for result in results if result["mode"] == mode]
+        print(json.dumps({"summary": True, "mode": mode, "workers": args.workers, "cpus": os.cpu_count(),
+                          "mean_speedup": round(sum(speedups) / len(speedups), 3)}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+""" Counts move generation leaf nodes from reference positions to validate and benchmark BoardState """
+
+import argparse
+import json
+import sys
+import time
+
+import engine
+
+# Reference positions with their published leaf counts by depth, the deepest count of each edge case position is the
+# published one and its shallower counts were taken once the deep count matched
+REFERENCE_POSITIONS = [
+    ("start", engine.START_FEN,
+     {1: 20, 2: 400, 3: 8902, 4: 197281, 5: 4865609}),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     {1: 48, 2: 2039, 3: 97862, 4: 4085603}),
+    ("endgame_rook_pawns", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     {1: 14, 2: 191, 3: 2812, 4: 43238, 5: 674624}),
+    ("promotions_castling", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     {1: 6, 2: 264, 3: 9467, 4: 422333}),
+    ("promotion_discovered_check", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     {1: 44, 2: 1486, 3: 62379, 4: 2103487}),
+    ("middlegame", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     {1: 46, 2: 2079, 3: 89890, 4: 3894594}),
+    ("enpassant_rank_pin", "3k4/3p4/8/K1P4r/8/8/8/8 b - - 0 1",
+     {1: 18, 2: 92, 3: 1670, 4: 10138, 6: 1134888}),
+    ("enpassant_uncovers_check", "8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1",
+     {1: 15, 2: 126, 3: 1928, 4: 13931, 6: 1440467}),
+    ("enpassant_avoid_illegal", "8/8/4k3/8/2p5/8/B2P2K1/8 w - - 0 1",
+     {1: 13, 2: 102, 3: 1266, 4: 10276, 6: 1015133}),
+    ("short_castle_gives_check", "5k2/8/8/8/8/8/8/4K2R w K - 0 1",
+     {1: 15, 2: 66, 3: 1198, 4: 6399, 6: 661072}),
+    ("long_castle_gives_check", "3k4/8/8/8/8/8/8/R3K3 w Q - 0 1",
+     {1: 16, 2: 71, 3: 1286, 4: 7418, 6: 803711}),
+    ("castle_rights", "r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1",
+     {1: 26, 2: 1141, 3: 27826, 4: 1274206}),
+    ("castling_prevented", "r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1",
+     {1: 44, 2: 1494, 3: 50509, 4: 1720476}),
+    ("promote_out_of_check", "2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1",
+     {1: 11, 2: 133, 3: 1442, 4: 19174, 6: 3821001}),
+    ("discovered_check", "8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1",
+     {1: 29, 2: 165, 3: 5160, 4: 31961, 5: 1004658}),
+    ("promote_to_give_check", "4k3/1P6/8/8/8/8/K7/8 w - - 0 1",
+     {1: 9, 2: 40, 3: 472, 4: 2661, 6: 217342}),
+    ("underpromote_to_give_check", "8/P1k5/K7/8/8/8/8/8 w - - 0 1",
+     {1: 6, 2: 27, 3: 273, 4: 1329, 6: 92683}),
+    ("self_stalemate", "K1k5/8/P7/8/8/8/8/8 w - - 0 1",
+     {1: 2, 2: 6, 3: 13, 4: 63, 6: 2217}),
+    ("stalemate_and_checkmate", "8/k1P5/8/1K6/8/8/8/8 w - - 0 1",
+     {1: 10, 2: 25, 3: 268, 4: 926, 7: 567584}),
+    ("stalemate_and_checkmate_black", "8/8/2k5/5q2/5n2/8/5K2/8 b - - 0 1",
+     {1: 37, 2: 183, 3: 6559, 4: 23527}),
+]
+
+
+# Counts the leaf nodes of the legal move tree to the given depth, generating each ply's moves into its own reused list
+def perft(bs, depth, buffers=None):
+    if depth == 0:
+        return 1
+    if buffers is None:
+        buffers = [[] for _ in range(depth + 1)]
+    valid_moves = bs.get_valid_move_codes(buffers[depth])
+    if depth == 1:
+        return len(valid_moves)
+    nodes = 0
+    for move in valid_moves:
+        bs.make_move_code(move)
+        nodes += perft(bs, depth - 1, buffers)
+        bs.undo_move()
+    return nodes
+
+
+# Leaf counts split by root move, in coordinate notation, for tracking down a wrong total
+def divide(bs, depth):
+    counts = {}
+    for move in bs.get_valid_moves():
+        bs.make_move(move)
+        counts[move.get_chess_notation()] = perft(bs, depth - 1)
+        bs.undo_move()
+    return counts
+
+
+# Runs perft on one position and returns a JSON ready result, expected is None when no reference count is known
+def run_position(name, fen, depth, expected=None, split=False):
+    bs = engine.BoardState(fen)
+    start_time = time.perf_counter()
+    if split:
+        moves = divide(bs, depth)
+        nodes = sum(moves.values())
+    else:
+        moves = None
+        nodes = perft(bs, depth)
+    seconds = time.perf_counter() - start_time
+    result = {"name": name, "fen": fen, "depth": depth, "nodes": nodes, "expected": expected,
+              "passed": expected is None or nodes == expected, "seconds": round(seconds, 4),
+              "nps": int(nodes / seconds) if seconds > 0 else 0}
+    if moves is not None:
+        result["divide"] = moves
+    return result
+
+
+# Runs every reference position at its deepest known depth within max_depth, skipping positions above max_nodes
+def run_suite(max_depth=4, max_nodes=None):
+    results = []
+    for name, fen, counts in REFERENCE_POSITIONS:
+        depths = [d for d, count in counts.items() if d <= max_depth and (max_nodes is None or count <= max_nodes)]
+        if depths:
+            depth = max(depths)
+            results.append(run_position(name, fen, depth, counts[depth]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft move generation counts and throughput, as JSON lines")
+    parser.add_argument("--fen", help="position to count, defaults to the reference suite")
+    parser.add_argument("--depth", type=int, default=4, help="depth for --fen, maximum depth for the suite")
+    parser.add_argument("--max-nodes", type=int, help="skip suite entries whose reference count is larger")
+    parser.add_argument("--divide", action="store_true", help="also report counts per root move for --fen")
+    args = parser.parse_args(argv)
+
+    if args.fen:
+        results = [run_position("fen", args.fen, args.depth, split=args.divide)]
+    else:
+        results = run_suite(args.depth, args.max_nodes)
+    for result in results:
+        print(json.dumps(result))
+    total_nodes = sum(result["nodes"] for result in results)
+    total_seconds = sum(result["seconds"] for result in results)
+    print(json.dumps({"summary": True, "positions": len(results), "nodes": total_nodes,
+                      "seconds": round(total_seconds, 4),
+                      "nps": int(total_nodes / total_seconds) if total_seconds > 0 else 0,
+                      "failed": [result["name"] for result in results if not result["passed"]]}))
+    return 0 if all(result["passed"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
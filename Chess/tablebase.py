@@ -0,0 +1,543 @@
+""" Generates endgame tablebases for three and four piece endings by retrograde analysis, and probes them """
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+import engine
+
+# Results from the side to move's point of view, with the distance to mate in plies
+WIN = 1
+DRAW = 0
+LOSS = -1
+# Kings included, tables for more pieces would take far too long to generate in Python
+MAX_PIECES = 4
+# Piece letters strongest first, the order pieces take in a table's name and index
+PIECE_LETTERS = "QRBNP"
+# Each table file is this header followed by one byte per index of its layout, so impossible positions and those
+# stored under another symmetry have bytes too: 0 for a draw (or an index no position is stored at), an odd byte for a
+# win with that many plies to mate, an even one for a loss with two plies fewer to mate than its value
+HEADER = struct.Struct("<4sI")
+MAGIC = b"CTB1"
+MAX_DTM = 253
+TABLE_EXTENSION = ".tbl"
+
+
+# The table names for every three and four piece ending, pawn against pawn aside since en passant is not modelled
+def all_signatures():
+    singles = list(PIECE_LETTERS)
+    pairs = [PIECE_LETTERS[i] + PIECE_LETTERS[j] for i in range(5) for j in range(i, 5)]
+    signatures = ["K" + piece + "vK" for piece in singles] + ["K" + pair + "vK" for pair in pairs]
+    for white in singles:
+        for black in singles:
+            if side_order(white) >= side_order(black) and (white, black) != ('P', 'P'):
+                signatures.append(normalize(white, black)[0])
+    return sorted(set(signatures), key=lambda signature: (len(signature), signature))
+
+
+# Orders the pieces of one side so the stronger side can always be made white
+def side_order(pieces):
+    return tuple(sorted((len(PIECE_LETTERS) - PIECE_LETTERS.index(piece) for piece in pieces), reverse=True))
+
+
+# The table name for white's and black's pieces besides the kings, and whether colors have to be swapped to use it
+def normalize(white, black):
+    white = "".join(sorted(white, key=PIECE_LETTERS.index))
+    black = "".join(sorted(black, key=PIECE_LETTERS.index))
+    if side_order(black) > side_order(white):
+        return "K" + black + "vK" + white, True
+    return "K" + white + "vK" + black, False
+
+
+def encode_value(result, dtm):
+    if result == WIN:
+        return dtm
+    if result == LOSS:
+        return dtm + 2
+    return 0
+
+
+def decode_value(value):
+    if value == 0:
+        return DRAW, 0
+    if value & 1:
+        return WIN, value
+    return LOSS, value - 2
+
+
+# Board symmetries as square maps: swapping ranks with files, mirroring files and mirroring ranks in every combination
+def build_square_transforms():
+    transforms = []
+    for transform in range(8):
+        squares = []
+        for square in range(64):
+            r, f = divmod(square, 8)
+            if transform & 4:
+                r, f = f, r
+            if transform & 1:
+                f = 7 - f
+            if transform & 2:
+                r = 7 - r
+            squares.append(r * 8 + f)
+        transforms.append(squares)
+    return transforms
+
+
+SQUARE_TRANSFORMS = build_square_transforms()
+# White king squares kept in a table, every other position is one of these under a symmetry. Without pawns that is
+# the a1-d1-d4 triangle, pawns only allow mirroring the files so the king stays on files a-d
+PAWNLESS_KING_SQUARES = [r * 8 + f for r in range(8) for f in range(8) if f <= 3 and 7 - r <= f]
+PAWN_KING_SQUARES = [r * 8 + f for r in range(8) for f in range(4)]
+
+
+# Class for mapping the positions of one ending to table indexes, every position under a symmetry sharing one index.
+# Indexes run over 2 sides to move x the kept king squares x 64 squares per other piece, unused ones included
+# Pieces are the white king, the black king, then white's and black's other pieces in name order
+class TableLayout:
+    def __init__(self, signature):
+        self.signature = signature
+        white, black = signature[1:].split("vK")
+        self.white = white
+        self.black = black
+        self.pieces = ["wK", "bK"] + [piece_code('w', letter) for letter in white] + \
+            [piece_code('b', letter) for letter in black]
+        self.has_pawns = 'P' in white + black
+        if self.has_pawns:
+            self.king_squares = PAWN_KING_SQUARES
+            transforms = (0, 1)
+        else:
+            self.king_squares = PAWNLESS_KING_SQUARES
+            transforms = range(8)
+        self.king_slots = [-1] * 64
+        for slot, square in enumerate(self.king_squares):
+            self.king_slots[square] = slot
+        # The symmetries that bring a white king on each square into the kept squares, one or two of them
+        self.transforms_for = [[SQUARE_TRANSFORMS[transform] for transform in transforms
+                                if self.king_slots[SQUARE_TRANSFORMS[transform][square]] >= 0]
+                               for square in range(64)]
+        # Runs of identical pieces, whose squares are sorted so swapping them gives the same index
+        self.groups = [(start, start + 2) for start in range(2, len(self.pieces) - 1)
+                       if self.pieces[start] == self.pieces[start + 1]]
+        self.side_size = len(self.king_squares) * 64 ** (len(self.pieces) - 1)
+        self.size = 2 * self.side_size
+
+    # Index of the position's symmetry class, the smallest index any of its symmetries has
+    def index(self, squares, white_to_move):
+        best = None
+        for transform in self.transforms_for[squares[0]]:
+            moved = [transform[square] for square in squares]
+            for start, end in self.groups:
+                moved[start:end] = sorted(moved[start:end])
+            index = self.king_slots[moved[0]]
+            for square in moved[1:]:
+                index = index * 64 + square
+            if best is None or index < best:
+                best = index
+        return best if white_to_move else best + self.side_size
+
+    def decode(self, index):
+        white_to_move = index < self.side_size
+        if not white_to_move:
+            index -= self.side_size
+        squares = []
+        for _ in range(len(self.pieces) - 1):
+            index, square = divmod(index, 64)
+            squares.append(square)
+        squares.append(self.king_squares[index])
+        squares.reverse()
+        return squares, white_to_move
+
+    # No two pieces on one square and no pawn on the first or last rank
+    def is_valid(self, squares):
+        if len(set(squares)) != len(squares):
+            return False
+        for piece, square in zip(self.pieces, squares):
+            if piece[1] == 'p' and (square < 8 or square >= 56):
+                return False
+        return True
+
+    # Squares of the given (piece, square) pairs in this layout's piece order
+    def squares_for(self, pieces):
+        by_piece = {}
+        for piece, square in pieces:
+            by_piece.setdefault(piece, []).append(square)
+        return [by_piece[piece].pop() for piece in self.pieces]
+
+
+def piece_code(color, letter):
+    return color + ('p' if letter == 'P' else letter)
+
+
+# Class for probing tables, files are memory mapped so only the pages a probe touches are ever read
+class Tablebase:
+    def __init__(self, directory=None):
+        # Table name to (layout, data, offset of the first position in data)
+        self.tables = {}
+        self.files = []
+        if directory is not None:
+            for name in sorted(os.listdir(directory)):
+                if name.endswith(TABLE_EXTENSION):
+                    self.load(os.path.join(directory, name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for file, data in self.files:
+            data.close()
+            file.close()
+        self.files = []
+        self.tables = {}
+
+    def load(self, path):
+        signature = os.path.basename(path)[:-len(TABLE_EXTENSION)]
+        layout = TableLayout(signature)
+        file = open(path, "rb")
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, size = HEADER.unpack_from(data)
+        if magic != MAGIC or size != layout.size or len(data) != HEADER.size + size:
+            data.close()
+            file.close()
+            raise ValueError("Not a tablebase file for " + signature + ": " + path)
+        self.files.append((file, data))
+        self.tables[signature] = (layout, data, HEADER.size)
+
+    # Makes a table built in memory available to probes, used while generating the tables that depend on it
+    def add(self, layout, values):
+        self.tables[layout.signature] = (layout, values, 0)
+
+    # Result and distance to mate for (piece, square) pairs with the given side to move, None without the table
+    def probe_pieces(self, pieces, white_to_move):
+        white = "".join(piece[1].upper() for piece, _ in pieces if piece[0] == 'w' and piece[1] != 'K')
+        black = "".join(piece[1].upper() for piece, _ in pieces if piece[0] == 'b' and piece[1] != 'K')
+        if not white and not black:
+            return DRAW, 0
+        signature, swap_colors = normalize(white, black)
+        table = self.tables.get(signature)
+        if table is None:
+            return None
+        if swap_colors:
+            pieces = [(('b' if piece[0] == 'w' else 'w') + piece[1], square ^ 56) for piece, square in pieces]
+            white_to_move = not white_to_move
+        layout, data, offset = table
+        return decode_value(data[offset + layout.index(layout.squares_for(pieces), white_to_move)])
+
+    # Result and distance to mate for the board, None when it has too many pieces, castling rights, a possible en
+    # passant capture or no table
+    def probe(self, bs):
+        if bin(bs.occupied).count("1") > MAX_PIECES or bs.castling_rights or bs.get_enpassant_zobrist():
+            return None
+        pieces = [(piece, square) for piece in engine.PIECES for square in engine.squares_of(bs.bitboards[piece])]
+        return self.probe_pieces(pieces, bs.white_to_move)
+
+    # The move code that wins fastest, or failing that draws, or failing that loses slowest, None when any move
+    # leads out of the tables
+    def best_move(self, bs):
+        if self.probe(bs) is None:
+            return None
+        best_move = None
+        best_order = None
+        for move in bs.get_valid_move_codes():
+            bs.make_move_code(move)
+            value = self.probe(bs)
+            bs.undo_move()
+            if value is None:
+                return None
+            result, dtm = value
+            # The child's result is the opponent's
+            order = (-result, -dtm if result == LOSS else dtm)
+            if best_order is None or order > best_order:
+                best_move = move
+                best_order = order
+        return best_move
+
+
+# Class for generating tables. Every position is first searched forward with the BoardState move generator, counting
+# its moves within the table and scoring the ones that capture or promote out of it from tables already generated.
+# Results then spread backwards from the checkmates a ply at a time by taking moves back: a position one move before
+# a loss is a win, and a position whose every move leads to a win for the opponent is a loss
+class TablebaseGenerator:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.tablebase = Tablebase(directory)
+        self.board_state = engine.BoardState()
+        self.board_state.board = [[".."] * 8 for _ in range(8)]
+        self.board_state.castling_rights = 0
+        self.board_state.enpassant_move = ()
+        self.move_buffer = []
+        self.placed = []
+
+    # Generates the tables named and every table they lead into that is not on disk yet, returns a report per table
+    def generate_all(self, signatures):
+        reports = []
+        for signature in signatures:
+            self.generate_with_dependencies(signature, reports)
+        return reports
+
+    def generate_with_dependencies(self, signature, reports):
+        if signature in self.tablebase.tables:
+            return
+        for dependency in dependencies(signature):
+            self.generate_with_dependencies(dependency, reports)
+        reports.append(self.generate(signature))
+
+    def generate(self, signature):
+        start_time = time.perf_counter()
+        layout = TableLayout(signature)
+        size = layout.size
+        values = bytearray(size)
+        # Positions with a final result, including positions that can't happen, which stay draws
+        resolved = bytearray(size)
+        # Distinct positions in the table each position can move to that are not known to be wins for the opponent
+        remaining = bytearray(size)
+        # Longest distance to mate among the moves known to lose, plus the move itself
+        loss_depth = bytearray(size)
+        # Whether a capture or promotion out of the table draws, or wins
+        draw_exits = bytearray(size)
+        win_exits = bytearray(size)
+        # Positions waiting to be resolved at each distance to mate, wins at odd distances, losses at even ones
+        pending = [array("L") for _ in range(MAX_DTM + 3)]
+        legal_positions = 0
+
+        for index in range(size):
+            squares, white_to_move = layout.decode(index)
+            if not layout.is_valid(squares) or layout.index(squares, white_to_move) != index:
+                resolved[index] = 1
+                continue
+            moves = self.legal_moves(layout, squares, white_to_move)
+            if moves is None:
+                resolved[index] = 1
+                continue
+            legal_positions += 1
+            if not moves:
+                if self.board_state.in_check:
+                    pending[0].append(index)
+                else:
+                    resolved[index] = 1
+                continue
+            children = set()
+            fastest_win = None
+            for move in moves:
+                child = self.play(layout, squares, move)
+                if isinstance(child, int):
+                    children.add(layout.index(squares_after(squares, child, move), not white_to_move))
+                    continue
+                value = self.tablebase.probe_pieces(child, not white_to_move)
+                if value is None:
+                    raise ValueError("Missing table for a capture or promotion out of " + signature)
+                result, dtm = value
+                if result == LOSS:
+                    if fastest_win is None or dtm + 1 < fastest_win:
+                        fastest_win = dtm + 1
+                elif result == WIN:
+                    loss_depth[index] = max(loss_depth[index], dtm + 1)
+                else:
+                    draw_exits[index] = 1
+            remaining[index] = len(children)
+            if fastest_win is not None:
+                win_exits[index] = 1
+                pending[fastest_win].append(index)
+            elif not children:
+                if draw_exits[index]:
+                    resolved[index] = 1
+                else:
+                    pending[loss_depth[index]].append(index)
+
+        for depth in range(len(pending)):
+            for index in pending[depth]:
+                if resolved[index]:
+                    continue
+                resolved[index] = 1
+                values[index] = encode_value(LOSS if depth % 2 == 0 else WIN, depth)
+                squares, white_to_move = layout.decode(index)
+                for previous in self.previous_positions(layout, squares, white_to_move):
+                    if resolved[previous]:
+                        continue
+                    if depth % 2 == 0:
+                        pending[depth + 1].append(previous)
+                        continue
+                    remaining[previous] -= 1
+                    if depth + 1 > loss_depth[previous]:
+                        loss_depth[previous] = depth + 1
+                    if remaining[previous] == 0 and not win_exits[previous]:
+                        if draw_exits[previous]:
+                            resolved[previous] = 1
+                        elif loss_depth[previous] > MAX_DTM:
+                            raise ValueError("Distance to mate too long to store in " + signature)
+                        else:
+                            pending[loss_depth[previous]].append(previous)
+            pending[depth] = None
+
+        path = os.path.join(self.directory, signature + TABLE_EXTENSION)
+        with open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, size))
+            file.write(values)
+        self.tablebase.add(layout, values)
+        wins = sum(1 for value in values if value & 1)
+        losses = sum(1 for value in values if value and not value & 1)
+        return {"table": signature, "positions": legal_positions, "wins": wins,
+                "draws": legal_positions - wins - losses, "losses": losses,
+                "max_dtm": max(decode_value(value)[1] for value in set(values)), "bytes": HEADER.size + size,
+                "seconds": round(time.perf_counter() - start_time, 2)}
+
+    # Sets the board to a position and returns its legal moves, None when the side not to move is in check
+    def legal_moves(self, layout, squares, white_to_move):
+        bs = self.board_state
+        for square in self.placed:
+            bs.board[square >> 3][square & 7] = ".."
+        for piece in engine.PIECES:
+            bs.bitboards[piece] = 0
+        for piece, square in zip(layout.pieces, squares):
+            bs.bitboards[piece] |= 1 << square
+            bs.board[square >> 3][square & 7] = piece
+        self.placed = squares
+        bs.occupancy = {'w': 0, 'b': 0}
+        for piece in engine.PIECES:
+            bs.occupancy[piece[0]] |= bs.bitboards[piece]
+        bs.occupied = bs.occupancy['w'] | bs.occupancy['b']
+        bs.white_king = divmod(squares[0], 8)
+        bs.black_king = divmod(squares[1], 8)
+        bs.white_to_move = white_to_move
+        bs.check_mate = False
+        bs.stale_mate = False
+        if white_to_move:
+            if bs.is_square_attacked(squares[1], 'w'):
+                return None
+        elif bs.is_square_attacked(squares[0], 'b'):
+            return None
+        return bs.get_valid_move_codes(self.move_buffer)
+
+    # The index of the piece a move within the table moves, or the (piece, square) pairs after a capture or
+    # promotion that leaves it
+    def play(self, layout, squares, move):
+        start = move & 63
+        end = (move >> 6) & 63
+        moved = squares.index(start)
+        if not move >> 20 and (move >> 12) & 3 != engine.PROMOTION_MOVE:
+            return moved
+        pieces = []
+        for i, (piece, square) in enumerate(zip(layout.pieces, squares)):
+            if i == moved:
+                promotion = engine.move_promotion(move)
+                pieces.append((piece if promotion is None else piece[0] + promotion, end))
+            elif square != end:
+                pieces.append((piece, square))
+        return pieces
+
+    # Indexes of the positions in the table with a move to this one, found by taking back every move of the side
+    # that just moved. Captures and promotions can't be taken back within one table
+    def previous_positions(self, layout, squares, white_to_move):
+        occupied = 0
+        for square in squares:
+            occupied |= 1 << square
+        empty = engine.ALL_SQUARES ^ occupied
+        mover = 'b' if white_to_move else 'w'
+        previous = set()
+        for i, piece in enumerate(layout.pieces):
+            if piece[0] != mover:
+                continue
+            square = squares[i]
+            kind = piece[1]
+            if kind == 'K':
+                origins = engine.KING_ATTACKS[square] & empty
+            elif kind == 'N':
+                origins = engine.KNIGHT_ATTACKS[square] & empty
+            elif kind == 'R':
+                origins = engine.rook_attacks(square, occupied) & empty
+            elif kind == 'B':
+                origins = engine.bishop_attacks(square, occupied) & empty
+            elif kind == 'Q':
+                origins = (engine.rook_attacks(square, occupied) | engine.bishop_attacks(square, occupied)) & empty
+            else:
+                origins = pawn_origins(square, mover, empty)
+            for origin in engine.squares_of(origins):
+                before = list(squares)
+                before[i] = origin
+                previous.add(layout.index(before, mover == 'w'))
+        return previous
+
+
+def squares_after(squares, moved, move):
+    after = list(squares)
+    after[moved] = (move >> 6) & 63
+    return after
+
+
+# Squares a pawn now on square could have been pushed from, white pawns move towards rank index 0
+def pawn_origins(square, color, empty):
+    step = 8 if color == 'w' else -8
+    origin = square + step
+    # A pawn never stands on its first rank
+    if not 8 <= origin < 56 or not (1 << origin) & empty:
+        return 0
+    origins = 1 << origin
+    if square >> 3 == (4 if color == 'w' else 3) and (1 << (origin + step)) & empty:
+        origins |= 1 << (origin + step)
+    return origins
+
+
+# Tables a capture or promotion in an ending can lead into
+def dependencies(signature):
+    white, black = signature[1:].split("vK")
+    tables = set()
+    for side, other, is_white in ((white, black, True), (black, white, False)):
+        for i, letter in enumerate(side):
+            rest = side[:i] + side[i + 1:]
+            # Captured by the other side
+            if rest or other:
+                tables.add(normalize(rest, other)[0] if is_white else normalize(other, rest)[0])
+            if letter == 'P':
+                for promotion in "QRBN":
+                    promoted = rest + promotion
+                    tables.add(normalize(promoted, other)[0] if is_white else normalize(other, promoted)[0])
+    tables.discard(signature)
+    return sorted(tables, key=lambda table: (len(table), table))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generates and probes endgame tablebases of up to four pieces")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate = commands.add_parser("generate", help="generate tables, and the tables they depend on, as JSON lines")
+    generate.add_argument("tables", nargs="*", help="tables such as KQvK or KRvKN, defaults to every table")
+    generate.add_argument("--dir", default="tablebases", help="directory the tables are written to")
+    probe = commands.add_parser("probe", help="result, distance to mate and best move for a position")
+    probe.add_argument("--dir", default="tablebases", help="directory to read the tables from")
+    probe.add_argument("--fen", required=True, help="position to look up")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        os.makedirs(args.dir, exist_ok=True)
+        for signature in args.tables:
+            white, black = signature[1:].split("vK")
+            if normalize(white, black)[0] != signature or len(signature) - 2 > MAX_PIECES:
+                parser.error("Unknown table " + signature + ", tables are named like KQvK or KRvKN")
+        generator = TablebaseGenerator(args.dir)
+        for signature in args.tables or all_signatures():
+            for report in generator.generate_all([signature]):
+                print(json.dumps(report), flush=True)
+        return 0
+
+    bs = engine.BoardState(args.fen)
+    with Tablebase(args.dir) as tablebase:
+        value = tablebase.probe(bs)
+        if value is None:
+            print(json.dumps({"fen": args.fen, "found": False}))
+            return 1
+        move = tablebase.best_move(bs)
+        print(json.dumps({"fen": args.fen, "found": True,
+                          "result": {WIN: "win", DRAW: "draw", LOSS: "loss"}[value[0]], "dtm": value[1],
+                          "move": None if move is None else str(engine.PieceMove.from_move_code(move))}))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
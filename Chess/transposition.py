@@ -0,0 +1,112 @@
+""" Fixed size transposition table storing search results by position key """
+
+import ctypes
+import multiprocessing
+
+# Bound types, an exact score was searched inside the window, lower and upper bounds come from beta and alpha cutoffs
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Approximate bytes taken by one stored entry: the list slot, the entry tuple, its key int and its score float
+ENTRY_SIZE = 160
+# Bytes per entry of the shared table, two 64 bit words
+SHARED_ENTRY_SIZE = 16
+
+
+# Class for caching search results across transpositions
+class TranspositionTable:
+    def __init__(self, size_mb=32):
+        # Round the slot count down to a power of two so a key maps to its slot with a single mask
+        slots = max(1, (size_mb * 1024 * 1024) // ENTRY_SIZE)
+        self.size = 1 << (slots.bit_length() - 1)
+        self.mask = self.size - 1
+        # Each entry is a (key, depth, score, bound, best move, age) tuple, or None for an empty slot
+        self.entries = [None] * self.size
+        self.age = 0
+
+    # Starts a new search, entries written by earlier searches become the first to be replaced
+    def new_search(self):
+        self.age = (self.age + 1) & 0xFF
+
+    # Empties every slot
+    def clear(self):
+        self.entries = [None] * self.size
+        self.age = 0
+
+    # Returns the entry stored for a position key, or None if the slot holds a different position
+    def probe(self, key):
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            return entry
+        return None
+
+    # Stores a search result, keeping a deeper entry from the current search over a shallower result
+    def store(self, key, depth, score, bound, best_move):
+        index = key & self.mask
+        entry = self.entries[index]
+        if entry is not None and entry[0] != key and entry[5] == self.age and entry[1] > depth:
+            return
+        self.entries[index] = (key, depth, score, bound, kept_best_move(entry, key, best_move), self.age)
+
+
+# Transposition table in shared memory, every search process started with the same array reads and writes one table
+# An entry is two words, the packed data and the position key xor'd with it. Two processes writing a slot at the same
+# time can leave words from different entries, which then fail the key check instead of being read as one entry
+class SharedTranspositionTable:
+    def __init__(self, size_mb=32, array=None):
+        if array is None:
+            slots = max(1, (size_mb * 1024 * 1024) // SHARED_ENTRY_SIZE)
+            array = multiprocessing.RawArray(ctypes.c_uint64, 2 << (slots.bit_length() - 1))
+        # Pass the array to worker processes and build a table on it there to share the entries
+        self.array = array
+        self.size = len(array) // 2
+        self.mask = self.size - 1
+        # Kept per process, the process running the search sets it for its workers
+        self.age = 0
+
+    def new_search(self):
+        self.age = (self.age + 1) & 0xFF
+
+    def clear(self):
+        ctypes.memset(self.array, 0, ctypes.sizeof(self.array))
+        self.age = 0
+
+    # Returns the entry stored for a position key as the same tuple TranspositionTable gives, or None
+    def probe(self, key):
+        index = (key & self.mask) << 1
+        data = self.array[index + 1]
+        if data and self.array[index] ^ data == key:
+            return unpack_entry(key, data)
+        return None
+
+    # Stores a search result with the same replacement rule as TranspositionTable
+    def store(self, key, depth, score, bound, best_move):
+        index = (key & self.mask) << 1
+        data = self.array[index + 1]
+        entry = unpack_entry(self.array[index] ^ data, data) if data else None
+        if entry is not None and entry[0] != key and entry[5] == self.age and entry[1] > depth:
+            return
+        data = pack_entry(depth, score, bound, kept_best_move(entry, key, best_move), self.age)
+        self.array[index] = key ^ data
+        self.array[index + 1] = data
+
+
+# The best move to store over the entry in a slot, the stored one when this search of the same position found none
+def kept_best_move(entry, key, best_move):
+    if best_move is None and entry is not None and entry[0] == key:
+        return entry[4]
+    return best_move
+
+
+# Packs an entry into one word: the move code plus one in bits 0-24 (zero for no move), the score in tenths offset to
+# be positive in bits 25-40, the depth in bits 41-48, the bound in bits 49-50 and the age in bits 51-58
+def pack_entry(depth, score, bound, best_move, age):
+    move = 0 if best_move is None else best_move + 1
+    return move | (int(round(score * 10)) + 0x8000) << 25 | min(depth, 0xFF) << 41 | bound << 49 | age << 51
+
+
+def unpack_entry(key, data):
+    move = data & 0x1FFFFFF
+    return (key, (data >> 41) & 0xFF, (((data >> 25) & 0xFFFF) - 0x8000) / 10, (data >> 49) & 3,
+            move - 1 if move else None, (data >> 51) & 0xFF)
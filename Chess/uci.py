@@ -0,0 +1,287 @@
+""" Plays through the UCI protocol on standard input and output, so the engine runs under chess GUIs and tournament
+managers without a display """
+
+import sys
+import threading
+import time
+
+import chessAI
+import engine
+import openingbook
+import tablebase
+
+ENGINE_NAME = "ChessAI"
+ENGINE_AUTHOR = "antoniosellemi"
+# Moves left in the game assumed when the clock doesn't say
+DEFAULT_MOVES_TO_GO = 30
+# Seconds kept back from every move for the reply to reach the GUI
+MOVE_OVERHEAD = 0.05
+# Options offered to the GUI as (name, type, default), with their bounds for spin options
+OPTIONS = [("Hash", "spin", chessAI.HASH_SIZE_MB, 1, 4096),
+           ("NullMovePruning", "check", chessAI.NULL_MOVE_PRUNING),
+           ("LateMoveReductions", "check", chessAI.LATE_MOVE_REDUCTIONS),
+           ("BookFile", "string", ""),
+           ("TablebasePath", "string", "")]
+
+
+# Class for one UCI session, the search runs on its own thread so stop and isready are answered while it thinks
+class UCIEngine:
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.options = {option[0]: option[2] for option in OPTIONS}
+        self.board_state = engine.BoardState()
+        self.book = None
+        self.endgame_tables = None
+        self.searcher = None
+        self.search_thread = None
+        # Position of the running search, where its principal variations start
+        self.search_board = None
+        # Set when an infinite search may report its move, which is only once it has been told to stop
+        self.release = threading.Event()
+        self.search_start = 0.0
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    # Reads commands until quit or the end of the input
+    def run(self, commands=sys.stdin):
+        try:
+            for line in commands:
+                if not self.handle(line):
+                    break
+        finally:
+            self.stop_search()
+            self.close_files()
+        return 0
+
+    # Handles one command, returns False on quit
+    def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, arguments = tokens[0], tokens[1:]
+        if command == "uci":
+            self.send("id name " + ENGINE_NAME)
+            self.send("id author " + ENGINE_AUTHOR)
+            for option in OPTIONS:
+                name, kind, default = option[:3]
+                if kind == "check":
+                    default = str(default).lower()
+                line = "option name " + name + " type " + kind + " default " + str(default)
+                if kind == "spin":
+                    line += " min " + str(option[3]) + " max " + str(option[4])
+                self.send(line)
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "stop":
+            self.stop_search()
+        elif command == "quit":
+            return False
+        elif command == "ucinewgame":
+            self.finish_search()
+            self.close_files()
+            self.searcher = None
+            self.board_state = engine.BoardState()
+        elif command == "setoption":
+            self.finish_search()
+            self.set_option(arguments)
+        elif command == "position":
+            self.finish_search()
+            self.set_position(arguments)
+        elif command == "go":
+            self.finish_search()
+            self.go(arguments)
+        elif command == "d":
+            self.send("info string " + self.board_state.to_fen())
+        return True
+
+    # setoption name <name> [value <value>], names may contain spaces
+    def set_option(self, arguments):
+        if "name" not in arguments:
+            return
+        value_at = arguments.index("value") if "value" in arguments else len(arguments)
+        name = " ".join(arguments[arguments.index("name") + 1:value_at])
+        value = " ".join(arguments[value_at + 1:])
+        for option in OPTIONS:
+            if option[0].lower() == name.lower():
+                kind = option[1]
+                try:
+                    if kind == "spin":
+                        value = min(max(int(value), option[3]), option[4])
+                    elif kind == "check":
+                        value = value.lower() == "true"
+                except ValueError:
+                    self.send("info string Invalid value for " + option[0] + ": " + value)
+                    return
+                self.options[option[0]] = value
+                self.close_files()
+                self.searcher = None
+                return
+        self.send("info string Unknown option: " + name)
+
+    def close_files(self):
+        if self.book is not None:
+            self.book.close()
+            self.book = None
+        if self.endgame_tables is not None:
+            self.endgame_tables.close()
+            self.endgame_tables = None
+
+    # The searcher for the current options, built again only after an option changes so its hash table carries over
+    # from move to move
+    def get_searcher(self):
+        if self.searcher is None:
+            # A file that can't be opened is reported and the search goes on without it
+            if self.options["BookFile"]:
+                try:
+                    self.book = openingbook.OpeningBook(self.options["BookFile"])
+                except (OSError, ValueError) as error:
+                    self.send("info string " + str(error))
+            if self.options["TablebasePath"]:
+                try:
+                    self.endgame_tables = tablebase.Tablebase(self.options["TablebasePath"])
+                except (OSError, ValueError) as error:
+                    self.send("info string " + str(error))
+            self.searcher = chessAI.Searcher(hash_size_mb=self.options["Hash"],
+                                             null_move_pruning=self.options["NullMovePruning"],
+                                             late_move_reductions=self.options["LateMoveReductions"],
+                                             book=self.book, endgame_tables=self.endgame_tables)
+            self.searcher.iteration_callback = self.send_info
+        return self.searcher
+
+    # position [startpos | fen <fen>] [moves <move> ...]
+    def set_position(self, arguments):
+        moves_at = arguments.index("moves") if "moves" in arguments else len(arguments)
+        try:
+            if arguments and arguments[0] == "fen":
+                bs = engine.BoardState(" ".join(arguments[1:moves_at]))
+            else:
+                bs = engine.BoardState()
+        except (ValueError, IndexError, KeyError):
+            self.send("info string Invalid position: " + " ".join(arguments))
+            return
+        for text in arguments[moves_at + 1:]:
+            try:
+                bs.make_move_code(bs.parse_move(text))
+            except ValueError:
+                self.send("info string Illegal move: " + text)
+                break
+        self.board_state = bs
+
+    # go [depth n] [nodes n] [movetime ms] [wtime ms] [btime ms] [winc ms] [binc ms] [movestogo n] [infinite]
+    def go(self, arguments):
+        limits = {}
+        for i, token in enumerate(arguments[:-1]):
+            if token in ("depth", "nodes", "movetime", "wtime", "btime", "winc", "binc", "movestogo"):
+                try:
+                    limits[token] = int(arguments[i + 1])
+                except ValueError:
+                    pass
+        infinite = "infinite" in arguments or "ponder" in arguments
+        time_limit = None
+        if "movetime" in limits:
+            time_limit = max(0.0, limits["movetime"] / 1000 - MOVE_OVERHEAD)
+        elif not infinite:
+            side = "w" if self.board_state.white_to_move else "b"
+            if side + "time" in limits:
+                time_limit = time_for_move(limits[side + "time"], limits.get(side + "inc", 0),
+                                           limits.get("movestogo"))
+        max_depth = limits.get("depth")
+        if max_depth is None and (infinite or time_limit is not None or "nodes" in limits):
+            max_depth = chessAI.MAX_DEPTH
+        if infinite:
+            self.release.clear()
+        else:
+            self.release.set()
+        searcher = self.get_searcher()
+        self.search_start = time.perf_counter()
+        self.search_board = self.board_state
+        self.search_thread = threading.Thread(target=self.search, daemon=True,
+                                              args=(searcher, self.board_state, time_limit, limits.get("nodes"),
+                                                    max_depth))
+        self.search_thread.start()
+
+    def search(self, searcher, bs, time_limit, node_limit, max_depth):
+        valid_moves = bs.get_valid_moves()
+        if valid_moves:
+            move = searcher.find_best_move(bs, valid_moves, time_limit, node_limit, max_depth)
+            if searcher.book_move:
+                self.send("info string book move")
+            elif searcher.tablebase_move:
+                self.send("info string tablebase move")
+        else:
+            # Nothing to search, the game is already over
+            move = None
+            self.send("info depth 0 score " + ("mate 0" if bs.check_mate else "cp 0"))
+        # An infinite search reports its move only once the GUI says stop
+        self.release.wait()
+        if move is None and valid_moves:
+            move = valid_moves[0]
+        self.send("bestmove " + ("0000" if move is None else move.get_chess_notation()))
+
+    # Stops the running search, which reports its move before this returns. Asks again until the thread is gone,
+    # since a stop that comes before the search has started is cleared when it starts
+    def stop_search(self):
+        if self.search_thread is not None:
+            self.release.set()
+            while self.search_thread.is_alive():
+                self.searcher.stop()
+                self.search_thread.join(0.01)
+            self.search_thread = None
+
+    # Lets a search with limits run to the end before the next command changes anything, an infinite one is stopped
+    def finish_search(self):
+        if self.search_thread is not None:
+            if not self.release.is_set():
+                self.stop_search()
+            else:
+                self.search_thread.join()
+                self.search_thread = None
+
+    # One info line per completed iteration
+    def send_info(self, searcher):
+        seconds = time.perf_counter() - self.search_start
+        line = [code for _, code in searcher.principal_variation]
+        score = searcher.best_score
+        mate_in = self.mate_distance(searcher, line) if abs(score) >= chessAI.PROVEN_WIN else None
+        if mate_in is not None:
+            score_text = "mate " + str(mate_in if score > 0 else -mate_in)
+        else:
+            score_text = "cp " + str(int(round(score * 100)))
+        self.send("info depth " + str(searcher.completed_depth) + " score " + score_text + " nodes " +
+                  str(searcher.nodes) + " nps " + str(int(searcher.nodes / seconds) if seconds > 0 else 0) +
+                  " time " + str(int(seconds * 1000)) + " pv " +
+                  " ".join(engine.PieceMove.from_move_code(code).get_chess_notation() for code in line))
+
+    # Moves to mate along a principal variation, known only when it ends in checkmate or in a table position, which
+    # gives the plies left. None when the line was cut short of either
+    def mate_distance(self, searcher, line):
+        bs = engine.BoardState.from_snapshot(self.search_board.snapshot())
+        for code in line:
+            bs.make_move_code(code)
+        plies = len(line)
+        if bs.has_legal_move():
+            value = None if searcher.endgame_tables is None else searcher.endgame_tables.probe(bs)
+            if value is None or value[0] == tablebase.DRAW:
+                return None
+            plies += value[1]
+        return max(1, (plies + 1) // 2)
+
+
+# Seconds to spend on a move given the clock in milliseconds, an even share of the time left plus most of the
+# increment, and never more than half of what is left
+def time_for_move(remaining, increment, moves_to_go=None):
+    share = remaining / (moves_to_go or DEFAULT_MOVES_TO_GO) + increment * 0.75
+    return max(0.01, min(share, remaining / 2) / 1000 - MOVE_OVERHEAD)
+
+
+def main():
+    return UCIEngine().run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())